@@ -0,0 +1,250 @@
+"""
+Benchmark loading the labeling page: bytes transferred from MongoDB and the time
+to fetch and render a batch of sources with the legacy find()
+(python-side label filtering) vs server.label_page_pipeline.
+
+Uses a scratch collection in the database from config.json/secrets.json
+that is dropped afterwards. With --offline, only compares the BSON sizes of
+the two projections applied in python to the synthetic sources, no database needed.
+
+python benchmarks/label_page.py [--num_sources 100] [--num_users 10] [--repeat 3]
+python benchmarks/label_page.py --offline
+"""
+import argparse
+import os
+import sys
+import time
+
+import bson
+import jinja2
+import numpy as np
+import pymongo
+
+current_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "ztf-variable-marshal",
+)
+sys.path.insert(0, current_dir)
+
+from server import config, label_page_pipeline  # noqa: E402
+from utils import pack_lc, random_alphanumeric_str, to_pretty_json  # noqa: E402
+
+
+def synthetic_source(zvm_program_id: int, num_users: int, num_points: int, rng) -> dict:
+    ra, dec = float(rng.uniform(0, 360)), float(rng.uniform(-30, 90))
+    hjd = 2458200.5 + np.sort(rng.uniform(0, 1500, num_points))
+    lcs = [
+        pack_lc(
+            {
+                "_id": random_alphanumeric_str(length=24),
+                "telescope": "PO:1.2m",
+                "instrument": "ZTF",
+                "filter": filt,
+                "id": int(rng.integers(1e13, 1e14)),
+                "lc_type": "temporal",
+                "data": [
+                    {
+                        "hjd": float(hjd[ii]),
+                        "mag": float(rng.normal(17, 0.3)),
+                        "magerr": float(rng.uniform(0.01, 0.1)),
+                        "catflags": 0,
+                        "programid": 1,
+                    }
+                    for ii in range(num_points)
+                ],
+            },
+            config["misc"]["lc_storage_format"],
+        )
+        for filt in (1, 2, 3)
+    ]
+    return {
+        "_id": random_alphanumeric_str(length=12),
+        "zvm_program_id": zvm_program_id,
+        "ra": ra,
+        "dec": dec,
+        "l": float(rng.uniform(0, 360)),
+        "b": float(rng.uniform(-90, 90)),
+        "p": [{"period": 0.5, "period_unit": "Days"}],
+        "lc": lcs,
+        "spec": [],
+        "xmatch": {
+            "Gaia_EDR3": [
+                {
+                    "_id": int(rng.integers(1e15, 1e16)),
+                    "parallax": 1.0,
+                    "phot_g_mean_mag": 17.0,
+                }
+            ],
+            "ZTF_alerts": [
+                {
+                    "objectId": "ZTF18aaaaaaa",
+                    "candid": int(rng.integers(1e15, 1e16)),
+                    "candidate": {"jd": float(jd), "magpsf": 17.0, "sigmapsf": 0.1},
+                }
+                for jd in hjd[::20]
+            ],
+        },
+        "labels": [
+            {
+                "type": "phenomenological",
+                "label": "variable",
+                "value": 1,
+                "user": f"user{uu}",
+            }
+            for uu in range(num_users)
+        ],
+        "history": [
+            {"note_type": "info", "time_tag": None, "user": "admin", "note": "Saved"}
+        ],
+        "created": None,
+    }
+
+
+def legacy_fetch(collection, q, user, number):
+    sources = list(
+        collection.find(q, {"xmatch.ZTF_alerts": 0, "history": 0, "spec.data": 0})
+        .limit(number)
+        .sort([("created", -1)])
+    )
+    for source in sources:
+        source["labels"] = [
+            lab for lab in source.get("labels", ()) if lab.get("user", None) == user
+        ]
+    return sources
+
+
+def legacy_project(source, user):
+    """python version of legacy_fetch's projection and label filtering"""
+    source = {key: value for key, value in source.items() if key != "history"}
+    source["xmatch"] = {
+        key: value for key, value in source["xmatch"].items() if key != "ZTF_alerts"
+    }
+    source["spec"] = [
+        {key: value for key, value in spec.items() if key != "data"}
+        for spec in source["spec"]
+    ]
+    source["labels"] = [lab for lab in source["labels"] if lab["user"] == user]
+    return source
+
+
+def pipeline_project(source, user):
+    """python version of the $project stages of server.label_page_pipeline"""
+    projected = {key: source[key] for key in ("_id", "ra", "dec", "l", "b", "p")}
+    projected["xmatch"] = {
+        key: value for key, value in source["xmatch"].items() if key != "ZTF_alerts"
+    }
+    projected["labels"] = [lab for lab in source["labels"] if lab["user"] == user]
+    return projected
+
+
+def pipeline_fetch(collection, q, user, number):
+    return list(
+        collection.aggregate(
+            label_page_pipeline(q, user, sort={"created": -1}, limit=number)
+        )
+    )
+
+
+def timeit(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_sources", type=int, default=100)
+    parser.add_argument("--num_users", type=int, default=10)
+    parser.add_argument("--num_points", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--offline", action="store_true")
+    args = parser.parse_args()
+
+    if args.offline:
+        rng = np.random.default_rng(42)
+        sources = [
+            synthetic_source(-1, args.num_users, args.num_points, rng)
+            for _ in range(args.num_sources)
+        ]
+        print(
+            f"{args.num_sources} sources x 3 light curves x {args.num_points} points, "
+            f"{args.num_users} users' labels:"
+        )
+        for name, project in (
+            ("stored", lambda source, user: source),
+            ("legacy", legacy_project),
+            ("pipeline", pipeline_project),
+        ):
+            size = sum(len(bson.encode(project(source, "user0"))) for source in sources)
+            print(f"{name:9s} {size / 2**20:8.2f} MiB")
+        sys.exit(0)
+
+    client = pymongo.MongoClient(
+        host=config["database"]["host"],
+        port=config["database"]["port"],
+        username=config["database"]["user"],
+        password=config["database"]["pwd"],
+        authSource=config["database"]["db"],
+    )
+    collection = client[config["database"]["db"]][
+        f"benchmark_label_page_{random_alphanumeric_str(8)}"
+    ]
+
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(os.path.join(current_dir, "templates"))
+    )
+    env.filters["tojson_pretty"] = to_pretty_json
+    template = env.get_template("template-label.html")
+
+    def render(sources):
+        return template.render(
+            logo=config["server"]["logo"],
+            user="user0",
+            users=[],
+            programs=[],
+            classes=config["classifications"],
+            descriptions=config["label_descriptions"],
+            data=sources,
+            messages=[],
+        )
+
+    try:
+        rng = np.random.default_rng(42)
+        collection.insert_many(
+            [
+                synthetic_source(-1, args.num_users, args.num_points, rng)
+                for _ in range(args.num_sources)
+            ]
+        )
+        q = {"zvm_program_id": -1}
+
+        results = dict()
+        for name, fetch in (("legacy", legacy_fetch), ("pipeline", pipeline_fetch)):
+            t_fetch, sources = timeit(
+                lambda: fetch(collection, q, "user0", args.num_sources), args.repeat
+            )
+            t_render, html = timeit(lambda: render(sources), args.repeat)
+            results[name] = {
+                "bytes": sum(len(bson.encode(source)) for source in sources),
+                "fetch": t_fetch,
+                "render": t_render,
+                "html": len(html),
+            }
+
+        print(
+            f"{args.num_sources} sources x 3 light curves x {args.num_points} points, "
+            f"{args.num_users} users' labels, best of {args.repeat}:"
+        )
+        for name, result in results.items():
+            print(
+                f"{name:9s} {result['bytes'] / 2**20:8.2f} MiB transferred, "
+                f"fetch {result['fetch'] * 1e3:8.1f} ms, "
+                f"render {result['render'] * 1e3:8.1f} ms, "
+                f"html {result['html'] / 2**10:8.1f} KiB"
+            )
+
+    finally:
+        collection.drop()
@@ -0,0 +1,79 @@
+"""
+Benchmark light curve storage formats: BSON document size and the time
+it takes to decode a source and get its light curve columns
+
+python benchmarks/lc_storage.py [--num_points 10000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import time
+
+import bson
+import numpy as np
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "ztf-variable-marshal",
+    ),
+)
+
+from utils import lc_columns, pack_lc  # noqa: E402
+
+
+def synthetic_lc(num_points: int, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    hjd = 2458200.5 + np.sort(rng.uniform(0, 1500, num_points))
+    return {
+        "_id": "a" * 24,
+        "telescope": "PO:1.2m",
+        "instrument": "ZTF",
+        "id": 10538291000123,
+        "filter": 2,
+        "lc_type": "temporal",
+        "data": [
+            {
+                "hjd": float(hjd[ii]),
+                "mag": float(rng.normal(17, 0.3)),
+                "magerr": float(rng.uniform(0.01, 0.1)),
+                "ra": float(rng.normal(300.0, 1e-5)),
+                "dec": float(rng.normal(20.0, 1e-5)),
+                "programid": int(rng.integers(1, 4)),
+                "catflags": int(rng.choice([0, 0, 0, 32768])),
+                "expid": int(rng.integers(40000000, 90000000)),
+            }
+            for ii in range(num_points)
+        ],
+    }
+
+
+def timeit(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_points", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    lc = synthetic_lc(args.num_points)
+
+    print(f"{args.num_points} data points, best of {args.repeat}:")
+    print(f"{'format':>10} {'size, kB':>10} {'decode, ms':>12}")
+    for lc_format in ("records", "columnar", "packed"):
+        encoded = bson.encode({"_id": "ZTFS24aaaaaaa", "lc": [pack_lc(lc, lc_format)]})
+
+        def decode():
+            source = bson.decode(encoded)
+            return [lc_columns(llc) for llc in source["lc"]]
+
+        t_decode = timeit(decode, args.repeat)
+        print(f"{lc_format:>10} {len(encoded) / 1024:10.1f} {t_decode * 1e3:12.1f}")
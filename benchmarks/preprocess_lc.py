@@ -0,0 +1,136 @@
+"""
+Benchmark light curve pre-processing for the source page:
+the legacy pandas/apply path vs utils.preprocess_lc on a synthetic source
+
+python benchmarks/preprocess_lc.py [--num_points 50000] [--repeat 3]
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "ztf-variable-marshal",
+    ),
+)
+
+from utils import lc_records_to_columns, mjd_to_datetime, preprocess_lc  # noqa: E402
+
+
+def synthetic_lc(num_points: int, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    hjd = 2458200.5 + np.sort(rng.uniform(0, 1500, num_points))
+    detected = rng.uniform(size=num_points) > 0.2
+    data = []
+    for ii in range(num_points):
+        dp = {
+            "hjd": float(hjd[ii]),
+            "programid": int(rng.integers(1, 4)),
+            "catflags": 0,
+        }
+        if detected[ii]:
+            dp["mag"] = float(rng.normal(17, 0.3))
+            dp["magerr"] = float(rng.uniform(0.01, 0.1))
+        else:
+            dp["mag_ulim"] = float(rng.normal(20.5, 0.5))
+        data.append(dp)
+    return data
+
+
+def legacy_preprocess_lc(data, t_utc):
+    df = pd.DataFrame(data).fillna(0)
+
+    if "mjd" not in df:
+        df["mjd"] = df["hjd"] - 2400000.5
+    if "hjd" not in df:
+        df["hjd"] = df["mjd"] + 2400000.5
+    if "datetime" not in df:
+        df["datetime"] = df["mjd"].apply(lambda x: mjd_to_datetime(x))
+    if "dt" not in df:
+        df["dt"] = df["datetime"].apply(lambda x: x.strftime("%Y-%m-%d %H:%M:%S"))
+    df.sort_values(by=["mjd"], inplace=True)
+    if "jd" not in df:
+        df["jd"] = df["mjd"] + 2400000.5
+    df["days_ago"] = df["datetime"].apply(
+        lambda x: (t_utc - x).total_seconds() / 86400.0
+    )
+    data = df.to_dict("records")
+
+    lc = {
+        "lc_det": {
+            kk: [] for kk in ("dt", "days_ago", "jd", "mjd", "hjd", "mag", "magerr")
+        },
+        "lc_nodet_u": {
+            kk: [] for kk in ("dt", "days_ago", "jd", "mjd", "hjd", "mag_ulim")
+        },
+        "lc_nodet_l": {
+            kk: [] for kk in ("dt", "days_ago", "jd", "mjd", "hjd", "mag_llim")
+        },
+    }
+    for dp in data:
+        if ("mag_ulim" in dp) and (dp["mag_ulim"] > 0.01):
+            for kk in lc["lc_nodet_u"]:
+                lc["lc_nodet_u"][kk].append(dp[kk])
+        if ("mag_llim" in dp) and (dp["mag_llim"] > 0.01):
+            for kk in lc["lc_nodet_l"]:
+                lc["lc_nodet_l"][kk].append(dp[kk])
+        if ("mag" in dp) and (dp["mag"] > 0.01):
+            for kk in lc["lc_det"]:
+                lc["lc_det"][kk].append(dp[kk])
+    return lc
+
+
+def vectorized_preprocess_lc(data, t_utc):
+    return preprocess_lc(
+        lc_records_to_columns(
+            data,
+            fields=("mjd", "hjd", "jd", "dt", "mag", "magerr", "mag_ulim", "mag_llim"),
+        ),
+        t_utc=t_utc,
+    )
+
+
+def timeit(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_points", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data = synthetic_lc(args.num_points)
+    t_utc = datetime.datetime.utcnow()
+
+    t_legacy, lc_legacy = timeit(lambda: legacy_preprocess_lc(data, t_utc), args.repeat)
+    t_vectorized, lc_vectorized = timeit(
+        lambda: vectorized_preprocess_lc(data, t_utc), args.repeat
+    )
+
+    # same output
+    for key in lc_legacy:
+        for field in lc_legacy[key]:
+            legacy, vectorized = lc_legacy[key][field], lc_vectorized[key][field]
+            assert len(legacy) == len(vectorized), (key, field)
+            if field == "dt":
+                assert legacy == vectorized, (key, field)
+            else:
+                np.testing.assert_allclose(legacy, vectorized, rtol=0, atol=1e-6)
+
+    print(f"{args.num_points} data points, best of {args.repeat}:")
+    print(f"legacy:     {t_legacy * 1e3:8.1f} ms")
+    print(f"vectorized: {t_vectorized * 1e3:8.1f} ms")
+    print(f"speedup:    {t_legacy / t_vectorized:8.1f}x")
@@ -0,0 +1,119 @@
+"""
+Benchmark light curve formatting for the search page:
+the legacy per-source/per-point path vs utils.format_search_lcs
+on a synthetic cone search result
+
+python benchmarks/search_lcs.py [--num_sources 300] [--num_points 1000] [--repeat 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "ztf-variable-marshal",
+    ),
+)
+
+from utils import format_search_lcs, mjd_to_datetime  # noqa: E402
+
+MSIP_BEST_BEFORE_MJD = 58700.0
+
+
+def synthetic_lcs(num_sources: int, num_points: int, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    lcs = []
+    for _ in range(num_sources):
+        hjd = 2458200.5 + rng.uniform(0, 1500, num_points)
+        lcs.append(
+            [
+                {
+                    "hjd": float(hjd[ii]),
+                    "mag": float(rng.normal(17, 0.3)),
+                    "magerr": float(rng.uniform(0.01, 0.1)),
+                    "programid": int(rng.integers(1, 4)),
+                }
+                for ii in range(num_points)
+            ]
+        )
+    return lcs
+
+
+def legacy_format_search_lcs(lcs, msip_best_before_mjd):
+    formatted = []
+    for lc in lcs:
+        lc = [
+            p
+            for p in lc
+            if ((p["programid"] != 1) or (p["hjd"] - 2400000.5 <= msip_best_before_mjd))
+        ]
+
+        mags = np.array([llc["mag"] for llc in lc])
+        magerrs = np.array([llc["magerr"] for llc in lc])
+        hjds = np.array([llc["hjd"] for llc in lc])
+        mjds = hjds - 2400000.5
+        datetimes = np.array(
+            [
+                mjd_to_datetime(llc["hjd"] - 2400000.5).strftime("%Y-%m-%d %H:%M:%S")
+                for llc in lc
+            ]
+        )
+
+        ind_sort = np.argsort(mjds, kind="stable")
+        formatted.append(
+            {
+                "mag": mags[ind_sort].tolist(),
+                "magerr": magerrs[ind_sort].tolist(),
+                "mjd": datetimes[ind_sort].tolist(),
+            }
+        )
+    return formatted
+
+
+def timeit(func, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_sources", type=int, default=300)
+    parser.add_argument("--num_points", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    lcs = synthetic_lcs(args.num_sources, args.num_points)
+
+    t_legacy, lcs_legacy = timeit(
+        lambda: legacy_format_search_lcs(lcs, MSIP_BEST_BEFORE_MJD), args.repeat
+    )
+    t_vectorized, lcs_vectorized = timeit(
+        lambda: format_search_lcs(lcs, msip_best_before_mjd=MSIP_BEST_BEFORE_MJD),
+        args.repeat,
+    )
+
+    # same output
+    assert len(lcs_legacy) == len(lcs_vectorized)
+    for legacy, vectorized in zip(lcs_legacy, lcs_vectorized):
+        assert legacy["mjd"] == vectorized["mjd"]
+        np.testing.assert_allclose(legacy["mag"], vectorized["mag"], rtol=0, atol=0)
+        np.testing.assert_allclose(
+            legacy["magerr"], vectorized["magerr"], rtol=0, atol=0
+        )
+
+    print(
+        f"{args.num_sources} sources x {args.num_points} data points, "
+        f"best of {args.repeat}:"
+    )
+    print(f"legacy:     {t_legacy * 1e3:8.1f} ms")
+    print(f"vectorized: {t_vectorized * 1e3:8.1f} ms")
+    print(f"speedup:    {t_legacy / t_vectorized:8.1f}x")
@@ -0,0 +1,77 @@
+import json
+import os
+
+import pymongo
+from utils import radec2healpix
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+""" load config and secrets """
+with open(current_dir + "/config.json") as cjson:
+    config = json.load(cjson)
+
+with open(current_dir + "/secrets.json") as sjson:
+    secrets = json.load(sjson)
+
+for k in secrets:
+    if k in config:
+        config[k].update(secrets.get(k, {}))
+    else:
+        config[k] = secrets[k]
+
+
+def update_batch(db, batch, nside):
+    pixels = radec2healpix([s["ra"] for s in batch], [s["dec"] for s in batch], nside)
+    db["sources"].bulk_write(
+        [
+            pymongo.UpdateOne(
+                {"_id": s["_id"]},
+                {
+                    "$set": {
+                        "coordinates.healpix_nside": nside,
+                        "coordinates.healpix": int(pixel),
+                    }
+                },
+            )
+            for s, pixel in zip(batch, pixels)
+        ],
+        ordered=False,
+    )
+
+
+if __name__ == "__main__":
+    client = pymongo.MongoClient(
+        host=config["database"]["host"],
+        port=config["database"]["port"],
+        username=config["database"]["user"],
+        password=config["database"]["pwd"],
+        authSource=config["database"]["db"],
+    )
+
+    db = client[config["database"]["db"]]
+
+    nside = config["misc"]["healpix"]["nside"]
+    batch_size = 1000
+
+    # only touch the sources that have not been (re)indexed with the current nside yet,
+    # so that the job can be safely interrupted and rerun
+    c = db["sources"].find(
+        {"coordinates.healpix_nside": {"$ne": nside}},
+        {"_id": 1, "ra": 1, "dec": 1},
+        batch_size=batch_size,
+    )
+
+    num_updated = 0
+    batch = []
+    for source in c:
+        batch.append(source)
+        if len(batch) == batch_size:
+            update_batch(db, batch, nside)
+            num_updated += len(batch)
+            print(f"Updated {num_updated} sources")
+            batch = []
+
+    if len(batch) > 0:
+        update_batch(db, batch, nside)
+        num_updated += len(batch)
+        print(f"Updated {num_updated} sources")
@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+
+import pymongo
+from utils import lc_records, pack_lc, random_alphanumeric_str
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+""" load config and secrets """
+with open(current_dir + "/config.json") as cjson:
+    config = json.load(cjson)
+
+with open(current_dir + "/secrets.json") as sjson:
+    secrets = json.load(sjson)
+
+for k in secrets:
+    if k in config:
+        config[k].update(secrets.get(k, {}))
+    else:
+        config[k] = secrets[k]
+
+
+def needs_migration(lc_format: str):
+    """
+        Filter selecting the sources with light curves that lack an _id
+        or are not stored in lc_format yet
+    :param lc_format:
+    :return:
+    """
+    if lc_format == "records":
+        wrong_format = {"lc.format": {"$in": ["columnar", "packed"]}}
+    else:
+        wrong_format = {"lc": {"$elemMatch": {"format": {"$ne": lc_format}}}}
+
+    return {"$or": [{"lc": {"$elemMatch": {"_id": {"$exists": False}}}}, wrong_format]}
+
+
+def migrate_lc(lc, lc_format: str):
+    if "_id" not in lc:
+        lc["_id"] = random_alphanumeric_str(length=24)
+    if lc.get("format", "records") == lc_format:
+        return lc
+    return pack_lc(lc_records(lc), lc_format)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Assign missing light curve ids and convert light curves "
+        "to the configured storage format. Safe to interrupt and rerun."
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default=config["misc"]["lc_storage_format"],
+        choices=("records", "columnar", "packed"),
+    )
+    parser.add_argument("--batch_size", type=int, default=100)
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(
+        host=config["database"]["host"],
+        port=config["database"]["port"],
+        username=config["database"]["user"],
+        password=config["database"]["pwd"],
+        authSource=config["database"]["db"],
+    )
+
+    db = client[config["database"]["db"]]
+
+    c = db["sources"].find(
+        needs_migration(args.format),
+        {"_id": 1, "lc": 1, "last_modified": 1},
+        batch_size=args.batch_size,
+    )
+
+    num_migrated, num_skipped = 0, 0
+    for source in c:
+        lcs = [migrate_lc(lc, args.format) for lc in source["lc"]]
+        # the source might have been modified since we read it, leave it for the next run then
+        result = db["sources"].update_one(
+            {"_id": source["_id"], "last_modified": source.get("last_modified", None)},
+            {"$set": {"lc": lcs}},
+        )
+        if result.modified_count > 0:
+            num_migrated += 1
+        else:
+            num_skipped += 1
+
+        if (num_migrated + num_skipped) % args.batch_size == 0:
+            print(f"Migrated {num_migrated} sources, skipped {num_skipped}")
+
+    print(f"Migrated {num_migrated} sources, skipped {num_skipped}")
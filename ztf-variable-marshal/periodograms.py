@@ -0,0 +1,184 @@
+"""
+Periodograms for saved sources' light curves.
+
+Pure functions of numpy arrays so that they can run in worker processes.
+"""
+import numpy as np
+from astropy.timeseries import LombScargle
+from numba import njit
+
+METHODS = ("ls", "ce")
+
+
+def frequency_grid(t, f_min: float, f_max: float, oversampling: float = 5):
+    """
+        Uniform frequency grid resolving peaks of width ~1/baseline
+
+    :param t: time stamps [days]
+    :param f_min: [1/day]
+    :param f_max: [1/day]
+    :param oversampling: number of grid points per 1/baseline
+    :return: frequencies [1/day]
+    """
+    baseline = np.ptp(t) if len(t) > 1 else 1.0
+    df = 1.0 / (oversampling * max(baseline, 1.0))
+    return np.arange(max(f_min, df), f_max, df)
+
+
+def lomb_scargle(t, y, dy, freqs):
+    """
+        Generalized (floating mean, weighted) Lomb-Scargle periodogram,
+        Zechmeister & Kuerster 2009, normalized to [0, 1].
+        Uses astropy's O(N log N) "fast" method, freqs must be a regular grid
+
+    :param t: time stamps [days]
+    :param y: magnitudes
+    :param dy: magnitude errors
+    :param freqs: [1/day], see frequency_grid
+    :return: power at freqs
+    """
+    return LombScargle(
+        t, y, np.maximum(dy, 1e-6), fit_mean=True, center_data=True
+    ).power(freqs, method="fast", assume_regular_frequency=True)
+
+
+@njit(cache=True)
+def conditional_entropy(t, y, freqs, phase_bins: int = 10, mag_bins: int = 5):
+    """
+        Conditional entropy of magnitude given phase, Graham et al. 2013,
+        returned as 1 - H / max(H) so that higher is better like for the other methods
+
+    :param t: time stamps [days]
+    :param y: magnitudes
+    :param freqs: [1/day]
+    :param phase_bins:
+    :param mag_bins:
+    :return: power at freqs
+    """
+    y_min, y_max = np.min(y), np.max(y)
+    m = np.minimum(
+        ((y - y_min) / max(y_max - y_min, 1e-12) * mag_bins).astype(np.int64),
+        mag_bins - 1,
+    )
+
+    entropy = np.empty(len(freqs))
+    counts = np.empty((phase_bins, mag_bins))
+    for ii in range(len(freqs)):
+        counts[:] = 0.0
+        for jj in range(len(t)):
+            phase = (t[jj] * freqs[ii]) % 1.0
+            counts[min(int(phase * phase_bins), phase_bins - 1), m[jj]] += 1.0
+
+        h = 0.0
+        for pp in range(phase_bins):
+            in_phase = np.sum(counts[pp])
+            for mm in range(mag_bins):
+                if counts[pp, mm] > 0:
+                    p_ij = counts[pp, mm] / len(t)
+                    h += p_ij * np.log(in_phase / counts[pp, mm])
+        entropy[ii] = h
+
+    return 1.0 - entropy / max(np.max(entropy), 1e-12)
+
+
+def top_peaks(freqs, power, k: int = 5, min_separation: float = None):
+    """
+        Highest k local maxima of the periodogram at least min_separation apart
+
+    :param freqs: [1/day]
+    :param power:
+    :param k:
+    :param min_separation: [1/day], grid step by default
+    :return: indices of the peaks, highest first
+    """
+    if len(power) < 3:
+        return np.argsort(power)[::-1][:k]
+    if min_separation is None:
+        min_separation = freqs[1] - freqs[0]
+
+    w_max = np.r_[
+        False, (power[1:-1] >= power[:-2]) & (power[1:-1] >= power[2:]), False
+    ]
+    candidates = np.flatnonzero(w_max)
+    candidates = candidates[np.argsort(power[candidates])[::-1]]
+
+    peaks = []
+    for ii in candidates:
+        if all(abs(freqs[ii] - freqs[jj]) >= min_separation for jj in peaks):
+            peaks.append(ii)
+            if len(peaks) == k:
+                break
+
+    return np.array(peaks, dtype=np.int64)
+
+
+def merge_series(series):
+    """
+        Merge good detections of several light curves into one,
+        subtracting the median magnitude of each to remove filter offsets
+
+    :param series: [{"hjd": ..., "mag": ..., "magerr": ..., "catflags": ... or None}]
+    :return: t, y, dy
+    """
+    t, y, dy = [], [], []
+    for ss in series:
+        w_det = (ss["mag"] != 0) & np.isfinite(ss["mag"]) & np.isfinite(ss["hjd"])
+        if ss.get("catflags", None) is not None:
+            w_det &= ss["catflags"] == 0
+        if np.sum(w_det) < 2:
+            continue
+        t.append(ss["hjd"][w_det])
+        y.append(ss["mag"][w_det] - np.median(ss["mag"][w_det]))
+        magerr = ss["magerr"][w_det]
+        dy.append(np.where(np.isfinite(magerr), magerr, np.nanmedian(magerr)))
+
+    if len(t) == 0:
+        return np.empty(0), np.empty(0), np.empty(0)
+
+    return np.concatenate(t), np.concatenate(y), np.concatenate(dy)
+
+
+def period_candidates(
+    series,
+    method: str = "ls",
+    f_min: float = 0.01,
+    f_max: float = 48.0,
+    oversampling: float = 5,
+    k: int = 5,
+    min_points: int = 20,
+):
+    """
+        Periodogram of the merged light curves and its top-k peaks
+
+    :param series: see merge_series
+    :param method: ls (Lomb-Scargle) or ce (conditional entropy)
+    :param f_min: [1/day]
+    :param f_max: [1/day]
+    :param oversampling: see frequency_grid
+    :param k: number of peaks to return
+    :param min_points: do not bother with fewer good data points
+    :return: [{"period": [days], "power": ..., "method": ...}], best first
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown periodogram method {method}, use one of {METHODS}")
+
+    t, y, dy = merge_series(series)
+    if len(t) < min_points:
+        return []
+
+    t = t - t.min()
+    freqs = frequency_grid(t, f_min, f_max, oversampling)
+    if method == "ls":
+        power = lomb_scargle(t, y, dy, freqs)
+    else:
+        power = conditional_entropy(t, y, freqs)
+
+    return [
+        {
+            "period": float(1.0 / freqs[ii]),
+            "period_unit": "Days",
+            "power": float(power[ii]),
+            "method": method,
+        }
+        for ii in top_peaks(freqs, power, k=k)
+    ]
@@ -0,0 +1,330 @@
+"""
+Plot rendering for the source pages.
+
+Pure functions of numpy arrays and plain parameters that return PNG bytes,
+using the object-oriented matplotlib API with the Agg canvas
+so that they are safe to run in worker processes/threads.
+"""
+import functools
+import io
+import os
+
+import matplotlib.image as mpimg
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def to_png(fig, dpi: int = 200):
+    FigureCanvasAgg(fig)
+    buff = io.BytesIO()
+    fig.savefig(buff, dpi=dpi, bbox_inches="tight")
+    return buff.getvalue()
+
+
+@functools.lru_cache(maxsize=1)
+def hr_background():
+    return mpimg.imread(os.path.join(current_dir, "static/img/hr_plot.png"))
+
+
+def detections(series, use_catflags: bool = True):
+    """
+        Mask of detections (mag != 0) [that are not flagged]
+    :param series: {"mag": ..., "catflags": ... or None}
+    :param use_catflags:
+    :return:
+    """
+    w_det = series["mag"] != 0
+    if use_catflags and series.get("catflags", None) is not None:
+        w_det &= series["catflags"] == 0
+    return w_det
+
+
+def plot_lc(
+    source_id: str,
+    series: list,
+    w: float = 10,
+    h: float = 4,
+    hist: bool = False,
+    bins="auto",
+    period: float = None,
+    units: str = "days",
+    plot_twice: bool = False,
+):
+    """
+        Photometric or phase-folded light curve, optionally with mag histogram
+        on the right-hand side
+
+    :param source_id:
+    :param series: [{"filter": ..., "color": ..., "hjd": np.array, "mag": np.array,
+                     "magerr": np.array, "catflags": np.array or None}]
+    :param w: figure width [in]
+    :param h: figure height [in]
+    :param hist: plot mag histogram?
+    :param bins: histogram bins
+    :param period: fold with this period [days]
+    :param units: period units to display
+    :param plot_twice: plot two periods
+    :return: PNG bytes
+    """
+    fig = Figure(figsize=(w, h), dpi=200)
+
+    if not hist:
+        ax_plc = fig.add_subplot(111)
+    else:
+        # definitions for the axes
+        left, width = 0.1, 0.65
+        bottom, height = 0.1, 0.65
+        spacing = 0.005
+
+        rect_scatter = [left, bottom, width, height]
+        rect_histy = [left + width + spacing, bottom, 0.2, height]
+
+        ax_plc = fig.add_axes(rect_scatter)
+        ax_plc.tick_params(direction="in", top=True, right=True)
+        ax_histy = fig.add_axes(rect_histy)
+        ax_histy.tick_params(direction="in", labelleft=False)
+
+    if period is None:
+        ax_plc.title.set_text(f"Photometric light curve for {source_id}")
+    else:
+        ax_plc.title.set_text(
+            f"Phase-folded light curve for {source_id} with "
+            r"$\bf{"
+            f"p={period}\\:{units}"
+            "}$"
+        )
+
+    for ss in series:
+        filt, c = ss["filter"], ss["color"]
+
+        if period is None:
+            if ss.get("catflags", None) is not None:
+                w_good = ss["catflags"] == 0
+                if np.sum(w_good) > 0:
+                    ax_plc.errorbar(
+                        ss["hjd"][w_good],
+                        ss["mag"][w_good],
+                        yerr=ss["magerr"][w_good],
+                        elinewidth=0.4,
+                        marker=".",
+                        c=c,
+                        lw=0,
+                        label=f"filter: {filt}",
+                    )
+
+                w_not_so_good = ~w_good
+                if np.sum(w_not_so_good) > 0:
+                    ax_plc.errorbar(
+                        ss["hjd"][w_not_so_good],
+                        ss["mag"][w_not_so_good],
+                        yerr=ss["magerr"][w_not_so_good],
+                        elinewidth=0.4,
+                        marker="x",
+                        alpha=0.5,
+                        c=c,
+                        lw=0,
+                        label=f"filter: {filt}, flagged",
+                    )
+            else:
+                w_det = detections(ss)
+                ax_plc.errorbar(
+                    ss["hjd"][w_det],
+                    ss["mag"][w_det],
+                    yerr=ss["magerr"][w_det],
+                    elinewidth=0.4,
+                    marker=".",
+                    c=c,
+                    lw=0,
+                    label=f"filter: {filt}",
+                )
+
+        else:
+            # phase-folded lc:
+            w_det = detections(ss)
+            t = (ss["hjd"][w_det] / period) % 1
+            mag = ss["mag"][w_det]
+            mag_error = ss["magerr"][w_det]
+            if plot_twice:
+                t = np.hstack((t, t + 1))
+                mag = np.hstack((mag, mag))
+                mag_error = np.hstack((mag_error, mag_error))
+
+            ax_plc.errorbar(
+                t,
+                mag,
+                yerr=mag_error,
+                elinewidth=0.4,
+                marker=".",
+                c=c,
+                lw=0,
+                label=f"filter: {filt}",
+            )
+
+        if hist:
+            w_det = detections(ss, use_catflags=period is not None)
+            ax_histy.hist(
+                ss["mag"][w_det],
+                bins=bins,
+                color=c,
+                alpha=0.5,
+                label=f"filter: {filt}",
+                orientation="horizontal",
+            )
+
+    ax_plc.invert_yaxis()
+    ax_plc.grid(True, lw=0.3)
+    ax_plc.set_ylabel("mag")
+
+    if not hist:
+        ax_plc.legend(
+            bbox_to_anchor=(1, 1), loc="upper left", ncol=1, fontsize="x-small"
+        )
+        fig.tight_layout(pad=0, h_pad=0, w_pad=0)
+    else:
+        ax_histy.invert_yaxis()
+        ax_histy.grid(True, lw=0.3)
+        ax_histy.legend(
+            bbox_to_anchor=(1, 1), loc="upper left", ncol=1, fontsize="x-small"
+        )
+
+    return to_png(fig)
+
+
+def plot_maghist(
+    source_id: str, series: list, w: float = 4.3, h: float = 4, bins="auto"
+):
+    """
+        Histogram of detected magnitudes
+
+    :param source_id:
+    :param series: see plot_lc
+    :param w: figure width [in]
+    :param h: figure height [in]
+    :param bins: histogram bins
+    :return: PNG bytes
+    """
+    fig = Figure(figsize=(w, h), dpi=200)
+    ax_plc = fig.add_subplot(111)
+    ax_plc.title.set_text(f"Histogram of magnitudes for {source_id}")
+
+    for ss in series:
+        ax_plc.hist(
+            ss["mag"][detections(ss)],
+            bins=bins,
+            color=ss["color"],
+            alpha=0.5,
+            label=f'filter: {ss["filter"]}',
+        )
+
+    ax_plc.grid(True, lw=0.3)
+    ax_plc.set_xlabel("mag")
+    ax_plc.legend(loc="best", ncol=1, fontsize="x-small")
+
+    fig.tight_layout(pad=0, h_pad=0, w_pad=0)
+
+    return to_png(fig)
+
+
+@functools.lru_cache(maxsize=1)
+def hr_canvas():
+    """
+        HR diagram figure drawn once per process: the background is kept as a raster
+        and only the (animated) marker and title are drawn on top of it per plot
+
+    :return: canvas, axes, marker, title, background,
+             crop slices that mimic bbox_inches="tight"
+    """
+    fig = Figure(figsize=(4, 4), dpi=200)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.imshow(hr_background(), extent=[-1, 5, 17, -5])
+    ax.set_aspect(1 / 4)
+    ax.set_ylabel("G")
+    ax.set_xlabel("BP-RP")
+    title = ax.set_title(
+        "BP-RP: 0.0000, G: 0.0000",
+        fontsize=10,
+        horizontalalignment="center",
+        color="black",
+    )
+    (marker,) = ax.plot([], [], "o", markersize=8, c="#f22f29")
+    fig.tight_layout(pad=0, h_pad=0, w_pad=0)
+
+    # tight_layout(pad=0) lets the labels stick out of the figure, which savefig's
+    # tight bbox includes: grow the canvas around the axes so that nothing is cut
+    pad = 0.5
+    w, h = fig.get_size_inches()
+    pos = ax.get_position(original=True)
+    fig.set_size_inches(w + 2 * pad, h + 2 * pad)
+    ax.set_position(
+        [
+            (pos.x0 * w + pad) / (w + 2 * pad),
+            (pos.y0 * h + pad) / (h + 2 * pad),
+            pos.width * w / (w + 2 * pad),
+            pos.height * h / (h + 2 * pad),
+        ]
+    )
+
+    # tight bounding box [px], with savefig's default pad of 0.1 in
+    bbox = fig.get_tightbbox(canvas.get_renderer()).padded(0.1)
+    height = int(fig.bbox.height)
+    top = height - int(np.ceil(bbox.y1 * fig.dpi))
+    bottom = top + int(round(bbox.height * fig.dpi))
+    left = int(bbox.x0 * fig.dpi)
+    right = left + int(round(bbox.width * fig.dpi))
+    crop = (slice(top, bottom), slice(left, right))
+
+    marker.set_animated(True)
+    title.set_animated(True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    return canvas, ax, marker, title, background, crop
+
+
+def plot_hr(x: float = None, y: float = None, no_match: str = ""):
+    """
+        Source position on the Gaia HR diagram
+
+    :param x: BP-RP
+    :param y: absolute G
+    :param no_match: title to show if x/y are not set
+    :return: PNG bytes
+    """
+    if x is not None and y is not None:
+        canvas, ax, marker, title, background, crop = hr_canvas()
+        canvas.restore_region(background)
+        marker.set_data([x], [y])
+        title.set_text(f"BP-RP: {x:.4f}, G: {y:.4f}")
+        ax.draw_artist(marker)
+        ax.draw_artist(title)
+
+        # PNG encoding is most of the ~45-60 ms a tile takes (vs ~400 ms for savefig)
+        buff = io.BytesIO()
+        mpimg.imsave(
+            buff,
+            np.asarray(canvas.buffer_rgba())[crop],
+            format="png",
+            pil_kwargs={"compress_level": 1},
+        )
+        return buff.getvalue()
+
+    # the fallback is the same every time and is rendered once on startup
+    fig = Figure(figsize=(4, 4), dpi=200)
+    ax = fig.add_subplot(111)
+    ax.imshow(hr_background(), extent=[-1, 5, 17, -5])
+    ax.set_aspect(1 / 4)
+    ax.set_ylabel("G")
+    ax.set_xlabel("BP-RP")
+    ax.set_title(
+        no_match,
+        fontsize=16,
+        horizontalalignment="center",
+        color="red",
+    )
+    fig.tight_layout(pad=0, h_pad=0, w_pad=0)
+
+    return to_png(fig)
@@ -0,0 +1,52 @@
+import json
+import os
+
+import pymongo
+from utils import split_source_id
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+
+""" load config and secrets """
+with open(current_dir + "/config.json") as cjson:
+    config = json.load(cjson)
+
+with open(current_dir + "/secrets.json") as sjson:
+    secrets = json.load(sjson)
+
+for k in secrets:
+    if k in config:
+        config[k].update(secrets.get(k, {}))
+    else:
+        config[k] = secrets[k]
+
+
+if __name__ == "__main__":
+    client = pymongo.MongoClient(
+        host=config["database"]["host"],
+        port=config["database"]["port"],
+        username=config["database"]["user"],
+        password=config["database"]["pwd"],
+        authSource=config["database"]["db"],
+    )
+
+    db = client[config["database"]["db"]]
+
+    # highest number used so far in every {prefix}{yy}{ra hours} bucket
+    counters = dict()
+    for source in db["sources"].find({}, {"_id": 1}, batch_size=10000):
+        split = split_source_id(source["_id"])
+        if split is not None:
+            bucket, num = split
+            counters[bucket] = max(counters.get(bucket, 0), num)
+
+    # $max: never move a counter back, so the job can be rerun while the server is up
+    if len(counters) > 0:
+        db["counters"].bulk_write(
+            [
+                pymongo.UpdateOne({"_id": bucket}, {"$max": {"seq": num}}, upsert=True)
+                for bucket, num in counters.items()
+            ],
+            ordered=False,
+        )
+
+    print(f"Seeded {len(counters)} counters")
@@ -1,12 +1,25 @@
+import asyncio
 import base64
+import copy
 import datetime
-import io
+import fcntl
+import functools
+import hashlib
+import hmac
+import itertools
 import json
 import math
+import multiprocessing
 import os
+import pathlib
+import random
 import re
+import shutil
+import threading
+import time
 import traceback
 from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Mapping
 
 import aiofiles
@@ -15,7 +28,6 @@ from astropy.time import Time
 import aiohttp_jinja2
 import jinja2
 import jwt
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import pymongo
@@ -27,25 +39,40 @@ from bson.json_util import dumps, loads
 from misaka import HtmlRenderer, Markdown
 from motor.motor_asyncio import AsyncIOMotorClient
 from penquins import Kowalski
+from periodograms import METHODS, period_candidates
+from plots import plot_hr, plot_lc, plot_maghist
 from utils import (
-    alphabet2num,
+    PANSTARRS_SOURCE,
+    TTLCache,
+    build_panstarrs_link,
+    build_rgb_ps_stamp_url,
     check_password_hash,
     compute_hash,
+    format_search_lcs,
     generate_password_hash,
-    get_rgb_ps_stamp_url,
     great_circle_distance,
+    group_positions,
+    healpix_cone_pixels,
+    healpix_cross_match,
     lc_colors,
-    mjd_to_datetime,
+    lc_columns,
+    lc_records,
     num2alphabet,
+    pack_lc,
+    parse_ps_filenames,
     parse_radec,
+    preprocess_lc,
+    radec2healpix,
     radec2lb,
     radec_str2geojson,
     radec_str2rad,
     random_alphanumeric_str,
+    split_source_id,
     to_pretty_json,
     uid,
     utc_now,
 )
+from yarl import URL
 
 """ markdown rendering """
 rndr = HtmlRenderer()
@@ -184,29 +211,157 @@ async def add_master_program(_mongo):
             print(_err)
 
 
-# query fritz
-def api(endpoint, method="GET", data=None):
-    import requests
+class FritzClient(object):
+    """
+    Async Fritz (SkyPortal) API client with a shared connection pool.
+
+    GET requests are retried with exponential backoff on connection errors, timeouts,
+    429 and 5xx responses; responses of the lookups that change rarely (sources
+    around a position, instruments) are kept in a TTLCache.
+    After a request fails for good, Fritz is considered down for cooldown seconds
+    and requests return None right away so that pages do not keep waiting on it.
+    Lookups made while rendering a page get a single try of at most page_timeout
+    seconds instead.
+    Like before, all failures are soft: None is returned.
+    """
 
-    try:
-        base_url = config["fritz"]["url"]
-        token = config["fritz"]["token"]
-        response = requests.request(
-            method,
-            f"{base_url}/api/{endpoint}",
-            headers={"Authorization": f"token {token}"},  # noqa
-            json=data,
+    def __init__(
+        self,
+        url: str = None,
+        token: str = None,
+        timeout: float = 10,
+        max_connections: int = 16,
+        max_retries: int = 2,
+        backoff: float = 0.5,
+        cooldown: float = 60,
+        cache_ttl: float = 600,
+        cache_max_entries: int = 10000,
+        instruments_ttl: float = 86400,
+        page_timeout: float = 2,
+    ):
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+        self.page_timeout = page_timeout
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.cache_ttl = cache_ttl
+        self.instruments_ttl = instruments_ttl
+        self.cache = TTLCache(
+            max_size=cache_max_entries, ttl=cache_ttl, size_of=lambda _: 1
         )
-        if response.status_code != 200:
-            raise Exception(response.text)
-        else:
-            q = response.json()["data"]
-        return q
-    except Exception:
-        return None
+        self.down_until = 0
+        self.session = None
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={"Authorization": f"token {self.token}"},
+        )
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+        self.cache.clear()
+
+    async def request(
+        self, endpoint, method="GET", data=None, params=None, timeout: float = None
+    ):
+        """
+            Query Fritz API, retrying GETs
+        :param endpoint: e.g. "instrument"
+        :param method:
+        :param data: json body
+        :param params: query string
+        :param timeout: if set, make a single try of at most timeout seconds
+        :return: response["data"] or None on failure
+        """
+        if self.session is None or not self.url:
+            return None
+        if time.monotonic() < self.down_until:
+            return None
+
+        max_retries = self.max_retries if method == "GET" and timeout is None else 0
+        client_timeout = aiohttp.ClientTimeout(
+            total=timeout if timeout is not None else self.timeout
+        )
+        for nr in range(max_retries + 1):
+            try:
+                async with self.session.request(
+                    method,
+                    f"{self.url}/api/{endpoint}",
+                    json=data,
+                    params=params,
+                    timeout=client_timeout,
+                ) as resp:
+                    if resp.status == 429 or resp.status >= 500:
+                        raise aiohttp.ClientResponseError(
+                            resp.request_info, resp.history, status=resp.status
+                        )
+                    if resp.status != 200:
+                        # client error, retrying will not help
+                        print(f"Fritz {endpoint}: {resp.status} {await resp.text()}")
+                        return None
+                    return (await resp.json())["data"]
+            except (aiohttp.ClientError, asyncio.TimeoutError) as _e:
+                if nr == max_retries:
+                    print(f"Fritz {endpoint} failed: {str(_e)}")
+                    self.down_until = time.monotonic() + self.cooldown
+                    return None
+                await asyncio.sleep(self.backoff * 2**nr)
+            except Exception as _e:
+                print(f"Fritz {endpoint} failed: {str(_e)}")
+                return None
+
+    async def cached(
+        self, endpoint, params=None, ttl: float = None, timeout: float = None
+    ):
+        """
+            GET request, from the cache if possible. Failures are not cached
+        :param endpoint:
+        :param params:
+        :param ttl: override default time-to-live [s]
+        :param timeout: see request
+        :return:
+        """
+        key = json.dumps([endpoint, params], sort_keys=True)
+        data = self.cache.get(key, None)
+        if data is None:
+            data = await self.request(endpoint, params=params, timeout=timeout)
+            if data is not None:
+                self.cache.set(key, data, ttl=ttl)
+        return data
+
+    async def sources(
+        self, ra, dec, radius: float = 3 / 3600, timeout: float = None, **kwargs
+    ):
+        """
+            Fritz sources within radius of (ra, dec)
+        :param ra: [deg]
+        :param dec: [deg]
+        :param radius: [deg]
+        :param timeout: see request
+        :param kwargs: extra filters, e.g. hasSpectrum="true"
+        :return:
+        """
+        params = {
+            "ra": round(float(ra), 6),
+            "dec": round(float(dec), 6),
+            "radius": radius,
+            **kwargs,
+        }
+        data = await self.cached("sources", params=params, timeout=timeout)
+        return data.get("sources", []) if data is not None else []
+
+    async def instruments(self):
+        return await self.cached("instrument", ttl=self.instruments_ttl) or []
 
+    async def spectra(self, fritz_source_id):
+        return await self.request(f"sources/{fritz_source_id}/spectra")
 
-fritz_instruments = api("instrument")
 
 routes = web.RouteTableDef()
 
@@ -327,7 +482,9 @@ async def auth(request):
     try:
         # user exists and passwords match?
         select = await request.app["mongo"].users.find_one({"_id": username})
-        if check_password_hash(select["password"], password):
+        if await request.app["password_hasher"].check(
+            username, select["password"], password
+        ):
             payload = {
                 "user_id": username,
                 "exp": datetime.datetime.utcnow()
@@ -346,6 +503,9 @@ async def auth(request):
         else:
             return web.json_response({"message": "Wrong credentials"}, status=400)
 
+    except PasswordHasherBusy as e:
+        return web.json_response({"message": str(e)}, status=503)
+
     except Exception as e:
         print(f"Got error: {str(e)}")
         _err = traceback.format_exc()
@@ -397,7 +557,9 @@ async def login_post(request):
 
         # user exists and passwords match?
         select = await request.app["mongo"].users.find_one({"_id": username})
-        if check_password_hash(select["password"], password):
+        if await request.app["password_hasher"].check(
+            username, select["password"], password
+        ):
             payload = {
                 "user_id": username,
                 "exp": datetime.datetime.utcnow()
@@ -422,6 +584,9 @@ async def login_post(request):
         else:
             raise Exception("Bad credentials")
 
+    except PasswordHasherBusy as _e:
+        return web.json_response({"message": str(_e)}, status=503)
+
     except Exception as _e:
         print(f"Got error: {str(_e)}")
         _err = traceback.format_exc()
@@ -478,6 +643,185 @@ async def root_handler(request):
     return response
 
 
+class UsersProgramsCache(object):
+    """
+    In-process cache of the users and programs shared by all handlers.
+
+    Loaded at startup and reloaded lazily on first access after invalidate(),
+    which is called by the handlers that modify users or programs.
+    Other server processes' changes are picked up via a change stream when running
+    against a replica set, or after ttl seconds otherwise.
+    """
+
+    def __init__(self, mongo, ttl: float = 60):
+        self.mongo = mongo
+        self.ttl = ttl
+        self._users = None
+        self._programs = None
+        self.loaded = 0
+        # bumped by invalidate(), so that a load() that raced with it is dropped
+        self.generation = 0
+        self.lock = asyncio.Lock()
+        self.watcher = None
+
+    async def load(self):
+        generation = self.generation
+        users = await self.mongo.users.find({}, {"_id": 1}).to_list(length=None)
+        programs = await self.mongo.programs.find({}, {"last_modified": 0}).to_list(
+            length=None
+        )
+        if generation != self.generation:
+            # might have read the collections before the change
+            return
+        self._users = sorted(uu["_id"] for uu in users)
+        self._programs = sorted(programs, key=lambda pp: pp["_id"])
+        self.loaded = time.monotonic()
+
+    def invalidate(self):
+        self.generation += 1
+        self._users = None
+        self._programs = None
+
+    async def refresh(self):
+        if self._users is None or time.monotonic() - self.loaded > self.ttl:
+            async with self.lock:
+                # someone else might have reloaded while we were waiting,
+                # and a load that raced with an invalidate() needs another go
+                while self._users is None or time.monotonic() - self.loaded > self.ttl:
+                    await self.load()
+
+    async def users(self):
+        """
+            Sorted user names
+        :return:
+        """
+        await self.refresh()
+        return list(self._users)
+
+    async def program_ids(self):
+        """
+            Sorted program ids
+        :return:
+        """
+        await self.refresh()
+        return [pp["_id"] for pp in self._programs]
+
+    async def programs(self):
+        """
+            Program documents without last_modified, sorted by id
+        :return:
+        """
+        await self.refresh()
+        return copy.deepcopy(self._programs)
+
+    async def start(self, watch: bool = False):
+        await self.load()
+        if watch:
+            self.watcher = asyncio.ensure_future(self.watch())
+
+    async def stop(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+            await asyncio.gather(self.watcher, return_exceptions=True)
+            self.watcher = None
+
+    async def watch(self):
+        """
+            Invalidate the cache on any change to the users or programs collections,
+            requires a replica set
+        :return:
+        """
+        pipeline = [{"$match": {"ns.coll": {"$in": ["users", "programs"]}}}]
+        while True:
+            try:
+                async with self.mongo.watch(pipeline) as stream:
+                    async for _ in stream:
+                        self.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as _e:
+                print(f"Got error: {str(_e)}")
+                # the stream is gone, we might have missed something
+                self.invalidate()
+                await asyncio.sleep(self.ttl)
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher(object):
+    """
+    Runs bcrypt hashing and verification on a dedicated thread pool so that logins
+    do not block the event loop. At most num_workers + max_queue_size calls may be
+    pending, further ones are rejected with PasswordHasherBusy.
+
+    Successful verifications are remembered for cache_ttl seconds, keyed on an HMAC
+    of the user name, stored hash and password with a per-process random key,
+    so that repeated logins with the same credentials skip bcrypt.
+    Changing the password changes the stored hash and thus the key.
+    """
+
+    def __init__(
+        self,
+        num_workers: int = 4,
+        max_queue_size: int = 64,
+        cache_ttl: float = 300,
+        cache_max_size: int = 10000,
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="bcrypt"
+        )
+        self.max_pending = num_workers + max_queue_size
+        self.pending = 0
+        self.cache = TTLCache(
+            max_size=cache_max_size, ttl=cache_ttl, size_of=lambda _: 1
+        )
+        self._key = os.urandom(32)
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            raise PasswordHasherBusy(
+                "Too many pending password checks, try again later"
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, func, *args
+            )
+        finally:
+            self.pending -= 1
+
+    async def generate(self, password):
+        return await self.run(generate_password_hash, password)
+
+    async def check(self, username, encoded, password):
+        """
+            Check password against its stored bcrypt hash
+        :param username:
+        :param encoded: stored hash
+        :param password:
+        :return:
+        """
+        key = hmac.new(
+            self._key,
+            "\0".join((username, encoded, password)).encode("utf-8"),
+            hashlib.sha256,
+        ).digest()
+        if self.cache.get(key, False):
+            return True
+
+        is_correct = await self.run(check_password_hash, encoded, password)
+        if is_correct:
+            self.cache.set(key, True)
+
+        return is_correct
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
+        self.cache.clear()
+
+
 """ manage users: API """
 
 
@@ -546,11 +890,12 @@ async def add_user(request):
             await request.app["mongo"].users.insert_one(
                 {
                     "_id": username,
-                    "password": generate_password_hash(password),
+                    "password": await request.app["password_hasher"].generate(password),
                     "permissions": literal_eval(str(permissions)),
                     "last_modified": datetime.datetime.now(),
                 }
             )
+            request.app["users_programs"].invalidate()
 
             return web.json_response({"message": "success"}, status=200)
 
@@ -589,6 +934,7 @@ async def remove_user(request):
 
             # try to remove the user:
             await request.app["mongo"].users.delete_one({"_id": username})
+            request.app["users_programs"].invalidate()
 
             return web.json_response({"message": "success"}, status=200)
 
@@ -642,13 +988,18 @@ async def edit_user(request):
                 select["_id"] = username
                 await request.app["mongo"].users.insert_one(select)
                 await request.app["mongo"].users.delete_one({"_id": _id})
+                request.app["users_programs"].invalidate()
 
             # change password:
             if len(password) != 0:
                 await request.app["mongo"].users.update_one(
                     {"_id": username},
                     {
-                        "$set": {"password": generate_password_hash(password)},
+                        "$set": {
+                            "password": await request.app["password_hasher"].generate(
+                                password
+                            )
+                        },
                         "$currentDate": {"last_modified": True},
                     },
                 )
@@ -760,6 +1111,7 @@ async def programs_put_handler(request):
             "last_modified": datetime.datetime.now(),
         }
         await request.app["mongo"].programs.insert_one(doc)
+        request.app["users_programs"].invalidate()
 
         return web.json_response(
             {"message": "success", "result": doc}, status=200, dumps=dumps
@@ -771,6 +1123,9 @@ async def programs_put_handler(request):
         print(_err)
         return web.json_response({"message": f"Failed to add user: {_err}"}, status=500)
 
+    finally:
+        await invalidate_query_cache(request.app, "programs")
+
 
 # todo: /programs POST and DELETE
 
@@ -1173,11 +1528,379 @@ def parse_query(task, save: bool = False):
         return "", task_reduced, {}
 
 
+class CacheGenerations(object):
+    """
+    Per-tag (collection name) generation counters kept in the cache_generations
+    collection and thus shared by all server processes.
+
+    Writers bump the counters of the collections they modify, and query result
+    cache keys include the counters read before the query is run, so that
+    neither a result computed across a write nor one cached by another process
+    before the write is served afterwards.
+    """
+
+    def __init__(self, mongo):
+        self.mongo = mongo
+
+    async def get(self, tags):
+        """
+            Current generations of tags
+        :param tags:
+        :return: {tag: generation}, 0 for the tags that have never been bumped
+        """
+        docs = await self.mongo.cache_generations.find(
+            {"_id": {"$in": sorted(tags)}}
+        ).to_list(length=None)
+        generations = {doc["_id"]: doc["generation"] for doc in docs}
+        return {tag: generations.get(tag, 0) for tag in sorted(tags)}
+
+    async def bump(self, tag):
+        await self.mongo.cache_generations.update_one(
+            {"_id": tag}, {"$inc": {"generation": 1}}, upsert=True
+        )
+
+
+async def invalidate_query_cache(app, tag):
+    """
+        Drop cached query results tagged with tag in this process
+        and make the other processes ignore theirs
+    :param app:
+    :param tag: collection name
+    :return:
+    """
+    app["query_cache"].invalidate(tag)
+    try:
+        await app["cache_generations"].bump(tag)
+    except Exception as _e:
+        print(f"Got error: {str(_e)}")
+
+
+def query_collections(task_reduced):
+    """
+        Get the names of the collections a reduced query reads from
+    :param task_reduced:
+    :return: set of collection names or None if the query result must not be cached
+    """
+    query_type = task_reduced["query_type"]
+
+    if query_type in ("find", "find_one", "count_documents"):
+        return {task_reduced["query"]["catalog"]}
+
+    elif query_type == "cone_search":
+        return set(task_reduced["query"].keys())
+
+    elif query_type == "aggregate":
+        collections = {task_reduced["query"]["catalog"]}
+        # walk the pipeline including the nested ones in $lookup's, $facet's etc.
+        stages = list(task_reduced["query"]["pipeline"])
+        while len(stages) > 0:
+            stage = stages.pop()
+            if isinstance(stage, (list, tuple)):
+                stages.extend(stage)
+            elif isinstance(stage, dict):
+                for key, value in stage.items():
+                    # writing something? not cacheable
+                    if key in ("$out", "$merge"):
+                        return None
+                    if key in ("$lookup", "$graphLookup") and isinstance(value, dict):
+                        if "from" in value:
+                            collections.add(value["from"])
+                    elif key == "$unionWith":
+                        collections.add(
+                            value if isinstance(value, str) else value.get("coll")
+                        )
+                    if isinstance(value, (dict, list, tuple)):
+                        stages.append(value)
+        return collections
+
+    # general searches may do anything, info is cheap anyway
+    return None
+
+
+def query_cursor(db, query, max_time_ms: int, batch_size: int = None):
+    """
+        Build a (lazy) motor cursor for a reduced find or aggregate query
+    :param db:
+    :param query: reduced task
+    :param max_time_ms:
+    :param batch_size: number of documents per batch returned by mongo
+    :return:
+    """
+    if query["query_type"] == "find":
+        known_kwargs = ("skip", "hint", "limit", "sort")
+        kwargs = {kk: vv for kk, vv in query["kwargs"].items() if kk in known_kwargs}
+        kwargs["comment"] = str(query["user"])
+        if batch_size is not None:
+            kwargs["batch_size"] = batch_size
+
+        # project?
+        if len(query["query"]["projection"]) > 0:
+            return db[query["query"]["catalog"]].find(
+                query["query"]["filter"],
+                query["query"]["projection"],
+                max_time_ms=max_time_ms,
+                **kwargs,
+            )
+        # return the whole documents by default
+        return db[query["query"]["catalog"]].find(
+            query["query"]["filter"], max_time_ms=max_time_ms, **kwargs
+        )
+
+    elif query["query_type"] == "aggregate":
+        kwargs = dict()
+        if batch_size is not None:
+            kwargs["batchSize"] = batch_size
+
+        return db[query["query"]["catalog"]].aggregate(
+            query["query"]["pipeline"],
+            allowDiskUse=True,
+            maxTimeMS=max_time_ms,
+            **kwargs,
+        )
+
+    raise ValueError(f'cannot build cursor for query_type {query["query_type"]}')
+
+
+async def cone_search(object_queries, find_matches):
+    """
+        Run per-object cone search queries concurrently
+    :param object_queries: {object name: (filter, projection)}
+    :param find_matches: coroutine function (filter, projection) -> list of documents
+    :return: {object name: list of matched documents}
+    """
+    objects = list(object_queries.keys())
+    matches = await asyncio.gather(
+        *[find_matches(*object_queries[obj]) for obj in objects]
+    )
+
+    return dict(zip(objects, matches))
+
+
+def cone_search_positions(object_queries):
+    """
+        Unpack per-object cone search queries
+    :param object_queries: {object name: (filter, projection)}
+    :return: object names, GeoJSON lon [deg], lat [deg], radii [rad],
+             filter without the position constraint, projection
+    """
+    objects = list(object_queries.keys())
+
+    # all the rest must be the same for all objects
+    lon, lat, radii = [], [], []
+    for obj in objects:
+        _filter = object_queries[obj][0]
+        center, radius = _filter["coordinates.radec_geojson"]["$geoWithin"][
+            "$centerSphere"
+        ]
+        lon.append(center[0])
+        lat.append(center[1])
+        radii.append(radius)
+
+    _filter, _projection = object_queries[objects[0]]
+    _filter = {
+        kk: vv for kk, vv in _filter.items() if kk != "coordinates.radec_geojson"
+    }
+
+    return objects, np.array(lon), np.array(lat), np.array(radii), _filter, _projection
+
+
+def cone_search_projection(projection, fields):
+    """
+        Make sure the coordinates.<fields> needed to split the matches between the objects
+        come back from the db
+    :param projection:
+    :param fields: e.g. ("radec_geojson", )
+    :return: projection, coordinates.<fields> to strip from the matches afterwards
+    """
+    projection = dict(projection)
+    strip = []
+    if len(projection) > 0:
+        # _id is only taken into account if it is the sole projected field
+        inclusive = any(
+            vv
+            for kk, vv in projection.items()
+            if (kk != "_id" or len(projection) == 1) and not isinstance(vv, dict)
+        )
+        if inclusive:
+            if not projection.get("coordinates", 0):
+                for field in fields:
+                    if not projection.get(f"coordinates.{field}", 0):
+                        projection[f"coordinates.{field}"] = 1
+                        strip.append(field)
+        else:
+            if projection.pop("coordinates", None) is not None:
+                strip.extend(fields)
+            for field in fields:
+                if projection.pop(f"coordinates.{field}", None) is not None:
+                    strip.append(field)
+
+    return projection, set(strip)
+
+
+def strip_coordinates(matches, strip):
+    """
+        Remove coordinates.<strip> from matched documents in place
+    :param matches: list of lists of documents
+    :param strip: coordinates.<fields> to strip
+    :return:
+    """
+    if len(strip) == 0:
+        return
+    for _matches in matches:
+        for match in _matches:
+            if "coordinates" not in match:
+                continue
+            for field in strip:
+                match["coordinates"].pop(field, None)
+            if len(match["coordinates"]) == 0:
+                match.pop("coordinates")
+
+
+async def grouped_cone_search(object_queries, find_matches, group_radius: float):
+    """
+        Merge nearby positions into a single $geoWithin query per group
+        and split the matches back to the individual objects
+
+    :param object_queries: {object name: (filter, projection)}
+    :param find_matches: coroutine function (filter, projection) -> list of documents
+    :param group_radius: [rad]
+    :return: {object name: list of matched documents}
+    """
+    objects, lon, lat, radii, _filter, _projection = cone_search_positions(
+        object_queries
+    )
+    lon, lat = lon * np.pi / 180.0, lat * np.pi / 180.0
+    _projection, strip = cone_search_projection(_projection, ("radec_geojson",))
+
+    groups = group_positions(lon, lat, group_radius)
+
+    group_matches = await asyncio.gather(
+        *[
+            find_matches(
+                {
+                    "coordinates.radec_geojson": {
+                        "$geoWithin": {
+                            "$centerSphere": [
+                                [lon[seed] * 180.0 / np.pi, lat[seed] * 180.0 / np.pi],
+                                group_radius + np.max(radii[members]),
+                            ]
+                        }
+                    },
+                    **_filter,
+                },
+                _projection,
+            )
+            for seed, members in groups
+        ]
+    )
+
+    result = dict()
+    for (seed, members), matches in zip(groups, group_matches):
+        if len(matches) > 0:
+            match_lon, match_lat = np.array(
+                [mm["coordinates"]["radec_geojson"]["coordinates"] for mm in matches]
+            ).T
+            match_lon *= np.pi / 180.0
+            match_lat *= np.pi / 180.0
+        for member in members:
+            if len(matches) > 0:
+                distances = great_circle_distance(
+                    lat[member], lon[member], match_lat, match_lon
+                )
+                result[objects[member]] = [
+                    matches[ii] for ii in np.flatnonzero(distances <= radii[member])
+                ]
+            else:
+                result[objects[member]] = []
+
+    strip_coordinates(group_matches, strip)
+
+    return result
+
+
+# nside -> (all saved sources indexed with it?, time.monotonic() of the check)
+healpix_backfill_status = dict()
+
+
+async def healpix_backfilled(mongo, nside: int, ttl: float = 60):
+    """
+        Have all saved sources been indexed with nside yet (see add_healpix.py)?
+        Until they have, bulk cross-matches against the saved sources must take
+        the $geoWithin path, or the sources that are not (re)indexed yet drop out
+    :param mongo:
+    :param nside:
+    :param ttl: re-check after ttl seconds
+    :return:
+    """
+    complete, checked = healpix_backfill_status.get(nside, (False, -math.inf))
+    if time.monotonic() - checked > ttl:
+        complete = (
+            await mongo.sources.find_one(
+                {"coordinates.healpix_nside": {"$ne": nside}}, {"_id": 1}
+            )
+            is None
+        )
+        healpix_backfill_status[nside] = (complete, time.monotonic())
+    return complete
+
+
+async def healpix_cone_search(object_queries, find_matches, nside: int):
+    """
+        Resolve the HEALPix pixels overlapping all the cones, fetch the candidates
+        with a single $in query and do the exact separation test in numpy.
+        Only works for collections with coordinates.healpix, i.e. the saved sources
+
+    :param object_queries: {object name: (filter, projection)}
+    :param find_matches: coroutine function (filter, projection) -> list of documents
+    :param nside: HEALPix nside used to compute coordinates.healpix
+    :return: {object name: list of matched documents}
+    """
+    objects, lon, lat, radii, _filter, _projection = cone_search_positions(
+        object_queries
+    )
+    # GeoJSON-friendly lon -> RA
+    ra, dec = lon + 180.0, lat
+    _projection, strip = cone_search_projection(
+        _projection, ("radec_geojson", "healpix")
+    )
+
+    position_pixels = healpix_cone_pixels(ra, dec, radii, nside)
+    pixels = np.unique(np.concatenate(position_pixels))
+
+    matches = await find_matches(
+        {
+            "coordinates.healpix_nside": nside,
+            "coordinates.healpix": {"$in": pixels.tolist()},
+            **_filter,
+        },
+        _projection,
+    )
+
+    if len(matches) > 0:
+        match_lon, match_dec = np.array(
+            [mm["coordinates"]["radec_geojson"]["coordinates"] for mm in matches]
+        ).T
+        match_pixels = [mm["coordinates"]["healpix"] for mm in matches]
+        object_matches = healpix_cross_match(
+            ra, dec, radii, position_pixels, match_lon + 180.0, match_dec, match_pixels
+        )
+    else:
+        object_matches = [[] for _ in objects]
+
+    strip_coordinates([matches], strip)
+
+    return {
+        obj: [matches[ii] for ii in _matches]
+        for obj, _matches in zip(objects, object_matches)
+    }
+
+
 async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = False):
 
     db = mongo
 
-    if save:
+    # queries run by the scheduler have been registered upon enqueueing
+    if save and len(task_doc) > 0:
         # mark query as enqueued:
         await db.queries.insert_one(task_doc)
 
@@ -1208,55 +1931,85 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
             }
             kwargs["comment"] = str(query["user"])
 
-            # iterate over catalogs as they represent
-            for catalog in query["query"]:
-                query_result[catalog] = dict()
-                # iterate over objects:
-                for obj in query["query"][catalog]:
+            # run the per-object (or per-group) sub-queries concurrently,
+            # but not more than concurrency of them at a time
+            max_concurrency = int(config["misc"]["cone_search"]["concurrency"])
+            concurrency = int(query["kwargs"].get("concurrency", max_concurrency))
+            semaphore = asyncio.Semaphore(max(min(concurrency, max_concurrency), 1))
+
+            # merge nearby positions into a single query per group?
+            # skip/limit would then apply to the whole group, so don't do that
+            group = (
+                query["kwargs"].get("group", False) is True
+                and "skip" not in kwargs
+                and "limit" not in kwargs
+            )
+            group_radius = (
+                float(
+                    query["kwargs"].get(
+                        "group_radius", config["misc"]["cone_search"]["group_radius"]
+                    )
+                )
+                * np.pi
+                / 180.0
+                / 3600.0
+            )
+
+            async def find_matches(catalog, _filter, _projection):
+                async with semaphore:
                     # project?
-                    if len(query["query"][catalog][obj][1]) > 0:
+                    if len(_projection) > 0:
                         _select = db[catalog].find(
-                            query["query"][catalog][obj][0],
-                            query["query"][catalog][obj][1],
-                            max_time_ms=max_time_ms,
-                            **kwargs,
+                            _filter, _projection, max_time_ms=max_time_ms, **kwargs
                         )
                     # return the whole documents by default
                     else:
                         _select = db[catalog].find(
-                            query["query"][catalog][obj][0],
-                            max_time_ms=max_time_ms,
-                            **kwargs,
+                            _filter, max_time_ms=max_time_ms, **kwargs
                         )
-                    # mongodb does not allow having dots in field names -> replace with underscores
-                    query_result[catalog][
-                        obj.replace(".", "_")
-                    ] = await _select.to_list(length=None)
+                    return await _select.to_list(length=None)
+
+            nside = config["misc"]["healpix"]["nside"]
+            healpix_ready = "sources" in query["query"] and await healpix_backfilled(
+                db, nside
+            )
+
+            def catalog_cone_search(catalog):
+                object_queries = query["query"][catalog]
+                _find_matches = functools.partial(find_matches, catalog)
+                # lots of positions against the saved sources? go via their HEALPix index
+                if (
+                    catalog == "sources"
+                    and healpix_ready
+                    and len(object_queries)
+                    >= config["misc"]["healpix"]["bulk_min_positions"]
+                    and "skip" not in kwargs
+                    and "limit" not in kwargs
+                ):
+                    return healpix_cone_search(object_queries, _find_matches, nside)
+                if group:
+                    return grouped_cone_search(
+                        object_queries, _find_matches, group_radius
+                    )
+                return cone_search(object_queries, _find_matches)
+
+            catalogs = list(query["query"].keys())
+            catalog_results = await asyncio.gather(
+                *[catalog_cone_search(catalog) for catalog in catalogs]
+            )
+
+            for catalog, catalog_result in zip(catalogs, catalog_results):
+                # mongodb does not allow having dots in field names -> replace with underscores
+                query_result[catalog] = {
+                    obj.replace(".", "_"): matches
+                    for obj, matches in catalog_result.items()
+                }
 
         # convenience general search subtypes:
         elif query["query_type"] == "find":
             # print(query)
 
-            known_kwargs = ("skip", "hint", "limit", "sort")
-            kwargs = {
-                kk: vv for kk, vv in query["kwargs"].items() if kk in known_kwargs
-            }
-            kwargs["comment"] = str(query["user"])
-
-            # project?
-            if len(query["query"]["projection"]) > 0:
-
-                _select = db[query["query"]["catalog"]].find(
-                    query["query"]["filter"],
-                    query["query"]["projection"],
-                    max_time_ms=max_time_ms,
-                    **kwargs,
-                )
-            # return the whole documents by default
-            else:
-                _select = db[query["query"]["catalog"]].find(
-                    query["query"]["filter"], max_time_ms=max_time_ms, **kwargs
-                )
+            _select = query_cursor(db, query, max_time_ms)
 
             if (
                 isinstance(_select, int)
@@ -1303,15 +2056,7 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
         elif query["query_type"] == "aggregate":
             # print(query)
 
-            known_kwargs = ("allowDiskUse", "maxTimeMS", "batchSize")
-            kwargs = {
-                kk: vv for kk, vv in query["kwargs"].items() if kk in known_kwargs
-            }
-            kwargs["comment"] = str(query["user"])
-
-            _select = db[query["query"]["catalog"]].aggregate(
-                query["query"]["pipeline"], allowDiskUse=True, maxTimeMS=max_time_ms
-            )
+            _select = query_cursor(db, query, max_time_ms)
 
             query_result["query_result"] = await _select.to_list(length=None)
 
@@ -1474,6 +2219,258 @@ async def execute_query(mongo, task_hash, task_reduced, task_doc, save: bool = F
         raise Exception("Query failed")
 
 
+class QueryScheduler(object):
+    """
+    Executes enqueued queries in the background on a fixed number of worker tasks,
+    lowest priority number first (FIFO within the same priority).
+
+    Query status is persisted in the queries collection (enqueued -> running -> done/failed),
+    tasks and results are stored on disk under path_queries by execute_query.
+
+    Every scheduler (one per server process) tags the queries it owns with its id
+    and keeps a heartbeat in the query_schedulers collection. Queries left enqueued
+    or running by a scheduler that is gone (restart, crash) are marked failed,
+    so that they can be resubmitted.
+    """
+
+    def __init__(
+        self,
+        mongo,
+        num_workers: int = 4,
+        max_queue_size: int = 0,
+        heartbeat_interval: float = 30,
+    ):
+        self.mongo = mongo
+        self.num_workers = num_workers
+        self.queue = asyncio.PriorityQueue(maxsize=max_queue_size)
+        self.workers = []
+        # task_id -> asyncio.Task for queries that are being executed by this process
+        self.running = dict()
+        # tie-breaker to keep FIFO order within the same priority
+        self.counter = itertools.count()
+        self.instance_id = random_alphanumeric_str(length=24)
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat = None
+
+    async def start(self):
+        await self.beat()
+        await self.recover()
+        self.workers = [
+            asyncio.ensure_future(self.worker()) for _ in range(self.num_workers)
+        ]
+        self.heartbeat = asyncio.ensure_future(self.heartbeats())
+
+    async def stop(self):
+        tasks = [*self.workers, *self.running.values()]
+        if self.heartbeat is not None:
+            tasks.append(self.heartbeat)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers = []
+        self.heartbeat = None
+
+        # whatever this process has not finished will not be finished
+        await self.fail({"scheduler": self.instance_id}, "server stopped")
+        await self.mongo.query_schedulers.delete_one({"_id": self.instance_id})
+
+    async def beat(self):
+        await self.mongo.query_schedulers.update_one(
+            {"_id": self.instance_id}, {"$set": {"last_seen": utc_now()}}, upsert=True
+        )
+
+    async def heartbeats(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.beat()
+                await self.recover()
+            except Exception as _e:
+                print(f"Got error: {str(_e)}")
+
+    async def fail(self, q: dict, msg: str):
+        """
+            Mark enqueued/running queries matching q failed
+        :param q:
+        :param msg:
+        :return:
+        """
+        await self.mongo.queries.update_many(
+            {**q, "status": {"$in": ["enqueued", "running"]}},
+            {"$set": {"status": "failed", "msg": msg, "last_modified": utc_now()}},
+        )
+
+    async def recover(self):
+        """
+            Fail the queries owned by schedulers that have stopped beating
+            (or by none, i.e. left over from before the ownership was tracked)
+        :return:
+        """
+        since = utc_now() - datetime.timedelta(seconds=3 * self.heartbeat_interval)
+        alive = await self.mongo.query_schedulers.find(
+            {"last_seen": {"$gte": since}}, {"_id": 1}
+        ).to_list(length=None)
+        await self.fail(
+            {"scheduler": {"$nin": [scheduler["_id"] for scheduler in alive]}},
+            "query was orphaned by a server restart, resubmit it",
+        )
+        await self.mongo.query_schedulers.delete_many({"last_seen": {"$lt": since}})
+
+    async def enqueue(self, task_hash, task_reduced, task_doc, priority: int = 0):
+        """
+            Register query in the db and put it in the queue
+        :param task_hash:
+        :param task_reduced:
+        :param task_doc:
+        :param priority: lower is sooner
+        :return:
+        """
+        if self.queue.full():
+            raise Exception("Query queue is full, try again later")
+
+        existing = await self.mongo.queries.find_one(
+            {"user": task_reduced["user"], "task_id": task_hash}, {"status": 1}
+        )
+        if existing is not None:
+            # identical query already waiting or running? nothing to do
+            if existing["status"] in ("enqueued", "running"):
+                return task_hash
+            await self.mongo.queries.delete_one({"_id": existing["_id"]})
+
+        task_doc = {**task_doc, "scheduler": self.instance_id}
+        result = await self.mongo.queries.insert_one(task_doc)
+        try:
+            # the queue might have filled up while we were talking to the db
+            self.queue.put_nowait(
+                (priority, next(self.counter), task_hash, task_reduced)
+            )
+        except asyncio.QueueFull:
+            await self.mongo.queries.delete_one({"_id": result.inserted_id})
+            raise Exception("Query queue is full, try again later")
+
+        return task_hash
+
+    def cancel(self, task_hash):
+        """
+            Stop executing query if it is being run by this process
+        :param task_hash:
+        :return:
+        """
+        task = self.running.get(task_hash, None)
+        if task is not None:
+            task.cancel()
+
+    async def worker(self):
+        while True:
+            _, _, task_hash, task_reduced = await self.queue.get()
+            try:
+                # atomically claim the query. it is gone if it was deleted while waiting
+                claimed = await self.mongo.queries.find_one_and_update(
+                    {
+                        "user": task_reduced["user"],
+                        "task_id": task_hash,
+                        "status": "enqueued",
+                    },
+                    {"$set": {"status": "running", "last_modified": utc_now()}},
+                )
+                if claimed is None:
+                    continue
+
+                task = asyncio.ensure_future(
+                    execute_query(self.mongo, task_hash, task_reduced, {}, save=True)
+                )
+                self.running[task_hash] = task
+                # unlike await task, this does not raise if the query gets cancelled
+                await asyncio.wait({task})
+                if task.cancelled():
+                    # no-op if it was cancelled because it got deleted
+                    await self.fail(
+                        {"user": task_reduced["user"], "task_id": task_hash},
+                        "query was cancelled",
+                    )
+                elif task.exception() is not None:
+                    print(f"Query {task_hash} failed: {str(task.exception())}")
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as _e:
+                print(f"Got error: {str(_e)}")
+                _err = traceback.format_exc()
+                print(_err)
+
+            finally:
+                self.running.pop(task_hash, None)
+                self.queue.task_done()
+
+
+async def stream_query(request, task_reduced):
+    """
+        Stream find/aggregate query results back as newline-delimited extended json.
+
+        Documents are written out batch by batch while the cursor is still open,
+        so memory usage stays bounded no matter how many documents match.
+        The last line is a trailer {"$zvm_stream": {"status": ..., "num_documents": ...}}
+        that tells the client whether the query ran to completion.
+    :param request:
+    :param task_reduced:
+    :return:
+    """
+    query = task_reduced
+
+    max_time_ms = (
+        int(query["kwargs"]["max_time_ms"])
+        if "max_time_ms" in query["kwargs"]
+        else int(config["misc"]["max_time_ms"])
+    )
+    assert max_time_ms >= 1, "bad max_time_ms, must be int>=1"
+
+    batch_size = int(
+        query["kwargs"].get("batch_size", config["misc"]["stream_batch_size"])
+    )
+    assert batch_size >= 1, "bad batch_size, must be int>=1"
+
+    cursor = query_cursor(
+        request.app["mongo"], query, max_time_ms, batch_size=batch_size
+    )
+
+    response = web.StreamResponse(
+        status=200, headers={"Content-Type": "application/x-ndjson"}
+    )
+    await response.prepare(request)
+
+    trailer = {"status": "done", "num_documents": 0}
+    try:
+        lines = []
+        async for document in cursor:
+            lines.append(dumps(document))
+            if len(lines) >= batch_size:
+                await response.write(("\n".join(lines) + "\n").encode("utf-8"))
+                trailer["num_documents"] += len(lines)
+                lines = []
+        if len(lines) > 0:
+            await response.write(("\n".join(lines) + "\n").encode("utf-8"))
+            trailer["num_documents"] += len(lines)
+
+    except ConnectionResetError:
+        # client went away, nobody to report to
+        await cursor.close()
+        return response
+
+    except Exception as _e:
+        print(f"Got error: {str(_e)}")
+        _err = traceback.format_exc()
+        print(_err)
+        await cursor.close()
+        trailer["status"] = "failed"
+        trailer["msg"] = _err
+
+    await response.write((dumps({"$zvm_stream": trailer}) + "\n").encode("utf-8"))
+    await response.write_eof()
+
+    return response
+
+
 @routes.put("/query")
 @login_required
 async def query_handler(request):
@@ -1516,7 +2513,13 @@ async def query_handler(request):
         ), f'query_type {_query["query_type"]} not in {str(known_query_types)}'
 
         _query["user"] = user
-        save = False  # query scheduling is disabled as unnecessary for the Variable Marshal (compare to Kowalski)
+
+        # by default, queries are executed right away and not registered in the db.
+        # enqueue_only: register the query and run it in the background, return its id right away
+        # save: register the query and store the task and result on disk
+        kwargs = _query.get("kwargs", dict())
+        enqueue_only = kwargs.get("enqueue_only", False) is True
+        save = enqueue_only or (kwargs.get("save", False) is True)
 
         # tic = time.time()
         task_hash, task_reduced, task_doc = parse_query(_query, save=save)
@@ -1524,6 +2527,46 @@ async def query_handler(request):
         # print(f'parsing task took {toc-tic} seconds')
         # print(task_hash, task_reduced, task_doc)
 
+        if enqueue_only:
+            priority = int(task_reduced["kwargs"].get("priority", 0))
+            await request.app["query_scheduler"].enqueue(
+                task_hash, task_reduced, task_doc, priority=priority
+            )
+
+            return web.json_response(
+                {"message": "success", "query_id": task_hash, "status": "enqueued"},
+                status=200,
+            )
+
+        # saved queries run right away are owned by this process' scheduler, too
+        if save:
+            task_doc["scheduler"] = request.app["query_scheduler"].instance_id
+
+        # stream results back as they come instead of collecting them first?
+        stream = str(task_reduced["kwargs"].get("stream", False)).lower() == "true"
+        if stream and not save:
+            assert task_reduced["query_type"] in (
+                "find",
+                "aggregate",
+            ), "streaming is only supported for find and aggregate queries"
+            return await stream_query(request, task_reduced)
+
+        # identical queries by the same user are served from the result cache
+        # until they expire or the collections they read from get modified
+        cache_key, cache_tags = None, None
+        if not save and task_reduced["kwargs"].get("cache", True) is not False:
+            cache_tags = query_collections(task_reduced)
+        if cache_tags is not None:
+            # snapshot the generations before running the query:
+            # should a write happen meanwhile, the result is cached under a stale key
+            generations = await request.app["cache_generations"].get(cache_tags)
+            cache_key = compute_hash(dumps([task_reduced, generations]))
+            cached = request.app["query_cache"].get(cache_key)
+            if cached is not None:
+                return web.Response(
+                    body=cached, status=200, content_type="application/json"
+                )
+
         # execute query:
         task_hash, result = await execute_query(
             request.app["mongo"], task_hash, task_reduced, task_doc, save
@@ -1531,9 +2574,11 @@ async def query_handler(request):
 
         # print(result)
 
-        return web.json_response(
-            {"message": "success", "result": result}, status=200, dumps=dumps
-        )
+        body = dumps({"message": "success", "result": result}).encode("utf-8")
+        if cache_key is not None and result["status"] == "done":
+            request.app["query_cache"].set(cache_key, body, tags=cache_tags)
+
+        return web.Response(body=body, status=200, content_type="application/json")
 
     except Exception as _e:
         print(f"Got error: {str(_e)}")
@@ -1542,7 +2587,541 @@ async def query_handler(request):
         return web.json_response({"message": f"failure: {_err}"}, status=500)
 
 
-""" Label sources """
+@routes.post("/query")
+@login_required
+async def query_grab_handler(request):
+    """
+        Grab task or result of a saved query by its id
+    :param request:
+    :return:
+    """
+    user = request.get("user", None)
+    # try session if None:
+    if user is None:
+        session = await get_session(request)
+        user = session["user_id"]
+
+    try:
+        _data = await request.json()
+    except Exception as _e:
+        print(f"Cannot extract json() from request, trying post(): {str(_e)}")
+        _data = await request.post()
+
+    try:
+        task_id = str(_data["task_id"])
+        part = _data.get("part", "result")
+
+        query = await request.app["mongo"].queries.find_one(
+            {"user": user, "task_id": {"$eq": task_id}}, {"status": 1}
+        )
+        if query is None:
+            return web.json_response(
+                {"message": f"query {task_id} not found"}, status=404
+            )
+
+        user_tmp_path = os.path.join(config["path"]["path_queries"], user)
+
+        if part == "task":
+            task_file = os.path.join(user_tmp_path, f"{task_id}.task.json")
+            async with aiofiles.open(task_file, "r") as f_task_file:
+                return web.Response(
+                    text=await f_task_file.read(),
+                    status=200,
+                    content_type="application/json",
+                )
+
+        elif part == "result":
+            if query["status"] in ("enqueued", "running"):
+                return web.json_response(
+                    {"message": "query not finished yet", "status": query["status"]},
+                    status=200,
+                )
+
+            task_result_file = os.path.join(user_tmp_path, f"{task_id}.result.json")
+            async with aiofiles.open(task_result_file, "r") as f_task_result_file:
+                return web.Response(
+                    text=await f_task_result_file.read(),
+                    status=200,
+                    content_type="application/json",
+                )
+
+        else:
+            return web.json_response(
+                {"message": f"unknown query part: {part}"}, status=400
+            )
+
+    except Exception as _e:
+        print(f"Got error: {str(_e)}")
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({"message": f"failure: {_err}"}, status=500)
+
+
+@routes.delete("/query")
+@login_required
+async def query_delete_handler(request):
+    """
+        Delete saved query (or all of them with task_id=all) from db and disk
+    :param request:
+    :return:
+    """
+    user = request.get("user", None)
+    # try session if None:
+    if user is None:
+        session = await get_session(request)
+        user = session["user_id"]
+
+    try:
+        _data = await request.json()
+    except Exception as _e:
+        print(f"Cannot extract json() from request, trying post(): {str(_e)}")
+        _data = await request.post()
+
+    try:
+        task_id = str(_data["task_id"])
+        user_tmp_path = pathlib.Path(config["path"]["path_queries"]) / user
+
+        if task_id != "all":
+            await request.app["mongo"].queries.delete_one(
+                {"user": user, "task_id": {"$eq": task_id}}
+            )
+            request.app["query_scheduler"].cancel(task_id)
+
+            # remove files containing task and result
+            for p in user_tmp_path.glob(f"{task_id}*"):
+                p.unlink()
+
+        else:
+            tasks = (
+                await request.app["mongo"]
+                .queries.find({"user": user}, {"task_id": 1})
+                .to_list(length=None)
+            )
+            await request.app["mongo"].queries.delete_many({"user": user})
+            for task in tasks:
+                request.app["query_scheduler"].cancel(task["task_id"])
+
+            if user_tmp_path.exists() and user_tmp_path.is_dir():
+                shutil.rmtree(user_tmp_path)
+
+        return web.json_response({"message": "success"}, status=200)
+
+    except Exception as _e:
+        print(f"Got error: {str(_e)}")
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({"message": f"failure: {_err}"}, status=500)
+
+
+@routes.get("/query/cache")
+@login_required
+async def query_cache_handler(request):
+    """
+        Report query result cache statistics (hits, misses, size)
+    :param request:
+    :return:
+    """
+    return web.json_response(
+        {"message": "success", "result": request.app["query_cache"].stats()},
+        status=200,
+    )
+
+
+""" Label sources """
+
+
+def set_labels_update(user: str, labels: list, time_tag):
+    """
+        Update pipeline replacing the user's labels of a source in one go,
+        leaving other users' labels alone
+    :param user:
+    :param labels: the user's new labels
+    :param time_tag:
+    :return:
+    """
+    return [
+        {
+            "$set": {
+                "labels": {
+                    "$concatArrays": [
+                        {"$literal": labels},
+                        {
+                            "$filter": {
+                                "input": {"$ifNull": ["$labels", []]},
+                                "as": "label",
+                                "cond": {"$ne": ["$$label.user", user]},
+                            }
+                        },
+                    ]
+                },
+                "last_modified": time_tag,
+            }
+        }
+    ]
+
+
+class LabelWriter(object):
+    """
+    Coalesces the set_labels updates coming from the labeling page's autosave.
+
+    Updates are held for up to delay seconds (or until max_batch_size sources are
+    pending), successive updates of the same (user, source) replace each other,
+    and the last one is written with a single atomic update per source
+    (see set_labels_update) in one unordered bulk_write.
+    Batches are written one at a time, in order, so that an older batch
+    cannot overwrite a newer one.
+    Callers wait for the write that covers their update.
+    """
+
+    def __init__(self, mongo, delay: float = 0.25, max_batch_size: int = 1000):
+        self.mongo = mongo
+        self.delay = delay
+        self.max_batch_size = max_batch_size
+        # (user, source_id) -> {"labels": [...], "time_tag": ..., "futures": [...]}
+        self.pending = dict()
+        self.timer = None
+        self.tasks = set()
+        # serializes the bulk writes, asyncio.Lock wakes its waiters in FIFO order
+        self.lock = asyncio.Lock()
+
+    async def set(self, user: str, source_id: str, labels: list, time_tag):
+        """
+            Replace the user's labels of a source
+        :param user:
+        :param source_id:
+        :param labels:
+        :param time_tag:
+        :return:
+        """
+        future = asyncio.get_running_loop().create_future()
+        key = (user, source_id)
+        if key in self.pending:
+            self.pending[key]["labels"] = labels
+            self.pending[key]["time_tag"] = time_tag
+            self.pending[key]["futures"].append(future)
+        else:
+            self.pending[key] = {
+                "labels": labels,
+                "time_tag": time_tag,
+                "futures": [future],
+            }
+
+        if len(self.pending) >= self.max_batch_size:
+            self.flush_soon()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.delay, self.flush_soon
+            )
+
+        return await future
+
+    def flush_soon(self):
+        task = asyncio.ensure_future(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, dict()
+        if len(batch) == 0:
+            return
+
+        keys = list(batch.keys())
+        requests = [
+            pymongo.UpdateOne(
+                {"_id": source_id},
+                set_labels_update(
+                    user,
+                    batch[(user, source_id)]["labels"],
+                    batch[(user, source_id)]["time_tag"],
+                ),
+            )
+            for user, source_id in keys
+        ]
+        errors = dict()
+        async with self.lock:
+            try:
+                await self.mongo.sources.bulk_write(requests, ordered=False)
+            except pymongo.errors.BulkWriteError as bwe:
+                for error in bwe.details.get("writeErrors", []):
+                    errors[keys[error["index"]]] = Exception(error["errmsg"])
+            except Exception as _e:
+                print(f"Got error: {str(_e)}")
+                errors = {key: _e for key in keys}
+
+        for key in keys:
+            for future in batch[key]["futures"]:
+                if future.done():
+                    continue
+                if key in errors:
+                    future.set_exception(errors[key])
+                else:
+                    future.set_result(None)
+
+    async def stop(self):
+        await self.flush()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+def label_page_pipeline(q: dict, user: str, sort: dict = None, limit: int = None):
+    """
+        Aggregation pipeline fetching the sources matching q for template-label.html:
+        only the fields it renders and only the user's own labels
+    :param q: filter
+    :param user:
+    :param sort:
+    :param limit:
+    :return:
+    """
+    pipeline = [{"$match": q}]
+    if sort is not None:
+        pipeline.append({"$sort": sort})
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    pipeline.extend(
+        [
+            {
+                "$project": {
+                    "ra": 1,
+                    "dec": 1,
+                    "l": 1,
+                    "b": 1,
+                    "p": 1,
+                    "xmatch": 1,
+                    "labels": {
+                        "$filter": {
+                            "input": {"$ifNull": ["$labels", []]},
+                            "as": "label",
+                            "cond": {"$eq": ["$$label.user", user]},
+                        }
+                    },
+                }
+            },
+            # alerts are not shown and can be many
+            {"$project": {"xmatch.ZTF_alerts": 0}},
+        ]
+    )
+    return pipeline
+
+
+class LabelingQueues(object):
+    """
+    Shuffled queues of the ids of the sources a user has not labeled yet,
+    one per (user, program, filter), for the random labeling mode.
+
+    The queues live in the labeling_queues collection, one document per queued
+    source with a random rank, so they are shared by all server processes and
+    survive restarts. A queue is built in the background, by one process at a time
+    (see labeling_queue_builds), from a random sample of at most max_size unlabeled
+    sources of the program; page loads never wait on it.
+    Batches are handed out by atomically marking the lowest ranked ids handed out.
+    Ids that have been handed out or labeled (see remove) stay marked when the queue
+    is rebuilt, so that a rebuild does not put them back.
+    A queue is rebuilt when it runs low or gets older than ttl, so sources saved
+    in the meantime show up eventually. Queue documents expire expire_after seconds
+    after they were last touched.
+    """
+
+    def __init__(
+        self,
+        mongo,
+        max_size: int = 100000,
+        refill_threshold: int = 500,
+        ttl: float = 3600,
+        expire_after: float = 86400,
+        build_timeout: float = 600,
+    ):
+        self.mongo = mongo
+        self.max_size = max_size
+        self.refill_threshold = refill_threshold
+        self.ttl = ttl
+        self.expire_after = expire_after
+        self.build_timeout = build_timeout
+        # key -> build task run by this process
+        self.building = dict()
+
+    @staticmethod
+    def key(user: str, zvm_program_id: int, filt: dict):
+        return compute_hash(dumps([user, zvm_program_id, filt], sort_keys=True))
+
+    async def build(self, key, user: str, zvm_program_id: int, filt: dict):
+        now = utc_now()
+        expires = now + datetime.timedelta(seconds=self.expire_after)
+        try:
+            # claim the build, unless another process is at it
+            await self.mongo.labeling_queue_builds.update_one(
+                {"_id": key, "building_until": {"$lt": now}},
+                {
+                    "$set": {
+                        "user": user,
+                        "building_until": now
+                        + datetime.timedelta(seconds=self.build_timeout),
+                        "expires": expires,
+                    }
+                },
+                upsert=True,
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return
+
+        try:
+            q = {
+                "zvm_program_id": zvm_program_id,
+                **filt,
+                "labels.user": {"$ne": user},
+            }
+            # labels.user is multikey and $ne does not bound the index scan on it,
+            # so this reads all of the program's sources; $sample only keeps max_size
+            pipeline = [
+                {"$match": q},
+                {"$project": {"_id": 1}},
+                {"$sample": {"size": self.max_size}},
+            ]
+            requests = []
+            async for source in self.mongo.sources.aggregate(
+                pipeline,
+                allowDiskUse=True,
+                maxTimeMS=int(self.build_timeout * 1000),
+            ):
+                # ids already in the queue keep their rank and handed_out flag
+                requests.append(
+                    pymongo.UpdateOne(
+                        {"key": key, "source_id": source["_id"]},
+                        {
+                            "$setOnInsert": {
+                                "user": user,
+                                "rank": random.random(),
+                                "handed_out": False,
+                            },
+                            "$set": {"expires": expires},
+                        },
+                        upsert=True,
+                    )
+                )
+                if len(requests) >= 1000:
+                    await self.mongo.labeling_queues.bulk_write(requests, ordered=False)
+                    requests = []
+            if len(requests) > 0:
+                await self.mongo.labeling_queues.bulk_write(requests, ordered=False)
+
+            await self.mongo.labeling_queue_builds.update_one(
+                {"_id": key}, {"$set": {"built": time.time()}}
+            )
+        finally:
+            # let the next rebuild go ahead
+            await self.mongo.labeling_queue_builds.update_one(
+                {"_id": key}, {"$set": {"building_until": utc_now()}}
+            )
+
+    def refill(self, key, user: str, zvm_program_id: int, filt: dict):
+        if key in self.building:
+            return
+
+        async def build():
+            try:
+                await self.build(key, user, zvm_program_id, filt)
+            except Exception as _e:
+                print(f"Failed to build labeling queue: {str(_e)}")
+                _err = traceback.format_exc()
+                print(_err)
+            finally:
+                self.building.pop(key, None)
+
+        self.building[key] = asyncio.ensure_future(build())
+
+    async def pop(self, key, number: int):
+        """
+            Atomically mark the next number ids of the queue handed out
+        :param key:
+        :param number:
+        :return: source ids, lowest rank first
+        """
+        claim = random_alphanumeric_str(length=24)
+        expires = utc_now() + datetime.timedelta(seconds=self.expire_after)
+        candidate_ids = []
+        num_claimed = 0
+        # other processes might take some of the candidates first, try again for those
+        for _ in range(3):
+            candidates = (
+                await self.mongo.labeling_queues.find(
+                    {"key": key, "handed_out": False}, {"_id": 1}
+                )
+                .sort("rank", 1)
+                .limit(number - num_claimed)
+                .to_list(length=None)
+            )
+            if len(candidates) == 0:
+                break
+            candidate_ids.extend(candidate["_id"] for candidate in candidates)
+            result = await self.mongo.labeling_queues.update_many(
+                {
+                    "_id": {"$in": [candidate["_id"] for candidate in candidates]},
+                    "handed_out": False,
+                },
+                {"$set": {"handed_out": True, "claim": claim, "expires": expires}},
+            )
+            num_claimed += result.modified_count
+            if num_claimed >= number:
+                break
+
+        claimed = (
+            await self.mongo.labeling_queues.find(
+                {"_id": {"$in": candidate_ids}, "claim": claim},
+                {"source_id": 1},
+            )
+            .sort("rank", 1)
+            .to_list(length=None)
+        )
+        return [doc["source_id"] for doc in claimed]
+
+    async def next(self, user: str, zvm_program_id: int, filt: dict, number: int):
+        """
+            Hand out the next number ids of the unlabeled sources matching filt
+        :param user:
+        :param zvm_program_id:
+        :param filt: extra filter on top of the program
+        :param number:
+        :return: source ids or None if the queue is still being built
+        """
+        key = self.key(user, zvm_program_id, filt)
+        build = await self.mongo.labeling_queue_builds.find_one(
+            {"_id": key}, {"built": 1}
+        )
+        if build is None or "built" not in build:
+            # do not hold up the page on the scan of the program
+            self.refill(key, user, zvm_program_id, filt)
+            return None
+
+        batch = await self.pop(key, number)
+
+        threshold = max(self.refill_threshold, number)
+        num_left = await self.mongo.labeling_queues.count_documents(
+            {"key": key, "handed_out": False}, limit=threshold
+        )
+        if num_left < threshold or time.time() - build["built"] > self.ttl:
+            self.refill(key, user, zvm_program_id, filt)
+
+        return batch
+
+    async def remove(self, user: str, source_id: str):
+        """
+            Mark a source the user has just labeled handed out in their queues
+        :param user:
+        :param source_id:
+        :return:
+        """
+        await self.mongo.labeling_queues.update_many(
+            {"user": user, "source_id": source_id, "handed_out": False},
+            {"$set": {"handed_out": True}},
+        )
+
+    async def stop(self):
+        tasks = list(self.building.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 @routes.get("/label")
@@ -1558,17 +3137,8 @@ async def label_get_handler(request):
     user = session["user_id"]
 
     try:
-        users = (
-            await request.app["mongo"].users.find({}, {"_id": 1}).to_list(length=None)
-        )
-        users = sorted([uu["_id"] for uu in users])
-
-        programs = (
-            await request.app["mongo"]
-            .programs.find({}, {"_id": 1})
-            .to_list(length=None)
-        )
-        programs = sorted([pp["_id"] for pp in programs])
+        users = await request.app["users_programs"].users()
+        programs = await request.app["users_programs"].program_ids()
 
         classes = config["classifications"]
 
@@ -1592,7 +3162,10 @@ async def label_get_handler(request):
         unlabeled = _r.get("unlabeled", False)
 
         sources = []
+        messages = []
         if zvm_program_id and number:
+            # user's filter on top of the program, for the labeling queues
+            _filt = filt
             filt = {"zvm_program_id": int(zvm_program_id), **filt}
 
             if unlabeled:
@@ -1604,16 +3177,46 @@ async def label_get_handler(request):
             if not rand:
                 # '$or': [{'labels.user': {'$exists': False}},
                 #         {'labels.user': user}]
-                sources = (
-                    await request.app["mongo"]
-                    .sources.find(
-                        filt, {"xmatch.ZTF_alerts": 0, "history": 0, "spec.data": 0}
+                sources = await (
+                    request.app["mongo"]
+                    .sources.aggregate(
+                        label_page_pipeline(
+                            filt, user, sort={"created": -1}, limit=int(number)
+                        ),
+                        allowDiskUse=True,
+                        maxTimeMS=30000,
+                    )
+                    .to_list(length=None)
+                )
+            elif unlabeled:
+                # hand out the next batch off the user's queue for this program/filter
+                source_ids = await request.app["labeling_queues"].next(
+                    user, int(zvm_program_id), _filt, int(number)
+                )
+                if source_ids is None:
+                    messages.append(
+                        [
+                            "Shuffling the unlabeled sources of the program, "
+                            "reload the page in a minute",
+                            "info",
+                        ]
+                    )
+                    source_ids = []
+                order = {source_id: ii for ii, source_id in enumerate(source_ids)}
+                sources = await (
+                    request.app["mongo"]
+                    .sources.aggregate(
+                        label_page_pipeline({"_id": {"$in": source_ids}}, user),
+                        allowDiskUse=True,
+                        maxTimeMS=30000,
                     )
-                    .limit(int(number))
-                    .sort([("created", -1)])
                     .to_list(length=None)
                 )
-                # print(sources)
+                # labeled elsewhere (e.g. on the source page) since they were queued
+                sources = sorted(
+                    (source for source in sources if len(source["labels"]) == 0),
+                    key=lambda source: order[source["_id"]],
+                )
             else:
                 # fixme: slow on large number of matches. create indices to speed up!
                 pipeline = [
@@ -1628,29 +3231,14 @@ async def label_get_handler(request):
                 source_ids = await _select.to_list(length=None)
                 source_ids = [sid["_id"] for sid in source_ids]
 
-                pipeline = [
-                    {"$match": {"_id": {"$in": source_ids}}},
-                    {
-                        "$project": {
-                            "xmatch.ZTF_alerts": 0,
-                            "history": 0,
-                            "spec.data": 0,
-                        }
-                    },
-                ]
                 _select = request.app["mongo"].sources.aggregate(
-                    pipeline, allowDiskUse=True, maxTimeMS=30000
+                    label_page_pipeline({"_id": {"$in": source_ids}}, user),
+                    allowDiskUse=True,
+                    maxTimeMS=30000,
                 )
 
                 sources = await _select.to_list(length=None)
 
-        # fixme: pop other people's labels. should Do this on mongodb's side
-        for source in sources:
-            labels = [
-                lab for lab in source.get("labels", ()) if lab.get("user", None) == user
-            ]
-            source["labels"] = labels
-
         context = {
             "logo": config["server"]["logo"],
             "user": session["user_id"],
@@ -1659,7 +3247,7 @@ async def label_get_handler(request):
             "classes": classes,
             "descriptions": descriptions,
             "data": sources,
-            "messages": [],
+            "messages": messages,
         }
 
         response = aiohttp_jinja2.render_template(
@@ -1726,49 +3314,162 @@ async def label_get_handler(request):
 """ sources API """
 
 
+def encode_page_token(source) -> str:
+    """
+        Encode the keyset (created, _id) of the last source on a page
+    :param source:
+    :return:
+    """
+    return base64.urlsafe_b64encode(
+        dumps({"created": source["created"], "_id": source["_id"]}).encode("utf-8")
+    ).decode("utf-8")
+
+
+def decode_page_token(page_token: str) -> dict:
+    """
+        Decode a page token into a filter selecting the sources that come after it
+    :param page_token:
+    :return:
+    """
+    token = loads(base64.urlsafe_b64decode(page_token.encode("utf-8")).decode("utf-8"))
+    return {
+        "$or": [
+            {"created": {"$lt": token["created"]}},
+            {"created": token["created"], "_id": {"$lt": token["_id"]}},
+        ]
+    }
+
+
+async def sources_page(
+    mongo, q, projection, page_size: int, page_token=None, keep=None
+):
+    """
+        Fetch a page of saved sources matching q, latest first,
+        using keyset pagination on (created, _id)
+
+    :param mongo:
+    :param q: filter
+    :param projection:
+    :param page_size:
+    :param page_token: token of the previous page, None for the first one
+    :param keep: optional function selecting the sources to keep from a fetched batch
+    :return: sources, token for the next page or None if this is the last one
+    """
+    sources = []
+    more = True
+    while more and len(sources) <= page_size:
+        _q = q if page_token is None else {"$and": [q, decode_page_token(page_token)]}
+        # fetch one extra source to tell if there is a next page
+        batch = (
+            await mongo.sources.find(_q, projection)
+            .sort([("created", -1), ("_id", -1)])
+            .limit(page_size + 1)
+            .to_list(length=None)
+        )
+        more = len(batch) > page_size
+        if len(batch) > 0:
+            page_token = encode_page_token(batch[-1])
+        sources.extend(keep(batch) if keep is not None else batch)
+
+    if len(sources) > page_size:
+        sources = sources[:page_size]
+        return sources, encode_page_token(sources[-1])
+
+    return sources, None
+
+
+async def count_sources(mongo, q, exact: bool = False, keep=None):
+    """
+        Count saved sources matching q. Unless exact, this is a cheap estimate:
+        collection metadata if q is empty, otherwise a count capped at misc.sources_page.count_limit
+
+    :param mongo:
+    :param q: filter
+    :param exact:
+    :param keep: optional function selecting the sources to keep, see sources_page
+    :return: count, whether the count is exact
+    """
+    if exact:
+        if keep is not None:
+            sources = await mongo.sources.find(
+                q, {"coordinates.radec_geojson": 1, "coordinates.healpix": 1}
+            ).to_list(length=None)
+            return len(keep(sources)), True
+        count = await mongo.sources.count_documents(
+            q, maxTimeMS=config["misc"]["sources_page"]["count_max_time_ms"]
+        )
+        return count, True
+
+    if len(q) == 0:
+        return await mongo.sources.estimated_document_count(), False
+
+    count_limit = config["misc"]["sources_page"]["count_limit"]
+    count = await mongo.sources.count_documents(q, limit=count_limit)
+
+    return count, (count < count_limit) and (keep is None)
+
+
+def get_page_size(_query) -> int:
+    """
+        Requested page size, capped at misc.sources_page.max_page_size
+    :param _query:
+    :return:
+    """
+    page_size = int(
+        _query.get("page_size", None) or config["misc"]["sources_page"]["page_size"]
+    )
+    return max(min(page_size, config["misc"]["sources_page"]["max_page_size"]), 1)
+
+
 @routes.get("/sources")
 @login_required
 async def sources_get_handler(request):
     """
-        Serve saved sources page for the browser
+        Serve saved sources page for the browser or sources json if ?format=json,
+        a page at a time. ?count=exact returns the exact number of saved sources only
     :param request:
     :return:
     """
     # get session:
     session = await get_session(request)
 
+    frmt = request.query.get("format", "web")
+
     try:
 
         # todo: display light curves? for now, omit the actual data
 
-        # get last 50 added sources
-        # sources = await request.app['mongo'].sources.find({},
-        #                                                   {'_id': 1,
-        #                                                    'ra': 1,
-        #                                                    'dec': 1,
-        #                                                    'p': 1,
-        #                                                    'source_type': 1,
-        #                                                    'created': 1}).limit(10).sort({'created': -1}).to_list(
-        #     length=None)
-        sources = (
-            await request.app["mongo"]
-            .sources.find({}, {"coordinates": 0, "spec.data": 0, "lc.data": 0})
-            .limit(50)
-            .sort([("created", -1)])
-            .to_list(length=None)
-        )
+        if request.query.get("count", None) == "exact":
+            count, _ = await count_sources(request.app["mongo"], {}, exact=True)
+            return web.json_response({"message": "success", "count": count}, status=200)
 
-        users = (
-            await request.app["mongo"].users.find({}, {"_id": 1}).to_list(length=None)
-        )
-        users = sorted([uu["_id"] for uu in users])
+        page_size = get_page_size(request.query)
 
-        programs = (
-            await request.app["mongo"]
-            .programs.find({}, {"_id": 1})
-            .to_list(length=None)
+        # get latest added sources
+        sources, next_page_token = await sources_page(
+            request.app["mongo"],
+            {},
+            {"coordinates": 0, "spec.data": 0, "lc.data": 0},
+            page_size=page_size,
+            page_token=request.query.get("page_token", None),
         )
-        programs = sorted([pp["_id"] for pp in programs])
+        count, count_exact = await count_sources(request.app["mongo"], {})
+
+        if frmt == "json":
+            return web.json_response(
+                {
+                    "message": "success",
+                    "data": sources,
+                    "next_page_token": next_page_token,
+                    "count": count,
+                    "count_exact": count_exact,
+                },
+                status=200,
+                dumps=dumps,
+            )
+
+        users = await request.app["users_programs"].users()
+        programs = await request.app["users_programs"].program_ids()
 
         context = {
             "logo": config["server"]["logo"],
@@ -1776,6 +3477,10 @@ async def sources_get_handler(request):
             "users": users,
             "programs": programs,
             "data": sources,
+            "page_size": page_size,
+            "next_page_token": next_page_token,
+            "count": count,
+            "count_exact": count_exact,
             "messages": [["Displaying latest saved sources", "info"]],
         }
 
@@ -1787,6 +3492,9 @@ async def sources_get_handler(request):
     except Exception as _e:
         print(f"Error: {str(_e)}")
 
+        if frmt == "json":
+            return web.json_response({"message": f"failure: {str(_e)}"}, status=500)
+
         context = {
             "logo": config["server"]["logo"],
             "user": session["user_id"],
@@ -1811,7 +3519,8 @@ async def sources_get_handler(request):
 @login_required
 async def sources_post_handler(request):
     """
-        Process query to own db from browser
+        Process query to own db from browser, a page at a time.
+        Returns sources json if format is json; count=exact returns the exact number of matches only
     :param request:
     :return:
     """
@@ -1827,9 +3536,19 @@ async def sources_post_handler(request):
         _query = await request.post()
     # print(_query)
 
+    frmt = _query.get("format", "web")
+    # pagination is not part of the form to repopulate
+    form = {
+        kk: vv
+        for kk, vv in _query.items()
+        if kk not in ("page_token", "format", "count")
+    }
+
     try:
         # parse query
         q = dict()
+        # (ra, dec, pixels) of the positions to match if going via the HEALPix index
+        bulk_cross_match = None
 
         # filter set?
         if len(_query["filter"]) > 2:
@@ -1891,38 +3610,108 @@ async def sources_post_handler(request):
             # print(object_names, object_coordinates)
 
             object_position_query = dict()
-            object_position_query["$or"] = []
 
-            for oi, obj_crd in enumerate(object_coordinates):
+            # lots of positions? select candidates by HEALPix pixel and do the exact matching here
+            nside = config["misc"]["healpix"]["nside"]
+            bulk = (
+                len(object_coordinates)
+                >= config["misc"]["healpix"]["bulk_min_positions"]
+            )
+            if bulk and await healpix_backfilled(request.app["mongo"], nside):
                 # convert ra/dec into GeoJSON-friendly format
-                # print(obj_crd)
-                _ra, _dec = radec_str2geojson(*obj_crd)
-                # print(str(obj_crd), _ra, _dec)
+                _ra, _dec = np.array(
+                    [radec_str2geojson(*obj_crd) for obj_crd in object_coordinates]
+                ).T
+                position_pixels = healpix_cone_pixels(
+                    _ra + 180.0, _dec, cone_search_radius, nside
+                )
+                bulk_cross_match = (_ra + 180.0, _dec, position_pixels)
 
-                object_position_query["$or"].append(
-                    {
-                        "coordinates.radec_geojson": {
-                            "$geoWithin": {
-                                "$centerSphere": [[_ra, _dec], cone_search_radius]
+                object_position_query["coordinates.healpix_nside"] = nside
+                object_position_query["coordinates.healpix"] = {
+                    "$in": np.unique(np.concatenate(position_pixels)).tolist()
+                }
+
+            else:
+                object_position_query["$or"] = []
+
+                for oi, obj_crd in enumerate(object_coordinates):
+                    # convert ra/dec into GeoJSON-friendly format
+                    # print(obj_crd)
+                    _ra, _dec = radec_str2geojson(*obj_crd)
+                    # print(str(obj_crd), _ra, _dec)
+
+                    object_position_query["$or"].append(
+                        {
+                            "coordinates.radec_geojson": {
+                                "$geoWithin": {
+                                    "$centerSphere": [[_ra, _dec], cone_search_radius]
+                                }
                             }
                         }
-                    }
-                )
+                    )
 
             q = {**q, **object_position_query}
             q = {"$and": [q]}
 
-        users = (
-            await request.app["mongo"].users.find({}, {"_id": 1}).to_list(length=None)
-        )
-        users = sorted([uu["_id"] for uu in users])
+        # exact cross-match of the candidates selected by HEALPix pixel
+        def cross_match(sources):
+            if len(sources) == 0:
+                return sources
+            match_lon, match_dec = np.array(
+                [ss["coordinates"]["radec_geojson"]["coordinates"] for ss in sources]
+            ).T
+            matches = healpix_cross_match(
+                *bulk_cross_match,
+                cone_search_radius,
+                match_lon + 180.0,
+                match_dec,
+                [ss["coordinates"]["healpix"] for ss in sources],
+            )
+            matched = np.unique(np.concatenate(matches))
+            # keep the sort order
+            return [sources[ii] for ii in matched]
 
-        programs = (
-            await request.app["mongo"]
-            .programs.find({}, {"_id": 1})
-            .to_list(length=None)
-        )
-        programs = sorted([pp["_id"] for pp in programs])
+        keep = cross_match if bulk_cross_match is not None else None
+
+        if len(q) > 0 and _query.get("count", None) == "exact":
+            count, _ = await count_sources(
+                request.app["mongo"], q, exact=True, keep=keep
+            )
+            return web.json_response({"message": "success", "count": count}, status=200)
+
+        page_size = get_page_size(_query)
+
+        if len(q) > 0:
+            sources, next_page_token = await sources_page(
+                request.app["mongo"],
+                q,
+                {"coordinates.radec_str": 0, "spec.data": 0, "lc.data": 0},
+                page_size=page_size,
+                page_token=_query.get("page_token", None) or None,
+                keep=keep,
+            )
+            count, count_exact = await count_sources(request.app["mongo"], q, keep=keep)
+
+        if frmt == "json":
+            if len(q) == 0:
+                return web.json_response(
+                    {"message": "failure: empty query"}, status=400
+                )
+            return web.json_response(
+                {
+                    "message": "success",
+                    "data": sources,
+                    "next_page_token": next_page_token,
+                    "count": count,
+                    "count_exact": count_exact,
+                },
+                status=200,
+                dumps=dumps,
+            )
+
+        users = await request.app["users_programs"].users()
+        programs = await request.app["users_programs"].program_ids()
 
         # print(q)
         if len(q) == 0:
@@ -1932,28 +3721,23 @@ async def sources_post_handler(request):
                 "data": [],
                 "users": users,
                 "programs": programs,
-                "form": _query,
+                "form": form,
                 "messages": [["Empty query", "danger"]],
             }
 
         else:
 
-            sources = (
-                await request.app["mongo"]
-                .sources.find(
-                    q, {"coordinates.radec_str": 0, "spec.data": 0, "lc.data": 0}
-                )
-                .sort([("created", -1)])
-                .to_list(length=None)
-            )
-
             context = {
                 "logo": config["server"]["logo"],
                 "user": session["user_id"],
                 "data": sources,
                 "users": users,
                 "programs": programs,
-                "form": _query,
+                "form": form,
+                "page_size": page_size,
+                "next_page_token": next_page_token,
+                "count": count,
+                "count_exact": count_exact,
             }
 
             if len(sources) == 0:
@@ -1968,17 +3752,11 @@ async def sources_post_handler(request):
 
         print(f"Error: {str(_e)}")
 
-        users = (
-            await request.app["mongo"].users.find({}, {"_id": 1}).to_list(length=None)
-        )
-        users = sorted([uu["_id"] for uu in users])
+        if frmt == "json":
+            return web.json_response({"message": f"failure: {str(_e)}"}, status=500)
 
-        programs = (
-            await request.app["mongo"]
-            .programs.find({}, {"_id": 1})
-            .to_list(length=None)
-        )
-        programs = sorted([pp["_id"] for pp in programs])
+        users = await request.app["users_programs"].users()
+        programs = await request.app["users_programs"].program_ids()
 
         context = {
             "logo": config["server"]["logo"],
@@ -1986,7 +3764,7 @@ async def sources_post_handler(request):
             "data": [],
             "users": users,
             "programs": programs,
-            "form": _query,
+            "form": form,
             "messages": [[f"Error: {str(_e)}", "danger"]],
         }
 
@@ -2018,51 +3796,17 @@ async def source_get_handler(request):
     # print(frmt)
 
     if frmt == "json":
+        source["lc"] = [lc_records(lc) for lc in source["lc"]]
         return web.json_response(source, status=200, dumps=dumps)
 
     # for the web, reformat/compute data fields:
     # light curves
     bad_lc = []
     lc_color_indexes = dict()
+    t_utc = datetime.datetime.utcnow()
     for ilc, lc in enumerate(source["lc"]):
         try:
             if lc["lc_type"] == "temporal":
-                # convert to pandas dataframe and replace nans with zeros:
-                df = pd.DataFrame(lc["data"]).fillna(0)
-
-                # fixme?
-                if "mjd" not in df:
-                    df["mjd"] = df["hjd"] - 2400000.5
-                if "hjd" not in df:
-                    df["hjd"] = df["mjd"] + 2400000.5
-
-                if "datetime" not in df:
-                    df["datetime"] = df["mjd"].apply(lambda x: mjd_to_datetime(x))
-                # strings for plotly:
-                if "dt" not in df:
-                    df["dt"] = df["datetime"].apply(
-                        lambda x: x.strftime("%Y-%m-%d %H:%M:%S")
-                    )
-
-                df.sort_values(by=["mjd"], inplace=True)
-
-                if "jd" not in df:
-                    df["jd"] = df["mjd"] + 2400000.5
-
-                # fractional days ago
-                t_utc = datetime.datetime.utcnow()
-                df["days_ago"] = df["datetime"].apply(
-                    lambda x: (t_utc - x).total_seconds() / 86400.0
-                )
-
-                # print(df['programid'])
-
-                # convert back to dict:
-                lc["data"] = df.to_dict("records")
-
-                # for field in ('mag', 'magerr', 'mag_llim', 'mag_ulim', 'mjd', 'hjd', 'jd', 'dt', 'days_ago'):
-                #     lc[field] = df[field].values.tolist() if field in df else []
-
                 # pre-process for plotly:
                 # display color:
                 lc_color_indexes[lc["filter"]] = (
@@ -2072,52 +3816,23 @@ async def source_get_handler(request):
                 )
                 lc["color"] = lc_colors(lc["filter"], lc_color_indexes[lc["filter"]])
 
-                lc__ = {
-                    "lc_det": {
-                        "dt": [],
-                        "days_ago": [],
-                        "jd": [],
-                        "mjd": [],
-                        "hjd": [],
-                        "mag": [],
-                        "magerr": [],
-                    },
-                    "lc_nodet_u": {
-                        "dt": [],
-                        "days_ago": [],
-                        "jd": [],
-                        "mjd": [],
-                        "hjd": [],
-                        "mag_ulim": [],
-                    },
-                    "lc_nodet_l": {
-                        "dt": [],
-                        "days_ago": [],
-                        "jd": [],
-                        "mjd": [],
-                        "hjd": [],
-                        "mag_llim": [],
-                    },
-                }
-                for dp in lc["data"]:
-                    if ("mag_ulim" in dp) and (dp["mag_ulim"] > 0.01):
-                        for kk in ("dt", "days_ago", "jd", "mjd", "hjd", "mag_ulim"):
-                            lc__["lc_nodet_u"][kk].append(dp[kk])
-                    if ("mag_llim" in dp) and (dp["mag_llim"] > 0.01):
-                        for kk in ("dt", "days_ago", "jd", "mjd", "hjd", "mag_llim"):
-                            lc__["lc_nodet_l"][kk].append(dp[kk])
-                    if ("mag" in dp) and (dp["mag"] > 0.01):
-                        for kk in (
-                            "dt",
-                            "days_ago",
-                            "jd",
+                # split into detections and upper/lower limits
+                lc["data"] = preprocess_lc(
+                    lc_columns(
+                        lc,
+                        fields=(
                             "mjd",
                             "hjd",
+                            "jd",
+                            "dt",
                             "mag",
                             "magerr",
-                        ):
-                            lc__["lc_det"][kk].append(dp[kk])
-                lc["data"] = lc__
+                            "mag_ulim",
+                            "mag_llim",
+                        ),
+                    ),
+                    t_utc=t_utc,
+                )
 
         except Exception as e:
             print(str(e))
@@ -2161,19 +3876,17 @@ async def source_get_handler(request):
     source_flags = config["misc"]["source_flags"]
 
     # get ZVM programs:
-    programs = (
-        await request.app["mongo"]
-        .programs.find({}, {"last_modified": 0})
-        .to_list(length=None)
+    programs = await request.app["users_programs"].programs()
+
+    # the page is not held up by a slow Fritz for longer than page_timeout
+    fritz_sources = await request.app["fritz"].sources(
+        source["ra"],
+        source["dec"],
+        radius=3 / 3600,
+        timeout=request.app["fritz"].page_timeout,
+        hasSpectrum="true",
     )
-
-    data = api(
-        f"sources?ra={source['ra']}&dec={source['dec']}&radius={3/3600}&hasSpectrum=true"
-    )
-    if data is not None and len(data.get("sources", [])) > 0:
-        source["fritz_sources"] = [d["id"] for d in data["sources"]]
-    else:
-        source["fritz_sources"] = []
+    source["fritz_sources"] = [d["id"] for d in fritz_sources]
 
     context = {
         "logo": config["server"]["logo"],
@@ -2189,6 +3902,149 @@ async def source_get_handler(request):
     return response
 
 
+class PS1Client(object):
+    """
+    Async PS1 RGB cutout client with a shared connection pool and an on-disk cache
+    (PlotCache) keyed by (ra, dec, size, color). Concurrent requests for the same
+    cutout share one download.
+
+    Prefetches (e.g. of a bulk save's sources) go through a bounded queue served by
+    prefetch_workers tasks on a connection pool of their own, so that they do not
+    hold up the interactive requests; they are dropped when the queue is full.
+    Their timeout applies to connecting and to each read, not to the wait for
+    a free connection.
+
+    base_url points at the PS1 image server cgi-bin, or at a stand-in for tests.
+    """
+
+    def __init__(
+        self,
+        cache,
+        base_url: str = PANSTARRS_SOURCE,
+        timeout: float = 10,
+        max_connections: int = 16,
+        size: int = 240,
+        color=("y", "g", "i"),
+        prefetch_workers: int = 4,
+        prefetch_queue_size: int = 1000,
+    ):
+        self.cache = cache
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.size = size
+        self.color = tuple(color)
+        self.session = None
+        # key -> future of the download in progress
+        self.in_flight = dict()
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_queue = asyncio.Queue(maxsize=prefetch_queue_size)
+        self.prefetch_session = None
+        self.workers = []
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        self.prefetch_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.prefetch_workers),
+            timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=self.timeout, sock_read=self.timeout
+            ),
+        )
+        self.workers = [
+            asyncio.ensure_future(self.prefetch_worker())
+            for _ in range(self.prefetch_workers)
+        ]
+
+    async def stop(self):
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for session in (self.session, self.prefetch_session):
+            if session is not None:
+                await session.close()
+
+    @staticmethod
+    def key(ra, dec, size, color):
+        return compute_hash(
+            json.dumps([round(float(ra), 6), round(float(dec), 6), size, list(color)])
+        )
+
+    async def stamp_url(self, session, ra, dec, size, color):
+        async with session.get(
+            build_panstarrs_link(ra, dec, source=self.base_url)
+        ) as resp:
+            resp.raise_for_status()
+            red, blue, green = parse_ps_filenames(await resp.text(), color=color)
+        return build_rgb_ps_stamp_url(
+            red, blue, green, ra, dec, size=size, source=self.base_url
+        )
+
+    async def download(self, session, key, ra, dec, size, color):
+        url = await self.stamp_url(session, ra, dec, size, color)
+        async with session.get(url) as resp:
+            resp.raise_for_status()
+            data = await resp.read()
+        if len(data) > 0:
+            await self.cache.set(key, data)
+        return data
+
+    async def cutout(self, ra, dec, size: int = None, color=None, session=None):
+        """
+            RGB PNG cutout centered on (ra, dec), from the cache if possible
+        :param ra: [deg]
+        :param dec: [deg]
+        :param size: [px]
+        :param color: PS1 filters to use for R, G, B
+        :param session: to download with, the interactive one by default
+        :return: PNG bytes
+        """
+        size = self.size if size is None else int(size)
+        color = self.color if color is None else tuple(color)
+        key = self.key(ra, dec, size, color)
+
+        data = await self.cache.get(key)
+        if data is not None:
+            return data
+
+        if key not in self.in_flight:
+            self.in_flight[key] = asyncio.ensure_future(
+                self.download(session or self.session, key, ra, dec, size, color)
+            )
+            self.in_flight[key].add_done_callback(
+                lambda _: self.in_flight.pop(key, None)
+            )
+        return await asyncio.shield(self.in_flight[key])
+
+    def prefetch(self, ra, dec):
+        """
+            Download cutout in the background, unless too many are waiting already
+        :param ra: [deg]
+        :param dec: [deg]
+        :return:
+        """
+        try:
+            self.prefetch_queue.put_nowait((ra, dec))
+        except asyncio.QueueFull:
+            # it will be downloaded when first requested
+            pass
+
+    async def prefetch_worker(self):
+        while True:
+            ra, dec = await self.prefetch_queue.get()
+            try:
+                await self.cutout(ra, dec, session=self.prefetch_session)
+            except asyncio.CancelledError:
+                raise
+            except Exception as _e:
+                print(f"Failed to prefetch PS1 cutout: {str(_e)}")
+            finally:
+                self.prefetch_queue.task_done()
+
+
 @routes.get("/sources/{source_id}/images/ps1")
 @login_required
 async def source_cutout_get_handler(request):
@@ -2197,9 +4053,6 @@ async def source_cutout_get_handler(request):
     :param request:
     :return:
     """
-    # get session:
-    session = await get_session(request)
-
     _id = request.match_info["source_id"]
 
     source = (
@@ -2210,130 +4063,425 @@ async def source_cutout_get_handler(request):
     source = loads(dumps(source[0]))
 
     try:
-        ps1_url = get_rgb_ps_stamp_url(source["ra"], source["dec"], timeout=1.5)
-        # print(ps1_url)
-        async with aiohttp.ClientSession() as session:
-            async with session.get(ps1_url) as resp:
-                if resp.status == 200:
-                    buff = io.BytesIO()
-                    buff.write(await resp.read())
-                    buff.seek(0)
-                    return web.Response(body=buff, content_type="image/png")
+        png = await request.app["ps1"].cutout(source["ra"], source["dec"])
+        return web.Response(body=png, content_type="image/png")
     except Exception as e:
         print(e)
 
-    return web.Response(body=io.BytesIO(), content_type="image/png")
+    return web.Response(body=b"", content_type="image/png")
 
 
-@routes.get("/sources/{source_id}/images/hr")
-@login_required
-async def source_hr_get_handler(request):
+class ProcessPool(object):
     """
-        Serve HR diagram for a source
-    :param request:
-    :return:
+    Runs CPU-heavy pure functions (plots.py, periodograms.py) on a process pool
+    so that they do not block the event loop. At most num_workers + max_queue_size
+    calls may be pending, further ones are rejected; each is bounded by timeout seconds.
+    A call that times out keeps its slot until the worker is actually done with it.
+
+    Every server process has pools of its own, so num_workers is per server process.
+    It defaults to an even share of the cores among the gunicorn workers,
+    whose number is taken from WEB_CONCURRENCY (gunicorn's default for -w).
     """
-    # get session:
-    await get_session(request)
 
-    _id = request.match_info["source_id"]
+    def __init__(
+        self, num_workers: int = None, max_queue_size: int = 64, timeout: float = 30
+    ):
+        server_processes = int(os.environ.get("WEB_CONCURRENCY", 1))
+        self.num_workers = num_workers or max(
+            1, (os.cpu_count() or 1) // server_processes
+        )
+        # spawn: do not fork the event loop and db clients into the workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self.max_pending = self.num_workers + max_queue_size
+        self.pending = 0
+        # the slots are released from the executor's management thread
+        self.lock = threading.Lock()
+        self.timeout = timeout
+
+    def release(self, _future):
+        with self.lock:
+            self.pending -= 1
+
+    async def run(self, func, *args, **kwargs):
+        """
+            Run func(*args, **kwargs) in a worker process
+        :return: result
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise Exception("Too many pending jobs, try again later")
+            self.pending += 1
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except Exception:
+            self.release(None)
+            raise
+        # wait_for only cancels the wrapper, a running call goes on in the worker
+        future.add_done_callback(self.release)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=self.timeout)
 
-    catalogs = config["kowalski"]["catalogs_hr_diagram"]
+    def stop(self):
+        self.executor.shutdown(wait=False)
 
-    projection = {"ra": 1, "dec": 1}
-    for catalog in catalogs:
-        projection["xmatch." + catalog] = 1
 
-    source = (
-        await request.app["mongo"]
-        .sources.find({"_id": _id}, projection)
-        .to_list(length=None)
+def lc_plot_series(source):
+    """
+        Per-light curve arrays for plots.plot_lc and plots.plot_maghist
+    :param source: saved source with lc
+    :return:
+    """
+    lc_color_indexes = dict()
+    series = []
+    for lc in source["lc"]:
+        filt = lc["filter"]
+        lc_color_indexes[filt] = (
+            lc_color_indexes[filt] + 1 if filt in lc_color_indexes else 0
+        )
+        columns = lc_columns(lc, fields=("hjd", "mjd", "mag", "magerr", "catflags"))
+        series.append(
+            {
+                "filter": filt,
+                "color": lc_colors(filt, lc_color_indexes[filt]),
+                "hjd": columns["hjd"]
+                if "hjd" in columns
+                else columns["mjd"] + 2400000.5,
+                "mag": columns["mag"],
+                "magerr": columns["magerr"],
+                "catflags": columns.get("catflags", None),
+            }
+        )
+    return series
+
+
+def hr_xy(ra, dec, xmatches):
+    """
+        BP-RP and absolute G of the nearest cross-match with all the required properties
+    :param ra: [deg]
+    :param dec: [deg]
+    :param xmatches: Gaia cross-matches
+    :return: (x, y) or (None, None)
+    """
+    if len(xmatches) == 0:
+        return None, None
+
+    # pick the nearest match:
+    ii = np.argmin(
+        [
+            great_circle_distance(
+                dec * np.pi / 180,
+                ra * np.pi / 180,
+                *radec_str2rad(*dd["coordinates"]["radec_str"])[::-1],
+            )
+            for dd in xmatches
+        ]
     )
-    source = loads(dumps(source[0]))
 
-    xmatches = []
-    for catalog in catalogs:
-        if catalog in source["xmatch"]:
-            xmatches.extend(source["xmatch"][catalog])
-
-    if len(xmatches) > 0:
-        # pick the nearest match:
-        ii = np.argmin(
-            [
-                great_circle_distance(
-                    source["dec"] * np.pi / 180,
-                    source["ra"] * np.pi / 180,
-                    *radec_str2rad(*dd["coordinates"]["radec_str"])[::-1],
-                )
-                for dd in xmatches
-            ]
-        )
+    xmatch = xmatches[ii]
+
+    g = xmatch.get("phot_g_mean_mag", None)
+    bp = xmatch.get("phot_bp_mean_mag", None)
+    rp = xmatch.get("phot_rp_mean_mag", None)
+    p = xmatch.get("parallax", None)
+
+    x, y = np.nan, np.nan
+    if g and bp and rp and p:
+        x = bp - rp
+        y = g + 5 * np.log10(p / 1000) + 5
+
+    # the values might be NaNs (that can happen if the parallax is negative for example)
+    # which would cause the plot to not show anything
+    if math.isnan(x) or math.isnan(y):
+        return None, None
+
+    return float(x), float(y)
 
-        xmatch = xmatches[ii]
 
-        g = xmatch.get("phot_g_mean_mag", None)
-        bp = xmatch.get("phot_bp_mean_mag", None)
-        rp = xmatch.get("phot_rp_mean_mag", None)
-        p = xmatch.get("parallax", None)
+class PlotCache(object):
+    """
+    On-disk cache of rendered plots, content-addressed by the source id,
+    its last_modified, the endpoint and the normalized query parameters.
+
+    Files live under path, which is shared by all server processes, so the
+    directory itself is what is bounded: reads bump a file's mtime, and once
+    a process has written max_size / 100 bytes since it last looked, it scans
+    the directory and removes the least recently used files until they take up
+    less than 90% of max_size [bytes]. A lock file keeps the processes
+    from evicting at the same time. The directory is thus kept within max_size
+    plus whatever the processes write in between scans.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        # bytes written by this process since it last scanned the directory
+        self.written = 0
+        self.scan_every = max(max_size // 100, 1)
+
+        os.makedirs(self.path, exist_ok=True)
+        self._evict()
+
+    @staticmethod
+    def key(source_id, last_modified, endpoint, query):
+        return compute_hash(
+            json.dumps([source_id, str(last_modified), endpoint, sorted(query.items())])
+        )
 
-        x, y = np.nan, np.nan
-        if g and bp and rp and p:
-            x = bp - rp
-            y = g + 5 * np.log10(p / 1000) + 5
+    def file_name(self, key):
+        return os.path.join(self.path, f"{key}.png")
 
-        # we calculated x and y first, as the values might be NaNs
-        # (that can happen if the parallax is negative for example)
-        # which would caus the plot to not show anything
-        if not math.isnan(x) and not math.isnan(y):
+    def _evict(self):
+        with open(os.path.join(self.path, ".lock"), "w") as lock:
             try:
-                img = plt.imread(current_dir + "/static/img/hr_plot.png")
-                buff = io.BytesIO()
-                fig = plt.figure(figsize=(4, 4), dpi=200)
-                ax = fig.add_subplot(111)
-                ax.plot(
-                    x,
-                    y,
-                    "o",
-                    markersize=8,
-                    c="#f22f29",
-                )
-                ax.imshow(img, extent=[-1, 5, 17, -5])
-                ax.set_aspect(1 / 4)
-                ax.set_ylabel("G")
-                ax.set_xlabel("BP-RP")
-                ax.set_title(
-                    f"BP-RP: {x:.4f}, G: {y:.4f}",
-                    fontsize=10,
-                    horizontalalignment="center",
-                    color="black",
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another process is at it
+                return
+
+            files = []
+            now = time.time()
+            for ff in os.scandir(self.path):
+                try:
+                    stat = ff.stat()
+                    # left behind by a process that died mid-write
+                    if ff.name.endswith(".tmp") and now - stat.st_mtime > 3600:
+                        os.remove(ff.path)
+                except FileNotFoundError:
+                    continue
+                if ff.name.endswith(".png"):
+                    files.append((stat.st_mtime, stat.st_size, ff.path))
+
+            size = sum(file_size for _, file_size, _ in files)
+            if size <= self.max_size:
+                return
+            for _, file_size, file_path in sorted(files):
+                if size <= 0.9 * self.max_size:
+                    break
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+                size -= file_size
+
+    async def get(self, key):
+        try:
+            async with aiofiles.open(self.file_name(key), "rb") as f:
+                data = await f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            # recently used, for every process' eviction
+            os.utime(self.file_name(key))
+        except FileNotFoundError:
+            pass
+        return data
+
+    async def set(self, key, data: bytes):
+        if len(data) > self.max_size:
+            return
+        # write to a temporary file first so that readers never see a partial plot
+        tmp = f"{self.file_name(key)}.{random_alphanumeric_str(8)}.tmp"
+        async with aiofiles.open(tmp, "wb") as f:
+            await f.write(data)
+        os.replace(tmp, self.file_name(key))
+
+        self.written += len(data)
+        if self.written >= self.scan_every:
+            self.written = 0
+            await asyncio.get_running_loop().run_in_executor(None, self._evict)
+
+
+def plot_cached(endpoint: str):
+    """
+        Serve a source plot from app["plot_cache"], rendering it with func on a miss,
+        with ETag/Cache-Control headers
+    :param endpoint:
+    :return:
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(request):
+            _id = request.match_info["source_id"]
+            source = await request.app["mongo"].sources.find_one(
+                {"_id": _id}, {"last_modified": 1}
+            )
+            if source is None:
+                return await func(request)
+
+            plot_cache = request.app["plot_cache"]
+            key = plot_cache.key(
+                _id,
+                source.get("last_modified", None),
+                endpoint,
+                request.rel_url.query,
+            )
+            max_age = config["misc"]["plot_cache"]["max_age"]
+            headers = {
+                "ETag": f'"{key}"',
+                "Cache-Control": f"private, max-age={max_age}",
+            }
+            if request.headers.get("If-None-Match", None) == headers["ETag"]:
+                return web.Response(status=304, headers=headers)
+
+            data = await plot_cache.get(key)
+            if data is not None:
+                return web.Response(
+                    body=data, content_type="image/png", headers=headers
                 )
-                plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-                plt.savefig(buff, dpi=200, bbox_inches="tight")
-                buff.seek(0)
-                plt.close("all")
-                return web.Response(body=buff, content_type="image/png")
-            except Exception as e:
-                print(e)
 
-    img = plt.imread(current_dir + "/static/img/hr_plot.png")
-    buff = io.BytesIO()
-    fig = plt.figure(figsize=(4, 4), dpi=200)
-    ax = fig.add_subplot(111)
-    ax.imshow(img, extent=[-1, 5, 17, -5])
-    ax.set_aspect(1 / 4)
-    ax.set_ylabel("G")
-    ax.set_xlabel("BP-RP")
-    ax.set_title(
-        f'No Match in {", ".join(catalogs)}\n (with all required properties)',
-        fontsize=16,
-        horizontalalignment="center",
-        color="red",
+            response = await func(request)
+            if (
+                response.status == 200
+                and isinstance(response.body, bytes)
+                and len(response.body) > 0
+            ):
+                await plot_cache.set(key, response.body)
+                response.headers.update(headers)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def lc_plot_kwargs(query):
+    """
+        plots.plot_lc parameters from images/lc query parameters
+    :param query:
+    :return:
+    """
+    # aspect:
+    w = float(query.get("w", 10))
+    h = float(query.get("h", 4))
+
+    # plot mag hist on the right-hand side?
+    hist = True if "hist" in query else False
+    # bins
+    bins = query.get("bins", "auto")
+    if bins != "auto":
+        bins = int(bins)
+
+    # phase-fold?
+    period = query.get("p", None)
+    units = str(query.get("u", "days")).lower()
+    if period is not None:
+        period = float(period)
+        if units == "minutes":
+            period /= 24 * 60
+        elif units == "hours":
+            period /= 24
+    plot_twice = query.get("t", False)
+
+    return {
+        "w": w,
+        "h": h,
+        "hist": hist,
+        "bins": bins,
+        "period": period,
+        "units": units,
+        "plot_twice": bool(plot_twice),
+    }
+
+
+def maghist_plot_kwargs(query):
+    """
+        plots.plot_maghist parameters from images/maghist query parameters
+    :param query:
+    :return:
+    """
+    # aspect:
+    w = float(query.get("w", 4.3))
+    h = float(query.get("h", 4))
+    # bins
+    bins = query.get("bins", "auto")
+    if bins != "auto":
+        bins = int(bins)
+
+    return {"w": w, "h": h, "bins": bins}
+
+
+def source_image_projection():
+    """
+        Saved source fields needed by render_source_image
+    :return:
+    """
+    projection = {"ra": 1, "dec": 1, "lc": 1, "last_modified": 1}
+    for catalog in config["kowalski"]["catalogs_hr_diagram"]:
+        projection["xmatch." + catalog] = 1
+    return projection
+
+
+async def render_source_image(app, source, kind: str, query):
+    """
+        Render source image
+    :param app:
+    :param source: saved source with the fields in source_image_projection()
+    :param kind: lc, maghist, or hr
+    :param query: image parameters
+    :return: PNG bytes, empty if there is nothing to plot
+    """
+    if kind == "hr":
+        xmatches = []
+        for catalog in config["kowalski"]["catalogs_hr_diagram"]:
+            xmatches.extend(source.get("xmatch", dict()).get(catalog, []))
+
+        x, y = hr_xy(source["ra"], source["dec"], xmatches)
+        if x is None or y is None:
+            return app["hr_no_match"]
+        return await app["plot_renderer"].run(plot_hr, x, y)
+
+    if len(source.get("lc", [])) == 0:
+        return b""
+
+    if kind == "lc":
+        return await app["plot_renderer"].run(
+            plot_lc, source["_id"], lc_plot_series(source), **lc_plot_kwargs(query)
+        )
+    if kind == "maghist":
+        return await app["plot_renderer"].run(
+            plot_maghist,
+            source["_id"],
+            lc_plot_series(source),
+            **maghist_plot_kwargs(query),
+        )
+
+    raise ValueError(f"Unknown image kind {kind}")
+
+
+async def source_image_response(request, kind: str):
+    _id = request.match_info["source_id"]
+
+    source = await request.app["mongo"].sources.find_one(
+        {"_id": _id}, source_image_projection()
     )
-    plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-    plt.savefig(buff, dpi=200, bbox_inches="tight")
-    buff.seek(0)
-    plt.close("all")
-    return web.Response(body=buff, content_type="image/png")
+
+    try:
+        png = await render_source_image(
+            request.app, source, kind, request.rel_url.query
+        )
+        return web.Response(body=png, content_type="image/png")
+    except Exception as e:
+        print(e)
+
+    return web.Response(body=b"", content_type="image/png")
+
+
+@routes.get("/sources/{source_id}/images/hr")
+@login_required
+@plot_cached("hr")
+async def source_hr_get_handler(request):
+    """
+        Serve HR diagram for a source
+    :param request:
+    :return:
+    """
+    # get session:
+    await get_session(request)
+
+    return await source_image_response(request, "hr")
 
 
 @routes.get("/api/images/hr")
@@ -2362,118 +4510,46 @@ async def hr_get_handler(request):
         ra = float(ra)
         dec = float(dec)
 
-        kowalski_query_xmatch = {
-            "query_type": "cone_search",
-            "query": {
-                "object_coordinates": {
-                    "radec": {"source": (ra, dec)},
-                    "cone_search_radius": sep,
-                    "cone_search_unit": "arcsec",
-                },
-                "catalogs": {
-                    catalog: {
-                        "filter": {},
-                        "projection": {
-                            "_id": 1,
-                            "coordinates.radec_str": 1,
-                            "parallax": 1,
-                            "parallax_error": 1,
-                            "phot_g_mean_mag": 1,
-                            "phot_bp_mean_mag": 1,
-                            "phot_rp_mean_mag": 1,
-                        },
-                    }
-                    for catalog in catalogs
-                },
+        xmatch_catalogs = await cross_match(
+            kowalski=request.app["kowalski"],
+            ra=ra,
+            dec=dec,
+            radius=sep,
+            unit="arcsec",
+            catalogs={
+                catalog: {
+                    "filter": {},
+                    "projection": {
+                        "_id": 1,
+                        "coordinates.radec_str": 1,
+                        "parallax": 1,
+                        "parallax_error": 1,
+                        "phot_g_mean_mag": 1,
+                        "phot_bp_mean_mag": 1,
+                        "phot_rp_mean_mag": 1,
+                    },
+                }
+                for catalog in catalogs
             },
-        }
-
-        resp = request.app["kowalski"].query(kowalski_query_xmatch)
-
-        xmatch = []
-        for instance_results in resp.values():
-            for catalog_results in instance_results.get("data", {}).values():
-                xmatch.extend(catalog_results.get("source", []))
-
-        if len(xmatch) > 0:
-            # pick the nearest match:
-            ii = np.argmin(
-                [
-                    great_circle_distance(
-                        dec * np.pi / 180,
-                        ra * np.pi / 180,
-                        *radec_str2rad(*dd["coordinates"]["radec_str"])[::-1],
-                    )
-                    for dd in xmatch
-                ]
-            )
+            cache=request.app["xmatch_cache"],
+        )
 
-            xmatch = xmatch[ii]
+        xmatch = list(itertools.chain.from_iterable(xmatch_catalogs.values()))
 
-            g = xmatch.get("phot_g_mean_mag", None)
-            bp = xmatch.get("phot_bp_mean_mag", None)
-            rp = xmatch.get("phot_rp_mean_mag", None)
-            p = xmatch.get("parallax", None)
+        x, y = hr_xy(ra, dec, xmatch)
+        if x is not None and y is not None:
+            try:
+                png = await request.app["plot_renderer"].run(plot_hr, x, y)
+                return web.Response(body=png, content_type="image/png")
+            except Exception as e:
+                print(e)
 
-            x, y = np.nan, np.nan
-            if g and bp and rp and p:
-                x = bp - rp
-                y = g + 5 * np.log10(p / 1000) + 5
-            if not math.isnan(x) and not math.isnan(y):
-                try:
-                    img = plt.imread(current_dir + "/static/img/hr_plot.png")
-                    buff = io.BytesIO()
-
-                    fig = plt.figure(figsize=(4, 4), dpi=200)
-                    ax = fig.add_subplot(111)
-                    ax.plot(
-                        x,
-                        y,
-                        "o",
-                        markersize=8,
-                        c="#f22f29",
-                    )
-                    ax.imshow(img, extent=[-1, 5, 17, -5])
-                    ax.set_aspect(1 / 4)
-                    ax.set_ylabel("G")
-                    ax.set_xlabel("BP-RP")
-                    ax.set_title(
-                        f"BP-RP: {x:.4f}, G: {y:.4f}",
-                        fontsize=10,
-                        horizontalalignment="center",
-                        color="black",
-                    )
-                    plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-                    plt.savefig(buff, dpi=200, bbox_inches="tight")
-                    buff.seek(0)
-                    plt.close("all")
-                    return web.Response(body=buff, content_type="image/png")
-                except Exception as e:
-                    print(e)
-
-    img = plt.imread(current_dir + "/static/img/hr_plot.png")
-    buff = io.BytesIO()
-    fig = plt.figure(figsize=(4, 4), dpi=200)
-    ax = fig.add_subplot(111)
-    ax.imshow(img, extent=[-1, 5, 17, -5])
-    ax.set_aspect(1 / 4)
-    ax.set_ylabel("G")
-    ax.set_xlabel("BP-RP")
-    ax.set_title(
-        f'No Match in {", ".join(catalogs)}\n (with all required properties)',
-        fontsize=16,
-        horizontalalignment="center",
-        color="red",
-    )
-    plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-    plt.savefig(buff, dpi=200, bbox_inches="tight")
-    buff.seek(0)
-    plt.close("all")
-    return web.Response(body=buff, content_type="image/png")
+    return web.Response(body=request.app["hr_no_match"], content_type="image/png")
 
 
 @routes.get("/sources/{source_id}/images/lc")
 @login_required
+@plot_cached("lc")
 async def source_lc_get_handler(request):
     """
         Serve light curve plot for a source
@@ -2483,373 +4559,738 @@ async def source_lc_get_handler(request):
     # get session:
     await get_session(request)
 
-    _id = request.match_info["source_id"]
-
-    source = (
-        await request.app["mongo"]
-        .sources.find({"_id": _id}, {"lc": 1})
-        .to_list(length=None)
-    )
-    source = loads(dumps(source[0]))
-    # print(source)
-
-    # GET params:
-    _r = request.rel_url.query
-
-    # aspect:
-    w = float(_r.get("w", 10))
-    h = float(_r.get("h", 4))
-
-    # plot mag hist on the right-hand side?
-    hist = True if "hist" in _r else False
-    # bins
-    bins = _r.get("bins", "auto")
-    if bins != "auto":
-        bins = int(bins)
-
-    # phase-fold?
-    period = _r.get("p", None)
-    units = str(_r.get("u", "days")).lower()
-    if period is not None:
-        period = float(period)
-        if units == "minutes":
-            period /= 24 * 60
-        elif units == "hours":
-            period /= 24
-    plot_twice = _r.get("t", False)
-
-    if len(source["lc"]) > 0:
-        try:
-            buff = io.BytesIO()
-
-            fig = plt.figure(figsize=(w, h), dpi=200)
-
-            if not hist:
-                ax_plc = fig.add_subplot(111)
-            else:
-                # definitions for the axes
-                left, width = 0.1, 0.65
-                bottom, height = 0.1, 0.65
-                spacing = 0.005
-
-                rect_scatter = [left, bottom, width, height]
-                # rect_histx = [left, bottom + height + spacing, width, 0.2]
-                rect_histy = [left + width + spacing, bottom, 0.2, height]
-
-                ax_plc = plt.axes(rect_scatter)
-                ax_plc.tick_params(direction="in", top=True, right=True)
-                ax_histy = plt.axes(rect_histy)
-                ax_histy.tick_params(direction="in", labelleft=False)
-
-            if period is None:
-                ax_plc.title.set_text(f'Photometric light curve for {source["_id"]}')
-            else:
-                # r"$\bf{"
-                ax_plc.title.set_text(
-                    f'Phase-folded light curve for {source["_id"]} with '
-                    r"$\bf{"
-                    f"p={period}\:{units}"  # noqa W605
-                    "}$"
-                )
-
-            lc_color_indexes = dict()
-
-            for lc in source["lc"]:
-                filt = lc["filter"]
-                lc_color_indexes[filt] = (
-                    lc_color_indexes[filt] + 1 if filt in lc_color_indexes else 0
-                )
-                c = lc_colors(filt, lc_color_indexes[filt])
-
-                df_plc = pd.DataFrame.from_records(lc["data"])
-                # display(df_plc)
-
-                if "mjd" not in df_plc:
-                    df_plc["mjd"] = df_plc["hjd"] - 2400000.5
-                if "hjd" not in df_plc:
-                    df_plc["hjd"] = df_plc["mjd"] + 2400000.5
-
-                if period is None:
-                    # filter out unreleased MSIP data or only use it for QA
-                    # w_msip = (df_plc['programid'] != 1) | (df_plc['hjd'] <= t_cut_msip)
-                    # w_msip = (df_plc['programid'] == 1) & (df_plc['hjd'] <= t_cut_msip)
-
-                    # w_good = w_msip & (df_plc['catflags'] == 0)
-                    if "catflags" in df_plc:
-                        w_good = df_plc["catflags"] == 0
-                        if np.sum(w_good) > 0:
-                            t = df_plc.loc[w_good, "hjd"]
-                            mag = df_plc.loc[w_good, "mag"]
-                            mag_error = df_plc.loc[w_good, "magerr"]
-
-                            ax_plc.errorbar(
-                                t,
-                                mag,
-                                yerr=mag_error,
-                                elinewidth=0.4,
-                                marker=".",
-                                c=c,
-                                lw=0,
-                                label=f"filter: {filt}",
-                            )
-
-                        # w_not_so_good = w_msip & (df_plc['catflags'] != 0)
-                        w_not_so_good = df_plc["catflags"] != 0
-                        if np.sum(w_not_so_good) > 0:
-                            t = df_plc.loc[w_not_so_good, "hjd"]
-                            mag = df_plc.loc[w_not_so_good, "mag"]
-                            mag_error = df_plc.loc[w_not_so_good, "magerr"]
-
-                            ax_plc.errorbar(
-                                t,
-                                mag,
-                                yerr=mag_error,
-                                elinewidth=0.4,
-                                marker="x",
-                                alpha=0.5,
-                                c=c,
-                                lw=0,
-                                label=f"filter: {filt}, flagged",
-                            )
-                    else:
-                        w_det = df_plc["mag"] != 0
-                        t = df_plc.loc[w_det, "hjd"]
-                        mag = df_plc.loc[w_det, "mag"]
-                        mag_error = df_plc.loc[w_det, "magerr"]
-
-                        ax_plc.errorbar(
-                            t,
-                            mag,
-                            yerr=mag_error,
-                            elinewidth=0.4,
-                            marker=".",
-                            c=c,
-                            lw=0,
-                            label=f"filter: {filt}",
-                        )
+    return await source_image_response(request, "lc")
 
-                else:
-                    # phase-folded lc:
-                    if "catflags" in df_plc:
-                        w_det = (df_plc["mag"] != 0) & (df_plc["catflags"] == 0)
-                    else:
-                        w_det = df_plc["mag"] != 0
 
-                    df_plc["phase"] = df_plc["hjd"].apply(lambda x: (x / period) % 1)
-
-                    t = (
-                        df_plc.loc[w_det, "phase"]
-                        if not plot_twice
-                        else np.hstack(
-                            (
-                                df_plc.loc[w_det, "phase"].values,
-                                df_plc.loc[w_det, "phase"].values + 1,
-                            )
-                        )
-                    )
-                    mag = (
-                        df_plc.loc[w_det, "mag"]
-                        if not plot_twice
-                        else np.hstack(
-                            (
-                                df_plc.loc[w_det, "mag"].values,
-                                df_plc.loc[w_det, "mag"].values,
-                            )
-                        )
-                    )
-                    mag_error = (
-                        df_plc.loc[w_det, "magerr"].values
-                        if not plot_twice
-                        else np.hstack(
-                            (
-                                df_plc.loc[w_det, "magerr"].values,
-                                df_plc.loc[w_det, "magerr"].values,
-                            )
-                        )
-                    )
-
-                    ax_plc.errorbar(
-                        t,
-                        mag,
-                        yerr=mag_error,
-                        elinewidth=0.4,
-                        marker=".",
-                        c=c,
-                        lw=0,
-                        label=f"filter: {filt}",
-                    )
-
-                if hist:
-                    if period is not None:
-                        if "catflags" in df_plc:
-                            w_det = (df_plc["mag"] != 0) & (df_plc["catflags"] == 0)
-                        else:
-                            w_det = df_plc["mag"] != 0
-                    else:
-                        w_det = df_plc["mag"] != 0
-                    mag = df_plc.loc[w_det, "mag"]
-                    ax_histy.hist(
-                        mag,
-                        bins=bins,
-                        color=c,
-                        alpha=0.5,
-                        label=f"filter: {filt}",
-                        orientation="horizontal",
-                    )
-
-            ax_plc.invert_yaxis()
-            # if t_format == 'days_ago':
-            #     ax_plc.invert_xaxis()
-            ax_plc.grid(True, lw=0.3)
-            # ax_plc.set_xlabel(t_format)
-            ax_plc.set_ylabel("mag")
-
-            if not hist:
-                ax_plc.legend(
-                    bbox_to_anchor=(1, 1), loc="upper left", ncol=1, fontsize="x-small"
-                )
-                plt.tight_layout(pad=0, h_pad=0, w_pad=0)
-            else:
-                ax_histy.invert_yaxis()
-                ax_histy.grid(True, lw=0.3)
-                ax_histy.legend(
-                    bbox_to_anchor=(1, 1), loc="upper left", ncol=1, fontsize="x-small"
-                )
-
-            plt.savefig(buff, dpi=200, bbox_inches="tight")
-            buff.seek(0)
-            plt.close("all")
-            return web.Response(body=buff, content_type="image/png")
-        except Exception as e:
-            print(e)
+@routes.get("/sources/{source_id}/images/maghist")
+@login_required
+@plot_cached("maghist")
+async def source_maghist_get_handler(request):
+    """
+        Serve mag hist for a source
+    :param request:
+    :return:
+    """
+    # get session:
+    await get_session(request)
 
-    buff = io.BytesIO()
-    # buff.write(base64.b64decode(b"R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"))
-    # buff.seek(0)
-    # return web.Response(body=buff, content_type='image/gif')
-    return web.Response(body=buff, content_type="image/png")
+    return await source_image_response(request, "maghist")
 
 
-@routes.get("/sources/{source_id}/images/maghist")
+@routes.post("/sources/images")
 @login_required
-async def source_maghist_get_handler(request):
+async def sources_images_post_handler(request):
     """
-        Serve mag hist for a source
+        Serve a batch of source images in one multipart/form-data response,
+        one part per image named after its url.
+        Takes {"images": ["/sources/{source_id}/images/{lc|maghist|hr|ps1}?...", ...]}
     :param request:
     :return:
     """
     # get session:
     await get_session(request)
 
-    _id = request.match_info["source_id"]
+    try:
+        _r = await request.json()
+        urls = list(_r["images"])
+        assert (
+            len(urls) <= config["misc"]["image_bundle"]["max_images"]
+        ), f'too many images, max {config["misc"]["image_bundle"]["max_images"]}'
+
+        images = []
+        for url in urls:
+            url = URL(url)
+            match = re.fullmatch(
+                r"/sources/(?P<source_id>[^/]+)/images/(?P<kind>lc|maghist|hr|ps1)",
+                url.path,
+            )
+            assert match is not None, f"bad image url {url}"
+            images.append((match.group("source_id"), match.group("kind"), url.query))
+
+        # one db round trip for all the sources
+        sources = await (
+            request.app["mongo"]
+            .sources.find(
+                {"_id": {"$in": list({source_id for source_id, _, _ in images})}},
+                source_image_projection(),
+            )
+            .to_list(length=None)
+        )
+        sources = {source["_id"]: source for source in sources}
 
-    source = (
-        await request.app["mongo"]
-        .sources.find({"_id": _id}, {"lc": 1})
-        .to_list(length=None)
-    )
-    source = loads(dumps(source[0]))
-    # print(source)
+        plot_cache = request.app["plot_cache"]
+        semaphore = asyncio.Semaphore(request.app["plot_renderer"].num_workers)
 
-    # GET params:
-    _r = request.rel_url.query
+        async def image(source_id, kind, query):
+            source = sources.get(source_id, None)
+            if source is None:
+                return b""
+            if kind == "ps1":
+                return await request.app["ps1"].cutout(source["ra"], source["dec"])
 
-    # aspect:
-    w = float(_r.get("w", 4.3))
-    h = float(_r.get("h", 4))
-    # bins
-    bins = _r.get("bins", "auto")
-    if bins != "auto":
-        bins = int(bins)
+            key = plot_cache.key(
+                source_id, source.get("last_modified", None), kind, query
+            )
+            data = await plot_cache.get(key)
+            if data is not None:
+                return data
+
+            async with semaphore:
+                data = await render_source_image(request.app, source, kind, query)
+            if len(data) > 0:
+                await plot_cache.set(key, data)
+            return data
+
+        rendered = await asyncio.gather(
+            *[image(*im) for im in images], return_exceptions=True
+        )
 
-    if len(source["lc"]) > 0:
-        try:
-            buff = io.BytesIO()
+        writer = multipart.MultipartWriter("form-data")
+        for ii, (url, data) in enumerate(zip(urls, rendered)):
+            if isinstance(data, Exception):
+                print(f"Failed to render {url}: {str(data)}")
+                data = b""
+            part = writer.append(data, {"Content-Type": "image/png"})
+            part.set_content_disposition("form-data", name=url, filename=f"{ii}.png")
 
-            fig = plt.figure(figsize=(w, h), dpi=200)
-            ax_plc = fig.add_subplot(111)
-            ax_plc.title.set_text(f'Histogram of magnitudes for {source["_id"]}')
+        return web.Response(body=writer)
 
-            lc_color_indexes = dict()
+    except Exception as _e:
+        print(f"Got error: {str(_e)}")
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({"message": f"failure: {_err}"}, status=500)
 
-            for lc in source["lc"]:
-                filt = lc["filter"]
-                lc_color_indexes[filt] = (
-                    lc_color_indexes[filt] + 1 if filt in lc_color_indexes else 0
-                )
-                c = lc_colors(filt, lc_color_indexes[filt])
 
-                df_plc = pd.DataFrame.from_records(lc["data"])
-                # display(df_plc)
+class KowalskiGateway(object):
+    """
+    Async front end to the (blocking) penquins Kowalski client.
+
+    Queries run on a dedicated thread pool, at most max_concurrency calls per instance
+    at a time, each bounded by timeout seconds.
+    Queries without an explicit instance name are routed by catalog:
+    cone searches are split into one sub-query per instance that hosts some of
+    the requested catalogs and the sub-queries are run concurrently.
+    Results are returned as {instance_name: result} like penquins does.
+    """
+
+    def __init__(
+        self,
+        instances: Mapping,
+        max_concurrency: int = 8,
+        timeout: float = 60,
+        default_instance: str = "kowalski",
+    ):
+        self.instances_config = instances
+        self.timeout = timeout
+        self.default_instance = default_instance
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrency * len(instances),
+            thread_name_prefix="kowalski",
+        )
+        self.semaphores = {
+            name: asyncio.Semaphore(max_concurrency) for name in instances
+        }
+        self.lock = asyncio.Lock()
+        self.kowalski = Kowalski(instances=instances)
+
+    @property
+    def instances(self):
+        return self.kowalski.instances
+
+    async def run(self, func, *args, timeout: float = None, **kwargs):
+        return await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs)
+            ),
+            timeout=self.timeout if timeout is None else timeout,
+        )
 
-                if "mjd" not in df_plc:
-                    df_plc["mjd"] = df_plc["hjd"] - 2400000.5
-                if "hjd" not in df_plc:
-                    df_plc["hjd"] = df_plc["mjd"] + 2400000.5
+    def instance_for(self, catalog):
+        for name, instance in self.instances.items():
+            if catalog in instance.get("catalogs", []):
+                return name
+        if self.default_instance in self.instances:
+            return self.default_instance
+        return next(iter(self.instances))
+
+    def route(self, query):
+        """
+            Split query into [(instance_name, sub-query)] by catalog
+        :param query:
+        :return:
+        """
+        _query = query.get("query", {})
+        if "catalog" in _query:
+            return [(self.instance_for(_query["catalog"]), query)]
+        if "catalogs" in _query:
+            catalogs = dict()
+            for catalog, value in _query["catalogs"].items():
+                name = self.instance_for(catalog)
+                catalogs[name] = {**catalogs.get(name, dict()), catalog: value}
+            return [
+                (name, {**query, "query": {**_query, "catalogs": cats}})
+                for name, cats in catalogs.items()
+            ]
+        return [(self.instance_for(None), query)]
 
-                if "catflags" in df_plc:
-                    w_det = (df_plc["mag"] != 0) & (df_plc["catflags"] == 0)
-                else:
-                    w_det = df_plc["mag"] != 0
+    async def query_instance(self, name, query, timeout: float = None):
+        async with self.semaphores[name]:
+            result = await self.run(
+                self.kowalski.query, query=query, name=name, timeout=timeout
+            )
+        # unwrap {name: result} if penquins wrapped it
+        return result.get(name, result)
+
+    async def query(self, query, name: str = None, timeout: float = None):
+        """
+            Execute query on Kowalski instance(s) without blocking the event loop
+        :param query:
+        :param name: instance name, route by catalog if not set
+        :param timeout: [s], override default
+        :return: {instance_name: result}
+        """
+        sub_queries = [(name, query)] if name is not None else self.route(query)
+        results = await asyncio.gather(
+            *[
+                self.query_instance(inst, sub_query, timeout=timeout)
+                for inst, sub_query in sub_queries
+            ],
+            return_exceptions=True,
+        )
+        resp = dict()
+        for (inst, _), result in zip(sub_queries, results):
+            if isinstance(result, asyncio.TimeoutError):
+                result = {"status": "error", "message": f"{inst} timed out"}
+            elif isinstance(result, Exception):
+                result = {"status": "error", "message": str(result)}
+            resp[inst] = result
+        return resp
+
+    async def ping(self):
+        try:
+            return await self.run(self.kowalski.ping)
+        except Exception as _e:
+            print(f"Got error: {str(_e)}")
+            return False
 
-                mag = df_plc.loc[w_det, "mag"]
+    async def reset(self):
+        """
+            Reconnect to Kowalski
+        :return:
+        """
+        async with self.lock:
+            self.kowalski = await self.run(Kowalski, instances=self.instances_config)
 
-                ax_plc.hist(mag, bins=bins, color=c, alpha=0.5, label=f"filter: {filt}")
+    def stop(self):
+        self.executor.shutdown(wait=False)
 
-            ax_plc.grid(True, lw=0.3)
-            ax_plc.set_xlabel("mag")
-            ax_plc.legend(loc="best", ncol=1, fontsize="x-small")
 
-            plt.tight_layout(pad=0, h_pad=0, w_pad=0)
+class XMatchCache(object):
+    """
+    Cache of single-position Kowalski cone search results: an in-memory LRU in front
+    of the xmatch_cache collection, which expires entries via a TTL index.
 
-            plt.savefig(buff, dpi=200, bbox_inches="tight")
-            buff.seek(0)
-            plt.close("all")
-            return web.Response(body=buff, content_type="image/png")
-        except Exception as e:
-            print(e)
+    Entries are keyed by the HEALPix cell (nested, nside) of the position,
+    the cone radius and unit, and a hash of the catalogs with their filters and
+    projections, so repeated and nearby (same cell) lookups skip Kowalski.
+    """
+
+    def __init__(
+        self, mongo, nside: int = 131072, ttl: float = 604800, max_entries: int = 10000
+    ):
+        self.mongo = mongo
+        self.nside = nside
+        self.ttl = ttl
+        self.front = TTLCache(max_size=max_entries, ttl=ttl, size_of=lambda _: 1)
+
+    def key(self, ra, dec, radius, unit, catalogs):
+        pixel = int(radec2healpix(ra, dec, nside=self.nside))
+        return compute_hash(
+            json.dumps(
+                [pixel, self.nside, str(radius), unit, catalogs],
+                sort_keys=True,
+                default=str,
+            )
+        )
+
+    async def get(self, key):
+        result = self.front.get(key, None)
+        if result is not None:
+            return result
+        try:
+            doc = await self.mongo.xmatch_cache.find_one(
+                {"_id": key, "expires": {"$gt": utc_now()}}
+            )
+        except Exception as _e:
+            print(f"Got error: {str(_e)}")
+            return None
+        if doc is None:
+            return None
+        self.front.set(key, doc["result"])
+        return doc["result"]
+
+    async def set(self, key, result):
+        self.front.set(key, result)
+        try:
+            await self.mongo.xmatch_cache.update_one(
+                {"_id": key},
+                {
+                    "$set": {
+                        "result": result,
+                        "expires": utc_now() + datetime.timedelta(seconds=self.ttl),
+                    }
+                },
+                upsert=True,
+            )
+        except Exception as _e:
+            print(f"Got error: {str(_e)}")
 
-    buff = io.BytesIO()
-    return web.Response(body=buff, content_type="image/png")
 
+async def cross_match(
+    kowalski, ra, dec, radius=None, unit=None, catalogs=None, cache=None
+):
+    """
+        Cone search Kowalski catalogs around a single position
+    :param kowalski: KowalskiGateway
+    :param ra: [deg]
+    :param dec: [deg]
+    :param radius: default from config
+    :param unit: default from config
+    :param catalogs: {catalog: {"filter": ..., "projection": ...}}, default from config
+    :param cache: XMatchCache
+    :return: {catalog: [matches]}
+    """
+    if radius is None:
+        radius = config["kowalski"]["cross_match"]["cone_search_radius"]
+    if unit is None:
+        unit = config["kowalski"]["cross_match"]["cone_search_unit"]
+    if catalogs is None:
+        catalogs = config["kowalski"]["cross_match"]["catalogs"]
+
+    if cache is not None:
+        key = cache.key(ra, dec, radius, unit, catalogs)
+        xmatch = await cache.get(key)
+        if xmatch is not None:
+            return copy.deepcopy(xmatch)
 
-def cross_match(kowalski, ra, dec):
     kowalski_query_xmatch = {
         "query_type": "cone_search",
         "query": {
             "object_coordinates": {
                 "radec": f"[({ra}, {dec})]",
-                "cone_search_radius": config["kowalski"]["cross_match"][
-                    "cone_search_radius"
-                ],
-                "cone_search_unit": config["kowalski"]["cross_match"][
-                    "cone_search_unit"
-                ],
+                "cone_search_radius": radius,
+                "cone_search_unit": unit,
             },
-            "catalogs": config["kowalski"]["cross_match"]["catalogs"],
+            "catalogs": catalogs,
         },
     }
     # print(kowalski_query_xmatch)
 
-    resp = kowalski.query(query=kowalski_query_xmatch, name="kowalski")
+    resp = await kowalski.query(query=kowalski_query_xmatch)
     xmatch = {}
     for instance_result in resp.values():
-        xmatch = {**xmatch, **instance_result["data"]}
+        xmatch = {**xmatch, **instance_result.get("data", {})}
 
     # reformat for ingestion (we queried only one sky position):
     for cat in xmatch.keys():
         kk = list(xmatch[cat].keys())[0]
         xmatch[cat] = xmatch[cat][kk]
 
+    # do not cache partial results
+    if cache is not None and all(
+        instance_result.get("status", None) == "success"
+        for instance_result in resp.values()
+    ):
+        await cache.set(key, copy.deepcopy(xmatch))
+
     return xmatch
 
 
+def filter_msip(data):
+    """
+        Drop MSIP data points taken after filter_MSIP_best_before_mjd if so configured
+    :param data: light curve data points
+    :return:
+    """
+    if not config["misc"]["filter_MSIP"]:
+        return data
+    return [
+        dp
+        for dp in data
+        if (
+            (dp["programid"] != 1)
+            or (dp["hjd"] - 2400000.5 <= config["misc"]["filter_MSIP_best_before_mjd"])
+        )
+    ]
+
+
+def ztf_source_lc(ztf_source, release):
+    """
+        Light curve of a Kowalski ZTF source in the configured storage format
+    :param ztf_source:
+    :param release: catalog name
+    :return:
+    """
+    # temporal, folded; if folded - 'p': [{'period': float, 'period_error': float}]
+    lc = {
+        "_id": uid(length=24),
+        "telescope": "PO:1.2m",
+        "instrument": "ZTF",
+        "release": release,
+        "id": ztf_source["_id"],
+        "filter": ztf_source["filter"],
+        "lc_type": "temporal",
+        "data": filter_msip(ztf_source["data"]),
+    }
+    return pack_lc(lc, config["misc"]["lc_storage_format"])
+
+
+def new_source_doc(ztf_source, zvm_program_id: int, user: str):
+    """
+        Build a saved source document, without _id and xmatch,
+        from a Kowalski ZTF source or a position (see parse_radec)
+    :param ztf_source:
+    :param zvm_program_id:
+    :param user:
+    :return:
+    """
+    doc = dict()
+
+    # assign to zvm_program_id:
+    doc["zvm_program_id"] = int(zvm_program_id)
+
+    # coordinates:
+    doc["ra"] = ztf_source["ra"]
+    doc["dec"] = ztf_source["dec"]
+    # Galactic coordinates:
+    doc["l"], doc["b"] = radec2lb(doc["ra"], doc["dec"])  # longitude, latitude
+    doc["coordinates"] = ztf_source["coordinates"]
+    # HEALPix pixel index for bulk cross-matching
+    doc["coordinates"]["healpix_nside"] = config["misc"]["healpix"]["nside"]
+    doc["coordinates"]["healpix"] = int(
+        radec2healpix(doc["ra"], doc["dec"], config["misc"]["healpix"]["nside"])
+    )
+
+    # [{'period': float, 'period_error': float}]:
+    doc["p"] = []
+    doc["source_types"] = []
+    doc["source_flags"] = []
+    doc["history"] = []
+
+    doc["labels"] = []
+
+    # spectra
+    doc["spec"] = []
+
+    # lc:
+    if "data" in ztf_source:
+        doc["lc"] = [ztf_source_lc(ztf_source, config["kowalski"]["coll_sources"])]
+    else:
+        doc["lc"] = []
+
+    doc["created_by"] = user
+    time_tag = utc_now()
+    doc["created"] = time_tag
+    doc["last_modified"] = time_tag
+
+    # make history
+    doc["history"].append(
+        {"note_type": "info", "time_tag": time_tag, "user": user, "note": "Saved"}
+    )
+
+    return doc
+
+
+async def automerge_lcs(kowalski, instance, catalog, ra, dec, exclude_id=None):
+    """
+        Light curves of the ZTF sources within 2 arcsec from (ra, dec)
+    :param kowalski: KowalskiGateway
+    :param instance: Kowalski instance hosting catalog
+    :param catalog:
+    :param ra:
+    :param dec:
+    :param exclude_id: skip this ZTF source id (the one that is already there)
+    :return:
+    """
+    query_merge = {
+        "query_type": "cone_search",
+        "query": {
+            "object_coordinates": {
+                "radec": f"[({ra}, {dec})]",
+                # "cone_search_radius": config['kowalski']['cross_match']['cone_search_radius'],
+                # "cone_search_unit": config['kowalski']['cross_match']['cone_search_unit']},
+                "cone_search_radius": "2",
+                "cone_search_unit": "arcsec",
+            },
+            "catalogs": {
+                catalog: {
+                    "filter": {},
+                    "projection": {
+                        "_id": 1,
+                        "ra": 1,
+                        "dec": 1,
+                        "filter": 1,
+                        "coordinates": 1,
+                        "data": 1,
+                    }
+                    # "projection": {'_id': 1, 'ra': 1, 'dec': 1, 'filter': 1, 'coordinates': 1}
+                }
+            },
+        },
+    }
+    if exclude_id is not None:
+        # skip the one that is already there:
+        query_merge["query"]["catalogs"][catalog]["filter"] = {
+            "_id": {"$ne": int(exclude_id)}
+        }
+    # print(query_merge)
+
+    resp = await kowalski.query(query_merge, name=instance)
+    kk = list(resp.get(instance, {}).get("data", {}).get(catalog, {}).keys())[0]
+    sources_merge = resp[instance]["data"][catalog][kk]
+    # print(sources_merge)
+
+    return [ztf_source_lc(source_merge, catalog) for source_merge in sources_merge]
+
+
+async def next_source_numbers(mongo, source_id_base: str, num: int = 1):
+    """
+        Atomically reserve num consecutive numbers in the source_id_base bucket
+        of the counters collection, seeding the counter from the saved sources
+        if the bucket is new to it
+    :param mongo:
+    :param source_id_base: {prefix}{yy}{ra hours}
+    :param num:
+    :return: first reserved number
+    """
+    if await mongo.counters.count_documents({"_id": source_id_base}, limit=1) == 0:
+        saved_source_ids = await mongo.sources.find(
+            {"_id": {"$regex": f"^{re.escape(source_id_base)}[a-z]+$"}}, {"_id": 1}
+        ).to_list(length=None)
+        num_last = max(
+            (split_source_id(s["_id"])[1] for s in saved_source_ids), default=0
+        )
+        # $max: someone else might have seeded and used the counter in the meantime
+        await mongo.counters.update_one(
+            {"_id": source_id_base}, {"$max": {"seq": num_last}}, upsert=True
+        )
+
+    counter = await mongo.counters.find_one_and_update(
+        {"_id": source_id_base},
+        {"$inc": {"seq": num}},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+
+    return counter["seq"] - num + 1
+
+
+async def assign_source_ids(
+    mongo, docs, prefix: str = "ZTFS", naming: str = "incremental"
+):
+    """
+        Assign unique ids to new source docs:
+        incremental: {prefix}{yy}{ra hours}{a, b, ..., aa, ...}, one counter update
+                     per prefix+yy+ra hours present in docs
+        random: {prefix}{8 random characters}
+    :param mongo:
+    :param docs:
+    :param prefix:
+    :param naming: incremental or random
+    :return:
+    """
+    if naming != "incremental":
+        # random naming
+        for doc in docs:
+            doc["_id"] = uid(prefix=prefix, length=8)
+        return
+
+    yy = datetime.datetime.utcnow().strftime("%y")
+    groups = dict()
+    for doc in docs:
+        source_id_base = f'{prefix}{yy}{doc["coordinates"]["radec_str"][0][:2]}'
+        groups.setdefault(source_id_base, []).append(doc)
+
+    for source_id_base, group in groups.items():
+        num_first = await next_source_numbers(mongo, source_id_base, len(group))
+        for ii, doc in enumerate(group):
+            doc["_id"] = source_id_base + num2alphabet(num_first + ii)
+
+
+async def sources_put_bulk(request, _r, user: str):
+    """
+        Save a batch of ZTF sources and/or positions:
+        fetch light curves with one Kowalski query per batch_size ids,
+        cross-match concurrently, assign ids in one pass and insert_many(ordered=False)
+    :param request:
+    :param _r: {"sources": [{"_id": int} or {"ra": ..., "dec": ...}, ...],
+                "catalog": str, "zvm_program_id": int, ...}
+    :param user:
+    :return: per-item status, in the order of _r["sources"]
+    """
+    items = _r["sources"]
+    catalog = _r.get("catalog", None)
+    zvm_program_id = _r.get("zvm_program_id", None)
+    automerge = _r.get("automerge", False)
+    prefix = _r.get("prefix", "ZTFS")
+    naming = _r.get("naming", "incremental")  # 'incremental' or 'random'
+
+    assert zvm_program_id is not None, "zvm_program_id not specified"
+    assert catalog is not None, "catalog not specified"
+    assert isinstance(items, list), "sources must be a list"
+    assert (
+        len(items) <= config["misc"]["bulk_save"]["max_sources"]
+    ), f'too many sources, max {config["misc"]["bulk_save"]["max_sources"]}'
+
+    kowalski = request.app["kowalski"]
+    instance = None
+    for inst_name, inst in kowalski.instances.items():
+        if catalog in inst.get("catalogs", []):
+            instance = inst_name
+    assert instance is not None, f"no instance found for catalog {catalog}"
+
+    results = [None] * len(items)
+    ztf_sources = [None] * len(items)
+
+    # fetch ZTF sources by _id, in batches:
+    ids = dict()
+    for ii, item in enumerate(items):
+        try:
+            if item.get("_id", None) is not None:
+                ids.setdefault(int(item["_id"]), []).append(ii)
+            elif (item.get("ra", None) is not None) and (
+                item.get("dec", None) is not None
+            ):
+                ztf_sources[ii] = parse_radec(item["ra"], item["dec"])
+            else:
+                raise Exception("_id or (ra, dec) not specified")
+        except Exception as _e:
+            results[ii] = {"status": "failure", "message": str(_e)}
+
+    id_list = list(ids.keys())
+    batch_size = int(config["misc"]["bulk_save"]["batch_size"])
+    id_batches = []
+    for ib in range(0, len(id_list), batch_size):
+        ie = ib + batch_size
+        id_batches.append(id_list[ib:ie])
+    responses = await asyncio.gather(
+        *[
+            kowalski.query(
+                {
+                    "query_type": "find",
+                    "query": {
+                        "catalog": catalog,
+                        "filter": {"_id": {"$in": id_batch}},
+                        "projection": {
+                            "_id": 1,
+                            "ra": 1,
+                            "dec": 1,
+                            "filter": 1,
+                            "coordinates": 1,
+                            "data": 1,
+                        },
+                    },
+                },
+                name=instance,
+            )
+            for id_batch in id_batches
+        ]
+    )
+    for resp in responses:
+        for ztf_source in resp.get(instance, {}).get("data", []):
+            for ii in ids.pop(ztf_source["_id"], []):
+                # copy: the same _id might be requested more than once
+                ztf_sources[ii] = copy.deepcopy(ztf_source)
+    for _id, indices in ids.items():
+        for ii in indices:
+            results[ii] = {
+                "status": "failure",
+                "message": f"{_id} not found in {catalog}",
+            }
+
+    # build docs, cross-match and automerge concurrently
+    async def build(ii):
+        ztf_source = ztf_sources[ii]
+        doc = new_source_doc(ztf_source, zvm_program_id, user)
+        doc["xmatch"] = await cross_match(
+            kowalski=kowalski,
+            ra=doc["ra"],
+            dec=doc["dec"],
+            cache=request.app["xmatch_cache"],
+        )
+        if automerge:
+            doc["lc"].extend(
+                await automerge_lcs(
+                    kowalski,
+                    instance,
+                    catalog,
+                    doc["ra"],
+                    doc["dec"],
+                    exclude_id=ztf_source.get("_id", None),
+                )
+            )
+        return doc
+
+    indices = [ii for ii in range(len(items)) if results[ii] is None]
+    built = await asyncio.gather(*[build(ii) for ii in indices], return_exceptions=True)
+    docs = dict()
+    for ii, doc in zip(indices, built):
+        if isinstance(doc, Exception):
+            results[ii] = {"status": "failure", "message": str(doc)}
+        else:
+            docs[ii] = doc
+
+    # assign ids and insert, retrying on id collisions
+    saved = []
+    for nr in range(config["misc"]["max_retries"]):
+        if len(docs) == 0:
+            break
+        batch = list(docs.items())
+        await assign_source_ids(
+            request.app["mongo"],
+            [doc for _, doc in batch],
+            prefix=prefix,
+            naming=naming,
+        )
+        try:
+            await request.app["mongo"].sources.insert_many(
+                [doc for _, doc in batch], ordered=False
+            )
+            errors = []
+        except pymongo.errors.BulkWriteError as bwe:
+            errors = bwe.details.get("writeErrors", [])
+
+        failed = {error["index"]: error for error in errors}
+        for ib, (ii, doc) in enumerate(batch):
+            error = failed.get(ib, None)
+            if error is None:
+                results[ii] = {"status": "success", "_id": doc["_id"]}
+                saved.append((ii, doc))
+                docs.pop(ii)
+            elif error.get("code", None) != 11000:
+                results[ii] = {"status": "failure", "message": error.get("errmsg", "")}
+                docs.pop(ii)
+            # else duplicate id: try again
+
+    for ii in docs:
+        results[ii] = {"status": "failure", "message": "failed to assign unique _id"}
+
+    if config["misc"]["ps1"]["prefetch"]:
+        for ii, doc in saved:
+            request.app["ps1"].prefetch(doc["ra"], doc["dec"])
+
+    return results
+
+
 @routes.put("/sources")
 @login_required
 async def sources_put_handler(request):
     """
         Save ZTF source to own db assigning a unique id and adding to a program,
-        or create a blank one
+        or create a blank one.
+        Pass a list of {"_id": ...} or {"ra": ..., "dec": ...} as "sources"
+        to save many at once
     :param request:
     :return:
     """
@@ -2869,6 +5310,12 @@ async def sources_put_handler(request):
         # assert 'zvm_program_id' in _r, 'zvm_program_id not specified'
         # assert 'catalog' in _r, 'catalog not specified'
 
+        if "sources" in _r:
+            results = await sources_put_bulk(request, _r, user)
+            return web.json_response(
+                {"message": "success", "result": results}, status=200, dumps=dumps
+            )
+
         _id = _r.get("_id", None)
         ra = _r.get("ra", None)
         dec = _r.get("dec", None)
@@ -2886,9 +5333,7 @@ async def sources_put_handler(request):
         assert catalog is not None, "catalog not specified"
 
         instance = None
-        catalogs = []
         for inst_name, inst in request.app["kowalski"].instances.items():
-            catalogs.extend(inst.get("catalogs", []))
             if catalog in inst.get("catalogs", []):
                 instance = inst_name
         if instance is None:
@@ -2896,7 +5341,6 @@ async def sources_put_handler(request):
                 {"message": f"failure: no instance found for catalog {catalog}"},
                 status=400,
             )
-        catalogs = [c for c in catalogs if c.startswith("ZTF_sources_202")]
 
         # print(_r)
 
@@ -2917,7 +5361,7 @@ async def sources_put_handler(request):
                 },
             }
 
-            resp = request.app["kowalski"].query(kowalski_query)
+            resp = await request.app["kowalski"].query(kowalski_query, name=instance)
             ztf_sources = resp.get(instance, {}).get("data", [])
             assert len(ztf_sources) > 0, f"failure: {_id} not found in {catalog}"
             ztf_source = ztf_sources[0]
@@ -2926,182 +5370,33 @@ async def sources_put_handler(request):
             ztf_source = parse_radec(ra, dec)
 
         # build doc to ingest:
-        doc = dict()
-
-        if naming == "incremental":
-            source_id_base = f'{prefix}{datetime.datetime.utcnow().strftime("%y")}{ztf_source["coordinates"]["radec_str"][0][:2]}'
-
-            num_saved_sources = await request.app["mongo"].sources.count_documents(
-                {"_id": {"$regex": f"{source_id_base}.*"}}
-            )
-            # postfix = num2alphabet(num_saved_sources + 1)
-            if num_saved_sources > 0:
-                saved_source_ids = (
-                    await request.app["mongo"]
-                    .sources.find(
-                        {"_id": {"$regex": f"{source_id_base}.*"}}, {"_id": 1}
-                    )
-                    .to_list(length=None)
-                )
-                saved_source_ids = [s["_id"] for s in saved_source_ids]
-                saved_source_ids.sort(key=lambda item: (len(item), item))
-                # print(saved_source_ids)
-                num_last = alphabet2num(saved_source_ids[-1][8:])
-
-                postfix = num2alphabet(num_last + 1)
-
-            else:
-                postfix = "a"
-
-            source_id = source_id_base + postfix
-        else:
-            # random naming
-            source_id = uid(prefix=prefix, length=8)
-
-        # unique (sequential) id:
-        doc["_id"] = source_id
-
-        # assign to zvm_program_id:
-        doc["zvm_program_id"] = int(_r["zvm_program_id"])
-
-        # coordinates:
-        doc["ra"] = ztf_source["ra"]
-        doc["dec"] = ztf_source["dec"]
-        # Galactic coordinates:
-        doc["l"], doc["b"] = radec2lb(doc["ra"], doc["dec"])  # longitude, latitude
-        doc["coordinates"] = ztf_source["coordinates"]
-
-        # [{'period': float, 'period_error': float}]:
-        doc["p"] = []
-        doc["source_types"] = []
-        doc["source_flags"] = []
-        doc["history"] = []
-
-        doc["labels"] = []
+        doc = new_source_doc(ztf_source, zvm_program_id, user)
 
         # cross match:
-        xmatch = cross_match(
-            kowalski=request.app["kowalski"], ra=doc["ra"], dec=doc["dec"]
+        xmatch = await cross_match(
+            kowalski=request.app["kowalski"],
+            ra=doc["ra"],
+            dec=doc["dec"],
+            cache=request.app["xmatch_cache"],
         )
         doc["xmatch"] = xmatch
 
-        # spectra
-        doc["spec"] = []
-
-        # lc:
-        if "data" in ztf_source:
-            # filter lc for MSIP data
-            if config["misc"]["filter_MSIP"]:
-                # print(len(ztf_source['data']))
-                # ztf_source['data'] = [dp for dp in ztf_source['data'] if dp['programid'] != 1]
-                ztf_source["data"] = [
-                    dp
-                    for dp in ztf_source["data"]
-                    if (
-                        (dp["programid"] != 1)
-                        or (
-                            dp["hjd"] - 2400000.5
-                            <= config["misc"]["filter_MSIP_best_before_mjd"]
-                        )
-                    )
-                ]
-                # print(len(ztf_source['data']))
-
-            # temporal, folded; if folded - 'p': [{'period': float, 'period_error': float}]
-            lc = {
-                "_id": uid(length=24),
-                "telescope": "PO:1.2m",
-                "instrument": "ZTF",
-                "release": config["kowalski"]["coll_sources"],
-                "id": ztf_source["_id"],
-                "filter": ztf_source["filter"],
-                "lc_type": "temporal",
-                "data": ztf_source["data"],
-            }
-            doc["lc"] = [lc]
-        else:
-            doc["lc"] = []
-
         # feelin' lucky?
         if automerge:
-            query_merge = {
-                "query_type": "cone_search",
-                "query": {
-                    "object_coordinates": {
-                        "radec": f"[({doc['ra']}, {doc['dec']})]",
-                        # "cone_search_radius": config['kowalski']['cross_match']['cone_search_radius'],
-                        # "cone_search_unit": config['kowalski']['cross_match']['cone_search_unit']},
-                        "cone_search_radius": "2",
-                        "cone_search_unit": "arcsec",
-                    },
-                    "catalogs": {
-                        catalog: {
-                            "filter": {},
-                            "projection": {
-                                "_id": 1,
-                                "ra": 1,
-                                "dec": 1,
-                                "filter": 1,
-                                "coordinates": 1,
-                                "data": 1,
-                            }
-                            # "projection": {'_id': 1, 'ra': 1, 'dec': 1, 'filter': 1, 'coordinates': 1}
-                        }
-                    },
-                },
-            }
-            if _id is not None:
-                # skip the one that is already there:
-                query_merge["query"]["catalogs"][catalog]["filter"] = {
-                    "_id": {"$ne": int(_id)}
-                }
-            # print(query_merge)
-
-            resp = request.app["kowalski"].query(query_merge)
-            kk = list(resp.get(instance, {}).get("data", {}).get(catalog, {}).keys())[0]
-            sources_merge = resp["data"][catalog][kk]
-            # print(sources_merge)
-
-            for source_merge in sources_merge:
-                # filter lc for MSIP data
-                if config["misc"]["filter_MSIP"]:
-                    source_merge["data"] = [
-                        dp
-                        for dp in source_merge["data"]
-                        if (
-                            (dp["programid"] != 1)
-                            or (
-                                dp["hjd"] - 2400000.5
-                                <= config["misc"]["filter_MSIP_best_before_mjd"]
-                            )
-                        )
-                    ]
-
-                # temporal, folded; if folded - 'p': [{'period': float, 'period_error': float}]
-                lc = {
-                    "_id": uid(length=24),
-                    "telescope": "PO:1.2m",
-                    "instrument": "ZTF",
-                    "release": catalog,
-                    "id": source_merge["_id"],
-                    "filter": source_merge["filter"],
-                    "lc_type": "temporal",
-                    "data": source_merge["data"],
-                }
-
-                doc["lc"].append(lc)
-
-        doc["created_by"] = user
-        time_tag = utc_now()
-        doc["created"] = time_tag
-        doc["last_modified"] = time_tag
-
-        # make history
-        doc["history"].append(
-            {"note_type": "info", "time_tag": time_tag, "user": user, "note": "Saved"}
-        )
+            doc["lc"].extend(
+                await automerge_lcs(
+                    request.app["kowalski"],
+                    instance,
+                    catalog,
+                    doc["ra"],
+                    doc["dec"],
+                    exclude_id=_id,
+                )
+            )
 
         if naming == "incremental":
+            # unique (sequential) id:
+            await assign_source_ids(request.app["mongo"], [doc], prefix=prefix)
             await request.app["mongo"].sources.insert_one(doc)
         else:
             # avoid random name collisions
@@ -3113,7 +5408,11 @@ async def sources_put_handler(request):
                 except pymongo.errors.DuplicateKeyError:
                     continue
 
+        if config["misc"]["ps1"]["prefetch"]:
+            request.app["ps1"].prefetch(doc["ra"], doc["dec"])
+
         if return_result:
+            doc["lc"] = [lc_records(lc) for lc in doc["lc"]]
             return web.json_response(
                 {"message": "success", "result": doc}, status=200, dumps=dumps
             )
@@ -3130,17 +5429,18 @@ async def sources_put_handler(request):
         print(str(_err))
 
         try:
-            if not request.app["kowalski"].ping():
+            if not await request.app["kowalski"].ping():
                 print("Apparently lost connection to Kowalski, trying to reset")
-                request.app["kowalski"] = Kowalski(
-                    instances=config["kowalski"]["instances"]
-                )
+                await request.app["kowalski"].reset()
                 print("Success")
         except Exception as __e:
             print(str(__e))
 
         return web.json_response({"message": f"ingestion failed {str(_e)}"}, status=200)
 
+    finally:
+        await invalidate_query_cache(request.app, "sources")
+
 
 class MyMultipartReader(multipart.MultipartReader):
     def _get_boundary(self):
@@ -3177,8 +5477,11 @@ async def source_post_handler(request):
     try:
         _id = request.match_info["source_id"]
 
-        source = await request.app["mongo"].sources.find_one(
-            {"_id": _id}, {"lc.data": 0}
+        # autosaved labels are written without reading the source first
+        source = (
+            await request.app["mongo"].sources.find_one({"_id": _id}, {"lc.data": 0})
+            if _r.get("action", None) != "set_labels"
+            else None
         )
 
         if "action" in _r:
@@ -3240,7 +5543,9 @@ async def source_post_handler(request):
                     },
                 }
 
-                resp = request.app["kowalski"].query(kowalski_query)
+                resp = await request.app["kowalski"].query(
+                    kowalski_query, name=instance
+                )
                 ztf_sources = resp.get(instance, {}).get("data", [])
                 if len(ztf_sources) == 0:
                     return web.json_response(
@@ -3276,6 +5581,7 @@ async def source_post_handler(request):
                     "lc_type": "temporal",
                     "data": ztf_source["data"],
                 }
+                lc = pack_lc(lc, config["misc"]["lc_storage_format"])
 
                 # make history
                 time_tag = utc_now()
@@ -3350,7 +5656,10 @@ async def source_post_handler(request):
                     await request.app["mongo"].sources.update_one(
                         {"_id": _id},
                         {
-                            "$push": {"lc": lc, "history": h},
+                            "$push": {
+                                "lc": pack_lc(lc, config["misc"]["lc_storage_format"]),
+                                "history": h,
+                            },
                             "$set": {"last_modified": utc_now()},
                         },
                     )
@@ -3594,8 +5903,11 @@ async def source_post_handler(request):
 
             elif _r["action"] == "run_cross_match":
 
-                xmatch = cross_match(
-                    kowalski=request.app["kowalski"], ra=source["ra"], dec=source["dec"]
+                xmatch = await cross_match(
+                    kowalski=request.app["kowalski"],
+                    ra=source["ra"],
+                    dec=source["dec"],
+                    cache=request.app["xmatch_cache"],
                 )
 
                 # make history
@@ -3633,28 +5945,9 @@ async def source_post_handler(request):
                     label["user"] = user
                     label["last_modified"] = time_tag
 
-                doc = (
-                    await request.app["mongo"]
-                    .sources.find({"_id": _id}, {"_id": 0, "labels": 1})
-                    .to_list(length=None)
-                )
-                # ditch user's old labels:
-                labels_current = [
-                    lab
-                    for lab in doc[0].get("labels", ())
-                    if lab.get("user", None) != user
-                ]
-                # print(labels_current)
-
-                await request.app["mongo"].sources.update_one(
-                    {"_id": _id},
-                    {  # '$push': {'history': h},
-                        "$set": {
-                            "labels": labels + labels_current,
-                            "last_modified": time_tag,
-                        }
-                    },
-                )
+                # replace user's old labels, coalescing rapid autosave updates:
+                await request.app["label_writer"].set(user, _id, labels, time_tag)
+                await request.app["labeling_queues"].remove(user, _id)
 
                 return web.json_response({"message": "success"}, status=200)
 
@@ -3663,8 +5956,9 @@ async def source_post_handler(request):
                 # and ingest them into the source
 
                 fritz_source_id = _r.get("source_id", None)
-                data = api(f"sources/{fritz_source_id}/spectra", method="GET")
+                data = await request.app["fritz"].spectra(fritz_source_id)
                 if data is not None and len(data.get("spectra", [])) > 0:
+                    fritz_instruments = await request.app["fritz"].instruments()
                     new = False
                     for fritz_spectrum in data["spectra"]:
                         try:
@@ -3756,6 +6050,19 @@ async def source_post_handler(request):
                         status=200,
                     )
 
+            elif _r["action"] == "run_periodogram":
+                # compute period candidates, see periodograms.py
+                method = _r.get("method", "ls")
+                assert method in METHODS, f"method {method} not in {METHODS}"
+
+                candidates = await source_periodogram(
+                    request.app, _id, method=method, user=user
+                )
+
+                return web.json_response(
+                    {"message": "success", "result": candidates}, status=200
+                )
+
             else:
                 return web.json_response(
                     {"message": "failure: unknown action requested"}, status=200
@@ -3772,6 +6079,9 @@ async def source_post_handler(request):
         print(_err)
         return web.json_response({"message": f"action failed: {str(_e)}"}, status=200)
 
+    finally:
+        await invalidate_query_cache(request.app, "sources")
+
 
 @routes.delete("/sources/{source_id}")
 @login_required
@@ -3805,6 +6115,344 @@ async def source_delete_handler(request):
 
         return web.json_response({"message": f"deletion failed: {str(_e)}"}, status=200)
 
+    finally:
+        await invalidate_query_cache(request.app, "sources")
+
+
+""" periodograms """
+
+
+async def source_periodogram(app, source_id: str, method: str = "ls", user=None):
+    """
+        Compute period candidates for a saved source's merged light curves
+        on the periodogram pool and store them in its period_candidates[method]
+    :param app:
+    :param source_id:
+    :param method: see periodograms.METHODS
+    :param user: to make history
+    :return: candidates, best first
+    """
+    source = await app["mongo"].sources.find_one({"_id": source_id}, {"lc": 1})
+    assert source is not None, f"source {source_id} not found"
+
+    kwargs = {
+        k: config["misc"]["periodogram"][k]
+        for k in ("f_min", "f_max", "oversampling", "k", "min_points")
+    }
+    candidates = await app["periodogram_pool"].run(
+        period_candidates, lc_plot_series(source), method=method, **kwargs
+    )
+
+    time_tag = utc_now()
+    h = {
+        "note_type": "info",
+        "time_tag": time_tag,
+        "user": user,
+        "note": f"Period search ({method}): "
+        + (
+            f'best {candidates[0]["period"]:.6f} Days'
+            if len(candidates) > 0
+            else "not enough data"
+        ),
+    }
+
+    await app["mongo"].sources.update_one(
+        {"_id": source_id},
+        {
+            "$push": {"history": h},
+            "$set": {
+                f"period_candidates.{method}": candidates,
+                "last_modified": time_tag,
+            },
+        },
+    )
+
+    return candidates
+
+
+async def run_periodogram_job(app, job: dict, source_ids: list):
+    """
+        Compute period candidates for source_ids, at most num_workers at a time,
+        recording progress in the periodogram_jobs collection
+    :param app:
+    :param job: periodogram_jobs document
+    :param source_ids:
+    :return:
+    """
+    semaphore = asyncio.Semaphore(app["periodogram_pool"].num_workers)
+
+    async def process(source_id):
+        async with semaphore:
+            try:
+                await source_periodogram(
+                    app, source_id, method=job["method"], user=job["user"]
+                )
+                update = {"$inc": {"done": 1}}
+            except Exception as _e:
+                print(f"Got error: {str(_e)}")
+                update = {
+                    "$inc": {"done": 1, "failed": 1},
+                    "$push": {
+                        "errors": {
+                            "$each": [{"_id": source_id, "error": str(_e)}],
+                            "$slice": -100,
+                        }
+                    },
+                }
+            update["$set"] = {"last_modified": utc_now()}
+            await app["mongo"].periodogram_jobs.update_one({"_id": job["_id"]}, update)
+
+    update = {"status": "finished"}
+    try:
+        await asyncio.gather(*(process(source_id) for source_id in source_ids))
+    except asyncio.CancelledError:
+        # the server process is stopping: leave the job to another one
+        update = {"status": "running", "runner": None}
+        raise
+    except Exception as _e:
+        print(f"Got error: {str(_e)}")
+        _err = traceback.format_exc()
+        print(_err)
+        update = {"status": "failed"}
+    finally:
+        await invalidate_query_cache(app, "sources")
+        await app["mongo"].periodogram_jobs.update_one(
+            {"_id": job["_id"]},
+            {"$set": {**update, "last_modified": utc_now()}},
+        )
+
+
+class PeriodogramJobs(object):
+    """
+    Batch periodogram jobs (see run_periodogram_job), run as tasks of the server
+    process they were submitted to.
+
+    Job progress is kept in the periodogram_jobs collection, where at most one job
+    per (program, method) can be running at a time, across all server processes
+    (unique partial index). Like QueryScheduler, every process tags the jobs it runs
+    with its id and keeps a heartbeat in the periodogram_runners collection.
+    A process that stops hands its jobs over; running jobs of processes that
+    are gone are picked up by another one, which skips the sources that already
+    have period candidates for the method.
+    """
+
+    def __init__(self, app, heartbeat_interval: float = 30):
+        self.app = app
+        self.mongo = app["mongo"]
+        self.instance_id = random_alphanumeric_str(length=24)
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat = None
+        # job id -> asyncio.Task for the jobs run by this process
+        self.tasks = dict()
+
+    async def start(self):
+        await self.beat()
+        await self.recover()
+        self.heartbeat = asyncio.ensure_future(self.heartbeats())
+
+    async def stop(self):
+        # first, so that it does not take over any more jobs
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            await asyncio.gather(self.heartbeat, return_exceptions=True)
+            self.heartbeat = None
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        # let the jobs write down that they are up for grabs
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.mongo.periodogram_runners.delete_one({"_id": self.instance_id})
+
+    async def beat(self):
+        await self.mongo.periodogram_runners.update_one(
+            {"_id": self.instance_id}, {"$set": {"last_seen": utc_now()}}, upsert=True
+        )
+
+    async def heartbeats(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.beat()
+                await self.recover()
+            except Exception as _e:
+                print(f"Got error: {str(_e)}")
+
+    def run(self, job: dict, source_ids: list):
+        task = asyncio.ensure_future(run_periodogram_job(self.app, job, source_ids))
+        self.tasks[job["_id"]] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job["_id"], None))
+
+    async def submit(self, user: str, zvm_program_id: int, method: str):
+        """
+            Start computing period candidates for all saved sources of a program,
+            unless that is already under way
+        :param user:
+        :param zvm_program_id:
+        :param method: see periodograms.METHODS
+        :return: job id
+        """
+        time_tag = utc_now()
+        job = {
+            "_id": random_alphanumeric_str(length=24),
+            "user": user,
+            "zvm_program_id": zvm_program_id,
+            "method": method,
+            "status": "running",
+            "runner": self.instance_id,
+            "total": 0,
+            "done": 0,
+            "failed": 0,
+            "errors": [],
+            "created": time_tag,
+            "last_modified": time_tag,
+        }
+        try:
+            await self.mongo.periodogram_jobs.insert_one(job)
+        except pymongo.errors.DuplicateKeyError:
+            running = await self.mongo.periodogram_jobs.find_one(
+                {
+                    "zvm_program_id": zvm_program_id,
+                    "method": method,
+                    "status": "running",
+                },
+                {"_id": 1},
+            )
+            if running is None:
+                # it has just finished
+                return await self.submit(user, zvm_program_id, method)
+            return running["_id"]
+
+        sources = await self.mongo.sources.find(
+            {"zvm_program_id": zvm_program_id}, {"_id": 1}
+        ).to_list(length=None)
+        source_ids = [source["_id"] for source in sources]
+        await self.mongo.periodogram_jobs.update_one(
+            {"_id": job["_id"]}, {"$set": {"total": len(source_ids)}}
+        )
+        self.run(job, source_ids)
+
+        return job["_id"]
+
+    async def recover(self):
+        """
+            Take over the running jobs of the processes that have stopped beating
+        :return:
+        """
+        since = utc_now() - datetime.timedelta(seconds=3 * self.heartbeat_interval)
+        alive = await self.mongo.periodogram_runners.find(
+            {"last_seen": {"$gte": since}}, {"_id": 1}
+        ).to_list(length=None)
+        orphans = await self.mongo.periodogram_jobs.find(
+            {
+                "status": "running",
+                "runner": {"$nin": [runner["_id"] for runner in alive]},
+            },
+            {"_id": 1, "runner": 1},
+        ).to_list(length=None)
+        for orphan in orphans:
+            # unless another process got there first
+            job = await self.mongo.periodogram_jobs.find_one_and_update(
+                {
+                    "_id": orphan["_id"],
+                    "status": "running",
+                    "runner": orphan.get("runner", None),
+                },
+                {"$set": {"runner": self.instance_id, "last_modified": utc_now()}},
+                return_document=pymongo.ReturnDocument.AFTER,
+            )
+            if job is not None:
+                await self.resume(job)
+        await self.mongo.periodogram_runners.delete_many({"last_seen": {"$lt": since}})
+
+    async def resume(self, job: dict):
+        q = {"zvm_program_id": job["zvm_program_id"]}
+        sources = await self.mongo.sources.find(
+            {**q, f"period_candidates.{job['method']}": {"$exists": False}},
+            {"_id": 1},
+        ).to_list(length=None)
+        source_ids = [source["_id"] for source in sources]
+        total = await self.mongo.sources.count_documents(q)
+        await self.mongo.periodogram_jobs.update_one(
+            {"_id": job["_id"]},
+            {
+                "$set": {
+                    "total": total,
+                    "done": total - len(source_ids),
+                    "failed": 0,
+                    "errors": [],
+                    "last_modified": utc_now(),
+                }
+            },
+        )
+        self.run(job, source_ids)
+
+
+@routes.put("/periodograms")
+@login_required
+async def periodograms_put_handler(request):
+    """
+        Start computing period candidates for all saved sources of a program
+        in the background
+    :param request: {"zvm_program_id": int, "method": "ls" or "ce"}
+    :return: job id, poll GET /periodograms/{job_id} for progress
+    """
+    # get session:
+    session = await get_session(request)
+    user = session["user_id"]
+
+    try:
+        _r = await request.json()
+    except Exception as _e:
+        print(f"Cannot extract json() from request, trying post(): {str(_e)}")
+        _r = await request.post()
+
+    try:
+        assert "zvm_program_id" in _r, "zvm_program_id not specified"
+        zvm_program_id = int(_r["zvm_program_id"])
+        method = _r.get("method", "ls")
+        assert method in METHODS, f"method {method} not in {METHODS}"
+
+        # the job that is already running for the program, if any
+        job_id = await request.app["periodogram_jobs"].submit(
+            user, zvm_program_id, method
+        )
+
+        return web.json_response(
+            {"message": "success", "result": {"job_id": job_id}}, status=200
+        )
+
+    except Exception as _e:
+        print(f"Got error: {str(_e)}")
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({"message": f"failure: {_err}"}, status=500)
+
+
+@routes.get("/periodograms/{job_id}")
+@login_required
+async def periodograms_get_handler(request):
+    """
+        Progress of a batch periodogram job
+    :param request:
+    :return:
+    """
+    try:
+        job = await request.app["mongo"].periodogram_jobs.find_one(
+            {"_id": request.match_info["job_id"]}
+        )
+        if job is None:
+            return web.json_response({"message": "job not found"}, status=404)
+
+        return web.json_response(
+            {"message": "success", "result": job}, status=200, dumps=dumps
+        )
+
+    except Exception as _e:
+        print(f"Got error: {str(_e)}")
+        _err = traceback.format_exc()
+        print(_err)
+        return web.json_response({"message": f"failure: {_err}"}, status=500)
+
 
 """ search ZTF light curve db """
 
@@ -3821,11 +6469,7 @@ async def search_get_handler(request):
     session = await get_session(request)
 
     # get ZVM programs:
-    programs = (
-        await request.app["mongo"]
-        .programs.find({}, {"last_modified": 0})
-        .to_list(length=None)
-    )
+    programs = await request.app["users_programs"].programs()
 
     catalogs = []
     for instance in request.app["kowalski"].instances.values():
@@ -3988,7 +6632,7 @@ async def search_post_handler(request):
             },
         }
 
-        resp = request.app["kowalski"].query(kowalski_query)
+        resp = await request.app["kowalski"].query(kowalski_query)
         # print(resp)
         sources = []
         for instance_results in resp.values():
@@ -3996,63 +6640,25 @@ async def search_post_handler(request):
                 for cone in catalog_results.values():
                     sources.extend(cone)
 
-        data_formatted = []
-        for source in sources:
-            # re-format data (mjd, mag, magerr) for easier previews in the browser:
-
-            lc = source["data"]
-
-            # filter lc for MSIP data
-            if config["misc"]["filter_MSIP"]:
-                lc = [
-                    p
-                    for p in lc
-                    if (
-                        (p["programid"] != 1)
-                        or (
-                            p["hjd"] - 2400000.5
-                            <= config["misc"]["filter_MSIP_best_before_mjd"]
-                        )
-                    )
-                ]
-                if len(lc) == 0:
-                    continue
-
-            # print(lc)
-            mags = np.array([llc["mag"] for llc in lc])
-            magerrs = np.array([llc["magerr"] for llc in lc])
-            hjds = np.array([llc["hjd"] for llc in lc])
-            mjds = hjds - 2400000.5
-            datetimes = np.array(
-                [
-                    mjd_to_datetime(llc["hjd"] - 2400000.5).strftime(
-                        "%Y-%m-%d %H:%M:%S"
-                    )
-                    for llc in lc
-                ]
-            )
+        # re-format data (mjd, mag, magerr) for easier previews in the browser,
+        # filtering out MSIP data if necessary:
+        lcs = format_search_lcs(
+            [source.pop("data", []) for source in sources],
+            msip_best_before_mjd=config["misc"]["filter_MSIP_best_before_mjd"]
+            if config["misc"]["filter_MSIP"]
+            else None,
+        )
 
-            ind_sort = np.argsort(mjds)
-            mags = mags[ind_sort].tolist()
-            magerrs = magerrs[ind_sort].tolist()
-            mjds = mjds[ind_sort].tolist()
-            datetimes = datetimes[ind_sort].tolist()
-
-            source.pop("data", None)
-            source["mag"] = mags
-            source["magerr"] = magerrs
-            # source['mjd'] = mjds
-            source["mjd"] = datetimes
+        data_formatted = []
+        for source, lc in zip(sources, lcs):
+            if config["misc"]["filter_MSIP"] and len(lc["mag"]) == 0:
+                continue
+            source.update(lc)
             source["catalog"] = catalog
-
             data_formatted.append(source)
 
         # get ZVM programs:
-        programs = (
-            await request.app["mongo"]
-            .programs.find({}, {"last_modified": 0})
-            .to_list(length=None)
-        )
+        programs = await request.app["users_programs"].programs()
 
         context = {
             "logo": config["server"]["logo"],
@@ -4071,11 +6677,9 @@ async def search_post_handler(request):
         print(f"Querying Kowalski failed: {str(_e)}")
 
         try:
-            if not request.app["kowalski"].ping():
+            if not await request.app["kowalski"].ping():
                 print("Apparently lost connection to Kowalski, trying to reset")
-                request.app["kowalski"] = Kowalski(
-                    instances=config["kowalski"]["instances"]
-                )
+                await request.app["kowalski"].reset()
                 print("Success")
         except Exception as __e:
             print(str(__e))
@@ -4198,11 +6802,25 @@ async def app_factory():
     # store mongo connection
     app["mongo"] = mongo
 
+    # query result cache
+    app["query_cache"] = TTLCache(
+        max_size=int(config["misc"]["query_cache"]["max_size"]),
+        ttl=float(config["misc"]["query_cache"]["ttl"]),
+    )
+
+    # query result cache generations, shared by all server processes
+    app["cache_generations"] = CacheGenerations(mongo=mongo)
+
     # indices
     await app["mongo"].sources.create_index(
         [("coordinates.radec_geojson", "2dsphere"), ("_id", 1)], background=True
     )
-    await app["mongo"].sources.create_index([("created", -1)], background=True)
+    await app["mongo"].sources.create_index(
+        [("coordinates.healpix_nside", 1), ("coordinates.healpix", 1)], background=True
+    )
+    await app["mongo"].sources.create_index(
+        [("created", -1), ("_id", -1)], background=True
+    )
     await app["mongo"].sources.create_index([("zvm_program_id", 1)], background=True)
     await app["mongo"].sources.create_index(
         [("zvm_program_id", 1), ("labels.user", 1)], background=True
@@ -4213,14 +6831,253 @@ async def app_factory():
     await app["mongo"].sources.create_index([("labels.label", 1)], background=True)
     await app["mongo"].sources.create_index([("lc.id", 1)], background=True)
 
+    # expire cached cross-matches
+    await app["mongo"].xmatch_cache.create_index(
+        [("expires", 1)], expireAfterSeconds=0, background=True
+    )
+
+    # expire saved queries
+    await app["mongo"].queries.create_index(
+        [("expires", 1)], expireAfterSeconds=0, background=True
+    )
+    await app["mongo"].queries.create_index(
+        [("user", 1), ("task_id", 1)], background=True
+    )
+
+    # at most one running periodogram job per program and method.
+    # jobs from before the runners were tracked have nobody to resume them
+    await app["mongo"].periodogram_jobs.update_many(
+        {"status": "running", "runner": {"$exists": False}},
+        {"$set": {"status": "failed", "last_modified": utc_now()}},
+    )
+    await app["mongo"].periodogram_jobs.create_index(
+        [("zvm_program_id", 1), ("method", 1)],
+        unique=True,
+        partialFilterExpression={"status": "running"},
+        background=True,
+    )
+
+    # labeling queues
+    await app["mongo"].labeling_queues.create_index(
+        [("key", 1), ("source_id", 1)], unique=True, background=True
+    )
+    await app["mongo"].labeling_queues.create_index(
+        [("key", 1), ("handed_out", 1), ("rank", 1)], background=True
+    )
+    await app["mongo"].labeling_queues.create_index(
+        [("user", 1), ("source_id", 1)], background=True
+    )
+    await app["mongo"].labeling_queues.create_index(
+        [("expires", 1)], expireAfterSeconds=0, background=True
+    )
+    await app["mongo"].labeling_queue_builds.create_index(
+        [("expires", 1)], expireAfterSeconds=0, background=True
+    )
+
     # graciously close mongo client on shutdown
     async def close_mongo(app):
         app["mongo"].client.close()
 
     app.on_cleanup.append(close_mongo)
 
+    # users and programs lookups
+    app["users_programs"] = UsersProgramsCache(
+        mongo=mongo, ttl=config["misc"]["users_programs_cache"]["ttl"]
+    )
+
+    async def start_users_programs(app):
+        # change streams are only available on replica sets
+        await app["users_programs"].start(
+            watch=config["database"].get("replica_set", None) is not None
+        )
+
+    async def stop_users_programs(app):
+        await app["users_programs"].stop()
+
+    app.on_startup.append(start_users_programs)
+    app.on_shutdown.append(stop_users_programs)
+
+    # bcrypt off the event loop
+    app["password_hasher"] = PasswordHasher(
+        num_workers=int(config["misc"]["password_hasher"]["num_workers"]),
+        max_queue_size=int(config["misc"]["password_hasher"]["max_queue_size"]),
+        cache_ttl=float(config["misc"]["password_hasher"]["cache_ttl"]),
+        cache_max_size=int(config["misc"]["password_hasher"]["cache_max_size"]),
+    )
+
+    async def stop_password_hasher(app):
+        app["password_hasher"].stop()
+
+    app.on_cleanup.append(stop_password_hasher)
+
+    # random labeling mode queues
+    app["labeling_queues"] = LabelingQueues(
+        mongo=mongo,
+        max_size=int(config["misc"]["labeling_queues"]["max_size"]),
+        refill_threshold=int(config["misc"]["labeling_queues"]["refill_threshold"]),
+        ttl=float(config["misc"]["labeling_queues"]["ttl"]),
+        expire_after=float(config["misc"]["labeling_queues"]["expire_after"]),
+        build_timeout=float(config["misc"]["labeling_queues"]["build_timeout"]),
+    )
+
+    async def stop_labeling_queues(app):
+        # on shutdown, i.e. before the mongo client is closed
+        await app["labeling_queues"].stop()
+
+    app.on_shutdown.append(stop_labeling_queues)
+
+    # labeling page autosave
+    app["label_writer"] = LabelWriter(
+        mongo=mongo,
+        delay=float(config["misc"]["label_writer"]["delay"]),
+        max_batch_size=int(config["misc"]["label_writer"]["max_batch_size"]),
+    )
+
+    async def stop_label_writer(app):
+        # on shutdown, i.e. before the mongo client is closed
+        await app["label_writer"].stop()
+
+    app.on_shutdown.append(stop_label_writer)
+
+    # Fritz API client
+    app["fritz"] = FritzClient(
+        url=config.get("fritz", dict()).get("url", None),
+        token=config.get("fritz", dict()).get("token", None),
+        timeout=float(config["misc"]["fritz"]["timeout"]),
+        max_connections=int(config["misc"]["fritz"]["max_connections"]),
+        max_retries=int(config["misc"]["fritz"]["max_retries"]),
+        backoff=float(config["misc"]["fritz"]["backoff"]),
+        cooldown=float(config["misc"]["fritz"]["cooldown"]),
+        cache_ttl=float(config["misc"]["fritz"]["cache_ttl"]),
+        cache_max_entries=int(config["misc"]["fritz"]["cache_max_entries"]),
+        instruments_ttl=float(config["misc"]["fritz"]["instruments_ttl"]),
+        page_timeout=float(config["misc"]["fritz"]["page_timeout"]),
+    )
+
+    async def start_fritz(app):
+        await app["fritz"].start()
+
+    async def stop_fritz(app):
+        await app["fritz"].stop()
+
+    app.on_startup.append(start_fritz)
+    app.on_cleanup.append(stop_fritz)
+
+    # background query scheduler
+    app["query_scheduler"] = QueryScheduler(
+        mongo=mongo,
+        num_workers=int(config["misc"]["query_scheduler"]["num_workers"]),
+        max_queue_size=int(config["misc"]["query_scheduler"]["max_queue_size"]),
+        heartbeat_interval=float(
+            config["misc"]["query_scheduler"]["heartbeat_interval"]
+        ),
+    )
+
+    async def start_query_scheduler(app):
+        await app["query_scheduler"].start()
+
+    async def stop_query_scheduler(app):
+        await app["query_scheduler"].stop()
+
+    app.on_startup.append(start_query_scheduler)
+    app.on_shutdown.append(stop_query_scheduler)
+
     # Kowalski connection:
-    app["kowalski"] = Kowalski(instances=config["kowalski"]["instances"])
+    app["kowalski"] = KowalskiGateway(
+        instances=config["kowalski"]["instances"],
+        max_concurrency=int(config["kowalski"]["client"]["max_concurrency"]),
+        timeout=float(config["kowalski"]["client"]["timeout"]),
+        default_instance=config["kowalski"]["client"]["default_instance"],
+    )
+
+    # plot rendering
+    app["plot_renderer"] = ProcessPool(
+        num_workers=config["misc"]["plot_renderer"]["num_workers"],
+        max_queue_size=int(config["misc"]["plot_renderer"]["max_queue_size"]),
+        timeout=float(config["misc"]["plot_renderer"]["timeout"]),
+    )
+
+    async def start_plot_renderer(app):
+        # the HR diagram fallback is always the same
+        catalogs = config["kowalski"]["catalogs_hr_diagram"]
+        app["hr_no_match"] = await app["plot_renderer"].run(
+            plot_hr,
+            no_match=f'No Match in {", ".join(catalogs)}\n'
+            " (with all required properties)",
+        )
+
+    async def stop_plot_renderer(app):
+        app["plot_renderer"].stop()
+
+    app.on_startup.append(start_plot_renderer)
+    app.on_cleanup.append(stop_plot_renderer)
+
+    # periodograms, on their own pool so that batch jobs do not hold up the plots
+    app["periodogram_pool"] = ProcessPool(
+        num_workers=config["misc"]["periodogram"]["num_workers"],
+        max_queue_size=int(config["misc"]["periodogram"]["max_queue_size"]),
+        timeout=float(config["misc"]["periodogram"]["timeout"]),
+    )
+    # batch jobs
+    app["periodogram_jobs"] = PeriodogramJobs(
+        app,
+        heartbeat_interval=float(config["misc"]["periodogram"]["heartbeat_interval"]),
+    )
+
+    async def start_periodograms(app):
+        await app["periodogram_jobs"].start()
+
+    async def stop_periodogram_jobs(app):
+        # on shutdown, i.e. before the mongo client is closed
+        await app["periodogram_jobs"].stop()
+
+    async def stop_periodograms(app):
+        app["periodogram_pool"].stop()
+
+    app.on_startup.append(start_periodograms)
+    app.on_shutdown.append(stop_periodogram_jobs)
+    app.on_cleanup.append(stop_periodograms)
+
+    # rendered plots
+    app["plot_cache"] = PlotCache(
+        path=os.path.join(config["path"]["path_tmp"], "plots"),
+        max_size=int(config["misc"]["plot_cache"]["max_size"]),
+    )
+
+    # PS1 cutouts
+    app["ps1"] = PS1Client(
+        cache=PlotCache(
+            path=os.path.join(config["path"]["path_tmp"], "ps1"),
+            max_size=int(config["misc"]["ps1"]["cache_max_size"]),
+        ),
+        base_url=config["misc"]["ps1"]["base_url"],
+        timeout=float(config["misc"]["ps1"]["timeout"]),
+        max_connections=int(config["misc"]["ps1"]["max_connections"]),
+        prefetch_workers=int(config["misc"]["ps1"]["prefetch_workers"]),
+        prefetch_queue_size=int(config["misc"]["ps1"]["prefetch_queue_size"]),
+    )
+
+    async def start_ps1(app):
+        await app["ps1"].start()
+
+    async def stop_ps1(app):
+        await app["ps1"].stop()
+
+    app.on_startup.append(start_ps1)
+    app.on_cleanup.append(stop_ps1)
+
+    # Kowalski cross-match cache
+    app["xmatch_cache"] = XMatchCache(
+        mongo=mongo,
+        nside=int(config["misc"]["xmatch_cache"]["nside"]),
+        ttl=float(config["misc"]["xmatch_cache"]["ttl"]),
+        max_entries=int(config["misc"]["xmatch_cache"]["max_entries"]),
+    )
+
+    async def stop_kowalski(app):
+        app["kowalski"].stop()
+
+    app.on_cleanup.append(stop_kowalski)
 
     # set up JWT for user authentication/authorization
     app["JWT"] = {
@@ -4310,6 +7167,161 @@ class TestAPIs(object):
         resp = await client.delete("/users", json={"user": "test_user_edited"})
         assert resp.status == 200
 
+    # test saved sources pagination
+    async def test_sources(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+
+        login = await client.post(
+            "/login",
+            json={
+                "username": config["server"]["admin_username"],
+                "password": config["server"]["admin_password"],
+            },
+        )
+        assert login.status == 200
+
+        resp = await client.get("/sources", params={"format": "json", "page_size": 2})
+        assert resp.status == 200
+        page = await resp.json()
+        assert page["message"] == "success"
+        assert len(page["data"]) <= 2
+
+        if page["next_page_token"] is not None:
+            resp = await client.get(
+                "/sources",
+                params={
+                    "format": "json",
+                    "page_size": 2,
+                    "page_token": page["next_page_token"],
+                },
+            )
+            assert resp.status == 200
+            next_page = await resp.json()
+            assert len(next_page["data"]) > 0
+            # pages do not overlap
+            assert not {s["_id"] for s in page["data"]} & {
+                s["_id"] for s in next_page["data"]
+            }
+
+        resp = await client.get("/sources", params={"format": "json", "count": "exact"})
+        assert resp.status == 200
+        count = await resp.json()
+        assert count["count"] >= len(page["data"])
+
+    # test that coalesced autosave label writes keep other users' labels
+    async def test_labels(self, aiohttp_client):
+        client = await aiohttp_client(await app_factory())
+        mongo = client.server.app["mongo"]
+
+        login = await client.post(
+            "/login",
+            json={
+                "username": config["server"]["admin_username"],
+                "password": config["server"]["admin_password"],
+            },
+        )
+        assert login.status == 200
+
+        source_id = f"test_{random_alphanumeric_str(8)}"
+        other = {"type": "phenomenological", "label": "variable", "value": 1}
+        await mongo.sources.insert_one(
+            {"_id": source_id, "labels": [{**other, "user": "someone_else"}]}
+        )
+
+        try:
+            resp = await client.post(
+                f"/sources/{source_id}",
+                json={"action": "set_labels", "labels": [{**other, "value": 0.25}]},
+            )
+            assert resp.status == 200
+            assert (await resp.json())["message"] == "success"
+
+            # rapid successive clicks are coalesced, only the last one should stick
+            admin = config["server"]["admin_username"]
+            await asyncio.gather(
+                *(
+                    client.server.app["label_writer"].set(
+                        admin,
+                        source_id,
+                        [{**other, "value": value, "user": admin}],
+                        utc_now(),
+                    )
+                    for value in (0.5, 0.75, 1)
+                )
+            )
+
+            source = await mongo.sources.find_one({"_id": source_id})
+            mine = [lab for lab in source["labels"] if lab["user"] == admin]
+            theirs = [lab for lab in source["labels"] if lab["user"] != admin]
+            assert len(mine) == 1
+            assert mine[0]["value"] == 1
+            assert theirs == [{**other, "user": "someone_else"}]
+
+        finally:
+            await mongo.sources.delete_one({"_id": source_id})
+
+    # test PS1 cutout client against a local stand-in for the PS1 image server
+    async def test_ps1(self, aiohttp_server, tmp_path):
+        requests_seen = []
+
+        async def ps1filenames(request):
+            requests_seen.append(request.path)
+            lines = ["projcell subcell ra dec filter mjd type filename shortname"]
+            for f in "grizy":
+                lines.append(
+                    f"2381 062 0 0 {f} 0 stack "
+                    f"/rings.v3.skycell/2381/062/skycell.2381.062.stk.{f}.unconv.fits x"
+                )
+            return web.Response(text="\n".join(lines))
+
+        async def fitscut(request):
+            requests_seen.append(request.path)
+            assert ".y." in request.query["red"]
+            return web.Response(body=b"\x89PNG stand-in", content_type="image/png")
+
+        stand_in = web.Application()
+        stand_in.router.add_get("/cgi-bin/ps1filenames.py", ps1filenames)
+        stand_in.router.add_get("/cgi-bin/fitscut.cgi", fitscut)
+        server = await aiohttp_server(stand_in)
+
+        ps1 = PS1Client(
+            cache=PlotCache(path=str(tmp_path), max_size=1024),
+            base_url=str(server.make_url("/cgi-bin/")),
+            prefetch_workers=1,
+            prefetch_queue_size=1,
+        )
+        await ps1.start()
+        try:
+            cutouts = await asyncio.gather(
+                ps1.cutout(10.0, 20.0), ps1.cutout(10.0, 20.0)
+            )
+            assert cutouts == [b"\x89PNG stand-in"] * 2
+            # concurrent requests share one download
+            assert len(requests_seen) == 2
+
+            # served from disk
+            assert await ps1.cutout(10.0, 20.0) == b"\x89PNG stand-in"
+            assert len(requests_seen) == 2
+
+            # prefetches that do not fit in the queue are dropped
+            ps1.prefetch(30.0, 40.0)
+            ps1.prefetch(31.0, 41.0)
+            await ps1.prefetch_queue.join()
+            assert len(requests_seen) == 4
+            assert await ps1.cutout(30.0, 40.0) == b"\x89PNG stand-in"
+            assert len(requests_seen) == 4
+        finally:
+            await ps1.stop()
+
+    # the plot cache directory is shared by the server processes and bounded as a whole
+    async def test_plot_cache(self, tmp_path):
+        caches = [PlotCache(path=str(tmp_path), max_size=10000) for _ in range(2)]
+        for ii in range(40):
+            await caches[ii % 2].set(f"plot{ii}", b"x" * 1000)
+        assert sum(ff.stat().st_size for ff in tmp_path.glob("*.png")) <= 10000
+        assert await caches[0].get("plot39") == b"x" * 1000
+        assert await caches[1].get("plot0") is None
+
     # test programmatic query API
     async def test_query(self, aiohttp_client):
         # todo:
@@ -4360,6 +7372,17 @@ class TestAPIs(object):
         # print(result)
         assert result["status"] == "enqueued"
 
+        # fetch enqueued task
+        resp = await client.post(
+            "/query",
+            json={"task_id": result["query_id"], "part": "task"},
+            headers=headers,
+            timeout=1,
+        )
+        assert resp.status == 200
+        task = await resp.json()
+        assert task["query_type"] == "general_search"
+
         # remove enqueued query
         resp = await client.delete(
             "/query", json={"task_id": result["query_id"]}, headers=headers, timeout=1
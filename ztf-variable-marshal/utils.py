@@ -4,16 +4,20 @@ import hashlib
 import itertools
 import math
 import random
+import re
 import secrets
 import string
+import time
+from collections import OrderedDict
 from string import ascii_lowercase
 
+import astropy.units as u
 import bcrypt
 import numpy as np
 import pytz
 import requests
+from astropy_healpix import HEALPix
 from bson.json_util import dumps
-from numba import jit
 
 
 def generate_password_hash(password, salt_rounds=12):
@@ -56,6 +60,118 @@ def great_circle_distance(phi1, lambda1, phi2, lambda2):
     )
 
 
+def group_positions(lon, lat, radius):
+    """
+        Greedily group sky positions so that every member of a group lies
+        within radius of the group's seed position
+
+    :param lon: longitudes (e.g. RA or GeoJSON-friendly RA) [rad]
+    :param lat: latitudes (e.g. Dec) [rad]
+    :param radius: grouping radius [rad]
+    :return: list of (seed index, array of member indices) tuples
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+
+    groups = []
+    unassigned = np.ones(len(lon), dtype=bool)
+    for seed in range(len(lon)):
+        if not unassigned[seed]:
+            continue
+        candidates = np.flatnonzero(unassigned)
+        distances = great_circle_distance(
+            lat[seed], lon[seed], lat[candidates], lon[candidates]
+        )
+        members = candidates[distances <= radius]
+        unassigned[members] = False
+        groups.append((seed, members))
+
+    return groups
+
+
+def radec2healpix(ra, dec, nside: int):
+    """
+        Nested HEALPix pixel index of sky position(s)
+
+    :param ra: [deg]
+    :param dec: [deg]
+    :param nside:
+    :return: pixel index (array if ra/dec are arrays)
+    """
+    hp = HEALPix(nside=nside, order="nested")
+    return hp.lonlat_to_healpix(
+        np.asarray(ra, dtype=np.float64) * u.deg,
+        np.asarray(dec, dtype=np.float64) * u.deg,
+    )
+
+
+def healpix_cone_pixels(ra, dec, radius, nside: int):
+    """
+        Nested HEALPix pixels overlapping cones around sky positions
+
+    :param ra: [deg]
+    :param dec: [deg]
+    :param radius: cone radius (or an array of those) [rad]
+    :param nside:
+    :return: list of pixel index arrays, one per position
+    """
+    hp = HEALPix(nside=nside, order="nested")
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+    radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), ra.shape)
+
+    return [
+        hp.cone_search_lonlat(_ra * u.deg, _dec * u.deg, _radius * u.rad)
+        for _ra, _dec, _radius in zip(ra, dec, radius)
+    ]
+
+
+def healpix_cross_match(
+    ra, dec, radius, position_pixels, match_ra, match_dec, match_pixels
+):
+    """
+        Exact cross-match of sky positions against candidates
+        pre-selected by HEALPix pixel, see healpix_cone_pixels
+
+    :param ra: positions [deg]
+    :param dec: positions [deg]
+    :param radius: cone radius (or an array of those) [rad]
+    :param position_pixels: list of pixel index arrays, one per position
+    :param match_ra: candidates [deg]
+    :param match_dec: candidates [deg]
+    :param match_pixels: candidate pixel indices
+    :return: list of candidate index arrays, one per position
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64)) * np.pi / 180.0
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64)) * np.pi / 180.0
+    radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), ra.shape)
+    match_ra = np.asarray(match_ra, dtype=np.float64) * np.pi / 180.0
+    match_dec = np.asarray(match_dec, dtype=np.float64) * np.pi / 180.0
+    match_pixels = np.asarray(match_pixels, dtype=np.int64)
+
+    # group candidates by pixel: sort once and look pixels up with searchsorted
+    order = np.argsort(match_pixels, kind="stable")
+    sorted_pixels = match_pixels[order]
+
+    matches = []
+    for ii, pixels in enumerate(position_pixels):
+        pixels = np.asarray(pixels, dtype=np.int64)
+        start = np.searchsorted(sorted_pixels, pixels, side="left")
+        stop = np.searchsorted(sorted_pixels, pixels, side="right")
+        if np.sum(stop - start) == 0:
+            matches.append(np.array([], dtype=np.int64))
+            continue
+        candidates = np.sort(
+            np.concatenate([order[i0:i1] for i0, i1 in zip(start, stop) if i1 > i0])
+        )
+        distances = great_circle_distance(
+            dec[ii], ra[ii], match_dec[candidates], match_ra[candidates]
+        )
+        matches.append(candidates[distances <= radius[ii]])
+
+    return matches
+
+
 # @jit(forceobj=True)
 def deg2hms(x):
     """Transform degrees to *hours:minutes:seconds* strings.
@@ -415,6 +531,274 @@ def mjd_to_datetime(_mjd):
     return jd_to_datetime(_jd)
 
 
+# MJD 0 as numpy datetime64
+MJD_EPOCH = np.datetime64("1858-11-17T00:00:00", "us")
+
+
+def mjd_to_datetime64(_mjd):
+    """
+        Convert MJD(s) to numpy datetime64[us]
+    :param _mjd: float or array of floats
+    :return:
+    """
+    microseconds = np.round(np.asarray(_mjd, dtype=np.float64) * 86400e6)
+    return MJD_EPOCH + microseconds.astype("timedelta64[us]")
+
+
+def lc_records_to_columns(data, fields=None):
+    """
+        Convert light curve data points [{field: value}] into {field: np.array},
+        missing values become nan
+
+    :param data: list of data point dicts
+    :param fields: fields to extract, all present in any data point by default
+    :return:
+    """
+    if fields is None:
+        fields = list(dict.fromkeys(itertools.chain.from_iterable(data)))
+    present = set(itertools.chain.from_iterable(data))
+
+    columns = dict()
+    for field in fields:
+        if field not in present:
+            continue
+        values = [dp.get(field, None) for dp in data]
+        try:
+            columns[field] = np.array(values, dtype=np.float64)
+        except (TypeError, ValueError):
+            columns[field] = np.array(values, dtype=object)
+
+    return columns
+
+
+def pack_lc(lc: dict, lc_format: str = "records"):
+    """
+        Convert light curve data points [{field: value}] into the storage format:
+
+        records: as is (legacy)
+        columnar: data = {field: [values]}, None for missing values
+        packed: same as columnar, but complete numeric fields are stored
+                as raw little-endian int64/float64 bytes, their dtypes in lc["dtypes"]
+
+    :param lc: light curve with data as a list of data points
+    :param lc_format: records, columnar, or packed
+    :return: light curve in the storage format
+    """
+    if lc_format == "records":
+        return lc
+    if lc_format not in ("columnar", "packed"):
+        raise ValueError(f"Unknown light curve storage format {lc_format}")
+
+    data = lc["data"]
+    fields = list(dict.fromkeys(itertools.chain.from_iterable(data)))
+
+    columns, dtypes = dict(), dict()
+    for field in fields:
+        values = [dp.get(field, None) for dp in data]
+        columns[field] = values
+
+        if lc_format == "packed":
+            # bool is an int, too, but keep it as is
+            types = {type(vv) for vv in values}
+            if types <= {int, np.int32, np.int64}:
+                dtypes[field] = "<i8"
+            elif types <= {int, float, np.int32, np.int64, np.float32, np.float64}:
+                dtypes[field] = "<f8"
+            else:
+                continue
+            columns[field] = np.array(values, dtype=dtypes[field]).tobytes()
+
+    packed = {kk: vv for kk, vv in lc.items() if kk not in ("data", "dtypes")}
+    packed["format"] = lc_format
+    packed["data"] = columns
+    if lc_format == "packed":
+        packed["dtypes"] = dtypes
+
+    return packed
+
+
+def lc_columns(lc: dict, fields=None):
+    """
+        Light curve data as {field: np.array} regardless of the storage format,
+        missing values become nan
+
+    :param lc: light curve in any storage format, see pack_lc
+    :param fields: fields to extract, all by default
+    :return:
+    """
+    if lc.get("format", "records") == "records":
+        return lc_records_to_columns(lc["data"], fields=fields)
+
+    dtypes = lc.get("dtypes", dict())
+    columns = dict()
+    for field in fields if fields is not None else lc["data"].keys():
+        if field not in lc["data"]:
+            continue
+        values = lc["data"][field]
+        if field in dtypes:
+            columns[field] = np.frombuffer(values, dtype=dtypes[field])
+            continue
+        try:
+            columns[field] = np.array(values, dtype=np.float64)
+        except (TypeError, ValueError):
+            columns[field] = np.array(values, dtype=object)
+
+    return columns
+
+
+def lc_records(lc: dict):
+    """
+        Light curve with data as a list of data points regardless of the storage format
+    :param lc: light curve in any storage format, see pack_lc
+    :return: light curve in the records format
+    """
+    if lc.get("format", "records") == "records":
+        return lc
+
+    dtypes = lc.get("dtypes", dict())
+    columns = {
+        field: np.frombuffer(values, dtype=dtypes[field]).tolist()
+        if field in dtypes
+        else values
+        for field, values in lc["data"].items()
+    }
+    num_points = max((len(vv) for vv in columns.values()), default=0)
+    data = [
+        {
+            field: values[ii]
+            for field, values in columns.items()
+            if values[ii] is not None
+        }
+        for ii in range(num_points)
+    ]
+
+    records = {
+        kk: vv for kk, vv in lc.items() if kk not in ("data", "dtypes", "format")
+    }
+    records["data"] = data
+
+    return records
+
+
+def preprocess_lc(columns, t_utc=None):
+    """
+        Compute time representations for a temporal light curve and split it
+        into detections and upper/lower limits for plotting
+
+    :param columns: {field: np.array}, see lc_records_to_columns.
+                    hjd or mjd must be present; mag, magerr, mag_ulim, mag_llim are optional
+    :param t_utc: reference time for days_ago, utc now by default
+    :return: {"lc_det": {...}, "lc_nodet_u": {...}, "lc_nodet_l": {...}} with plain lists
+    """
+    if t_utc is None:
+        t_utc = datetime.datetime.utcnow()
+
+    def column(field):
+        # missing values are treated as zeros
+        return np.nan_to_num(
+            np.asarray(columns[field], dtype=np.float64),
+            nan=0.0,
+            posinf=0.0,
+            neginf=0.0,
+        )
+
+    mjd = column("mjd") if "mjd" in columns else column("hjd") - 2400000.5
+    hjd = column("hjd") if "hjd" in columns else mjd + 2400000.5
+    jd = column("jd") if "jd" in columns else mjd + 2400000.5
+
+    order = np.argsort(mjd, kind="stable")
+    mjd, hjd, jd = mjd[order], hjd[order], jd[order]
+
+    datetimes = mjd_to_datetime64(mjd)
+    if "dt" in columns:
+        dt = np.asarray(columns["dt"])[order].astype(str)
+    else:
+        # strings for plotly
+        dt = np.char.replace(np.datetime_as_string(datetimes, unit="s"), "T", " ")
+    # fractional days ago
+    days_ago = (np.datetime64(t_utc, "us") - datetimes) / np.timedelta64(86400, "s")
+
+    times = {"dt": dt, "days_ago": days_ago, "jd": jd, "mjd": mjd, "hjd": hjd}
+    zeros = np.zeros_like(mjd)
+
+    lc = dict()
+    for key, mask_field, fields in (
+        ("lc_det", "mag", ("mag", "magerr")),
+        ("lc_nodet_u", "mag_ulim", ("mag_ulim",)),
+        ("lc_nodet_l", "mag_llim", ("mag_llim",)),
+    ):
+        values = {
+            field: column(field)[order] if field in columns else zeros
+            for field in fields
+        }
+        mask = (
+            values[mask_field] > 0.01
+            if mask_field in columns
+            else np.zeros_like(mjd, dtype=bool)
+        )
+        lc[key] = {
+            **{kk: vv[mask].tolist() for kk, vv in times.items()},
+            **{kk: vv[mask].tolist() for kk, vv in values.items()},
+        }
+
+    return lc
+
+
+def format_search_lcs(lcs, msip_best_before_mjd=None):
+    """
+        Format the light curves of many sources for the search page in one pass:
+        flatten them into contiguous arrays, drop MSIP data points taken after
+        msip_best_before_mjd, sort by time within each source, convert times
+        to strings and split the result back per source
+
+    :param lcs: list of light curves, each a list of data points
+                {"hjd": ..., "mag": ..., "magerr": ..., "programid": ...}
+    :param msip_best_before_mjd: do not filter MSIP data if None
+    :return: list of {"mag": [...], "magerr": [...], "mjd": ["%Y-%m-%d %H:%M:%S"]},
+             in the order of lcs
+    """
+    counts = np.fromiter((len(lc) for lc in lcs), dtype=np.int64, count=len(lcs))
+    source_index = np.repeat(np.arange(len(lcs)), counts)
+    columns = lc_records_to_columns(
+        list(itertools.chain.from_iterable(lcs)),
+        fields=("hjd", "mag", "magerr", "programid"),
+    )
+    num_points = len(source_index)
+
+    def column(field):
+        if field not in columns:
+            return np.full(num_points, np.nan)
+        return columns[field]
+
+    mjd = np.asarray(column("hjd"), dtype=np.float64) - 2400000.5
+    mag, magerr = column("mag"), column("magerr")
+
+    if msip_best_before_mjd is not None:
+        keep = (column("programid") != 1) | (mjd <= msip_best_before_mjd)
+    else:
+        keep = np.ones(num_points, dtype=bool)
+
+    # sort by time within each source
+    order = np.lexsort((mjd, source_index))
+    order = order[keep[order]]
+    counts = np.bincount(source_index[order], minlength=len(lcs))
+    offsets = np.r_[0, np.cumsum(counts)]
+
+    dt = np.char.replace(
+        np.datetime_as_string(mjd_to_datetime64(mjd[order]), unit="s"), "T", " "
+    ).tolist()
+    mag, magerr = mag[order].tolist(), magerr[order].tolist()
+
+    return [
+        {
+            "mag": mag[start:stop],
+            "magerr": magerr[start:stop],
+            "mjd": dt[start:stop],
+        }
+        for start, stop in zip(offsets[:-1], offsets[1:])
+    ]
+
+
 def compute_hash(_task):
     """
         Compute hash for a hashable task
@@ -427,6 +811,103 @@ def compute_hash(_task):
     return hsh
 
 
+class TTLCache(object):
+    """
+    In-process LRU cache with a per-entry time-to-live, bounded by the total size
+    of the cached values as measured by size_of (len by default, i.e. bytes for bytes).
+
+    Entries may be tagged (e.g. with the names of the collections they were computed from)
+    so that they can be invalidated by tag when the underlying data change.
+    """
+
+    def __init__(self, max_size: int, ttl: float, size_of=len):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size_of = size_of
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (value, size, expiration time, tags), oldest first
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key, None)
+        return entry is not None and entry[2] > time.monotonic()
+
+    def _pop(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry[1]
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key, None)
+        if entry is None or entry[2] <= time.monotonic():
+            if entry is not None:
+                self._pop(key)
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, tags=(), ttl: float = None):
+        """
+            Cache value under key, evicting least recently used entries if necessary
+        :param key:
+        :param value:
+        :param tags: iterable of tags to invalidate the entry by
+        :param ttl: override default time-to-live [s]
+        :return: True if value was cached, False if it is too big to fit
+        """
+        size = self.size_of(value)
+        if size > self.max_size:
+            return False
+
+        if key in self._entries:
+            self._pop(key)
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (value, size, expires, frozenset(tags))
+        self.size += size
+
+        while self.size > self.max_size:
+            self._pop(next(iter(self._entries)))
+
+        return True
+
+    def delete(self, key):
+        if key in self._entries:
+            self._pop(key)
+
+    def invalidate(self, tag):
+        """
+            Drop all entries tagged with tag
+        :param tag:
+        :return:
+        """
+        for key in [kk for kk, entry in self._entries.items() if tag in entry[3]]:
+            self._pop(key)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 def random_alphanumeric_str(length: int = 8):
     return "".join(
         random.SystemRandom().choice(string.ascii_uppercase + string.digits)
@@ -434,21 +915,20 @@ def random_alphanumeric_str(length: int = 8):
     ).lower()
 
 
-@jit(forceobj=True)
-def iter_all_strings():
-    for size in itertools.count(1):
-        for s in itertools.product(ascii_lowercase, repeat=size):
-            yield "".join(s)
-
-
 def num2alphabet(num: int):
-
+    """
+        Bijective base-26 representation of num: 1 -> a, 26 -> z, 27 -> aa, ...
+    :param num: >= 1
+    :return:
+    """
     assert num >= 1, "bad number"
 
-    for s in itertools.islice(iter_all_strings(), num):
-        pass
+    digits = []
+    while num > 0:
+        num, remainder = divmod(num - 1, 26)
+        digits.append(ascii_lowercase[remainder])
 
-    return s
+    return "".join(reversed(digits))
 
 
 def alphabet2num(dg: str):
@@ -460,6 +940,19 @@ def alphabet2num(dg: str):
     )
 
 
+def split_source_id(source_id: str):
+    """
+        Split an incrementally named source id {prefix}{yy}{ra hours}{a, b, ..., aa, ...}
+        into its counter bucket and number
+    :param source_id:
+    :return: (bucket, number) or None if source_id does not look like that
+    """
+    match = re.fullmatch(r"(.*\d{4})([a-z]+)", source_id)
+    if match is None:
+        return None
+    return match.group(1), alphabet2num(match.group(2))
+
+
 # alphabet = string.ascii_letters + string.digits
 alphabet = string.ascii_lowercase + string.digits
 
@@ -535,10 +1028,10 @@ PANSTARRS_SOURCE = "http://ps1images.stsci.edu/cgi-bin/"
 # ===================== #
 
 
-def build_panstarrs_link(ra, dec, type="stack"):
+def build_panstarrs_link(ra, dec, type="stack", source=PANSTARRS_SOURCE):
     """build the link where you will get the ps1 filename information for the given Ra Dec and type."""
     return (
-        PANSTARRS_SOURCE
+        source
         + "ps1filenames.py?ra="
         + str(ra)
         + "&dec="
@@ -547,30 +1040,32 @@ def build_panstarrs_link(ra, dec, type="stack"):
     )
 
 
-def get_ps_color_filelocation(ra, dec, color=("y", "g", "i"), timeout=1):
-    """ """
+def parse_ps_filenames(text, color=("y", "g", "i")):
+    """parse ps1filenames.py output into the file locations for the given colors"""
     if len(color) != 3:
         raise ValueError("color must have exactly 3 entries ('g','r','i','z','y')")
-    d = [
-        link.split(" ")[-2]
-        for link in requests.get(build_panstarrs_link(ra, dec), timeout=timeout)
-        .content.decode("utf-8")
-        .splitlines()[1:]
-    ]
+    d = [link.split(" ")[-2] for link in text.splitlines()[1:]]
     return np.asarray([[d_ for d_ in d if ".%s." % b in d_] for b in color]).flatten()
 
 
-def get_rgb_ps_stamp_url(ra, dec, size=240, color=("y", "g", "i"), timeout=1):
-    """build the link url where you can download the RGB stamps centered on RA-Dec with a `size`.
-    The RGB color is based on the given color [R,G,B] you set in.
+def get_ps_color_filelocation(ra, dec, color=("y", "g", "i"), timeout=1):
+    """ """
+    if len(color) != 3:
+        raise ValueError("color must have exactly 3 entries ('g','r','i','z','y')")
+    return parse_ps_filenames(
+        requests.get(build_panstarrs_link(ra, dec), timeout=timeout).content.decode(
+            "utf-8"
+        ),
+        color=color,
+    )
 
-    Returns
-    -------
-    link (str)
-    """
-    red, blue, green = get_ps_color_filelocation(ra, dec, color=color, timeout=timeout)
+
+def build_rgb_ps_stamp_url(
+    red, blue, green, ra, dec, size=240, source=PANSTARRS_SOURCE
+):
+    """build the link url to download the RGB stamp made of the given files"""
     return (
-        PANSTARRS_SOURCE
+        source
         + "fitscut.cgi?red="
         + red
         + "&blue="
@@ -584,3 +1079,15 @@ def get_rgb_ps_stamp_url(ra, dec, size=240, color=("y", "g", "i"), timeout=1):
         + "&size=%d" % size
         + "&wcs=1&asinh=True&autoscale=99.750000&format=png&download=True"
     )
+
+
+def get_rgb_ps_stamp_url(ra, dec, size=240, color=("y", "g", "i"), timeout=1):
+    """build the link url where you can download the RGB stamps centered on RA-Dec with a `size`.
+    The RGB color is based on the given color [R,G,B] you set in.
+
+    Returns
+    -------
+    link (str)
+    """
+    red, blue, green = get_ps_color_filelocation(ra, dec, color=color, timeout=timeout)
+    return build_rgb_ps_stamp_url(red, blue, green, ra, dec, size=size)
@@ -181,6 +181,10 @@ class zvm(object):
 
     def query(self, query, timeout: int | float = 5 * 3600, retries: int = 3):
 
+        # streaming requested? hand back a generator over the result documents
+        if str(query.get("kwargs", dict()).get("stream", False)).lower() == "true":
+            return self.query_stream(query=query, timeout=timeout)
+
         try:
             _query = deepcopy(query)
 
@@ -236,6 +240,44 @@ class zvm(object):
 
             return {"status": "failed", "message": _err}
 
+    def query_stream(self, query, timeout: int | float = 5 * 3600):
+        """
+            Execute a find or aggregate query in streaming mode,
+            yielding result documents as they arrive from the server
+        :param query:
+        :param timeout:
+        :return: generator over the result documents
+        """
+        _query = deepcopy(query)
+        if "kwargs" not in _query:
+            _query["kwargs"] = dict()
+        _query["kwargs"]["stream"] = True
+
+        with self.session.put(
+            os.path.join(self.base_url, "query"),
+            json=_query,
+            headers=self.headers,
+            timeout=timeout,
+            cookies={"jwt_token": self.access_token, "user_id": self.username},
+            stream=True,
+        ) as resp:
+            if resp.status_code != requests.codes.ok:
+                raise Exception(resp.text)
+
+            # documents are newline-delimited; the last line is a status trailer
+            for line in resp.iter_lines(chunk_size=None):
+                if len(line) == 0:
+                    continue
+                document = loads(line)
+                if "$zvm_stream" in document:
+                    trailer = document["$zvm_stream"]
+                    if trailer["status"] != "done":
+                        raise Exception(trailer.get("msg", "query failed"))
+                    return
+                yield document
+
+        raise Exception("stream ended prematurely")
+
     def get_query(self, query_id: str, part: str = "result", retries: int = 3):
         """
             Fetch json for task or result by query id